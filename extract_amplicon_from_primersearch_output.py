@@ -46,6 +46,7 @@ from Bio import Seq, SeqIO, SeqUtils, SeqRecord
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 from pathlib import Path
+from helper_scripts.seq_reader import OffsetIndex
 import argparse
 import subprocess
 import shutil
@@ -108,6 +109,8 @@ def extractAmpliconLength(amplimer_length_line):
 
 def parsePrimerSearch(primersearch_results, full_length_dict, file_base):
     # parse primersearch results file
+    # each contig is read (from full_length_dict) once, and kept for the amplicons of the other primers
+    full_length_seqs = {}
     with open(primersearch_results, 'r') as inputFile:
         extracted_amplicon_list = []  # empty list of extracted amplicon sequence
         not_match_primer_list = []
@@ -143,8 +146,10 @@ def parsePrimerSearch(primersearch_results, full_length_dict, file_base):
                     # check if extracted amplicon is over the max length
                     if endIndex - startIndex <= max_amplicon_len:
                         
-                        full_length_record = full_length_dict[seq_id]  # created SeqRecord from amplicon and add to list
-                        extracted_sequence = full_length_record.seq[startIndex:endIndex]
+                        if seq_id not in full_length_seqs:
+                            full_length_seqs[seq_id] = full_length_dict[seq_id].seq
+                        # created SeqRecord from amplicon and add to list
+                        extracted_sequence = Seq(full_length_seqs[seq_id][startIndex:endIndex])
                         # ampliconRec = SeqRecord(extracted_sequence, id=f'{primer_name}-{seq_id}') 
                         ampliconRec = SeqRecord(extracted_sequence, id=f'{primer_name}-{file_base}'[:max_seqid_len])
                         extracted_amplicon_list.append(ampliconRec)
@@ -203,8 +208,9 @@ if __name__ == "__main__":
             print (f"primersearch does not generate any results ! exitting")
             sys.exit()
             
-        # read full-length fasta sequences into dict of SeqrRecords with key = record.id
-        full_length_dict = SeqIO.to_dict(SeqIO.parse(fasta_file, "fasta"))
+        # lazy dict of the full-length fasta records with key = seq_id, each record is read (from the
+        # offset index next to the fasta file) only when one of its amplicons is extracted
+        full_length_dict = OffsetIndex(fasta_file)
         extracted_amplicon_list, not_match_primer_list, _3lists_for_df \
             = parsePrimerSearch(primersearch_results, full_length_dict, file_base)
         
@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 
 import argparse
-from Bio import SeqIO
 import gzip
+from seq_reader import read_records
 
 '''
 This script is currently set to run inside the hmas2_sampling_rawreads.nf.
@@ -27,15 +27,19 @@ def parse_argument():
 
 
 def extract_rawreads(source_read, raw_read, output_file, compress=True):
-    source_dict = SeqIO.to_dict(SeqIO.parse(source_read, "fastq"))
-    with gzip.open(raw_read, 'rt') as r:
-        raw_dict = SeqIO.to_dict(SeqIO.parse(r, "fastq"))
-        
-    #create our sought-after SeqRecord list with matching seq_id
-    record_list = [raw_dict[key] for key in source_dict]
+    # only the seq_ids of the source reads, and the raw reads with one of them, are kept in memory
+    source_ids = list(dict.fromkeys(record.id for record in read_records(source_read)))
+    wanted = set(source_ids)
+    raw_dict = {}
+    for record in read_records(raw_read):
+        if record.id in wanted and record.id not in raw_dict:
+            raw_dict[record.id] = record
+
+    #create our sought-after record list with matching seq_id
+    record_list = [raw_dict[key] for key in source_ids]
     if compress:
         with gzip.open(output_file, 'wt') as w:
-            SeqIO.write(record_list, w, "fastq")
+            w.writelines(f"@{record.header}\n{record.seq}\n+\n{record.qual}\n" for record in record_list)
 
 if __name__ == "__main__":
     
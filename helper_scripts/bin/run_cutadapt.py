@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import sys, os, shutil, subprocess, argparse
+import re, gzip, itertools
 from datetime import datetime
 import concurrent.futures
 import utilities
@@ -55,6 +56,8 @@ def parse_argument():
     parser.add_argument('-o', '--out_dir', metavar = '', required = True, help = 'Specify output folder')
     parser.add_argument('-s', '--sample', metavar = '', required = True, help = 'Specify sample name')
     parser.add_argument('-p', '--oligo_file', metavar = '', required = True, help = 'Specify oligo file')
+    parser.add_argument('-d', '--demux', action = 'store_true', help = 'Demultiplex all primers in a single pass '
+                        'over the reads, instead of running cutadapt once per primer')
     
     return parser.parse_args()
 
@@ -113,6 +116,185 @@ def remove_primer(sample,R1_gz,R2_gz,out_dir,num_process, oligo_file):
 
 
 
+IUPAC_BASES = {'A':'A', 'C':'C', 'G':'G', 'T':'T', 'U':'T', 'R':'AG', 'Y':'CT', 'S':'CG', 'W':'AT',
+			   'K':'GT', 'M':'AC', 'B':'CGT', 'D':'AGT', 'H':'ACT', 'V':'ACG', 'N':'ACGTN'}
+# length of the primer prefix used as the key of the primer index
+INDEX_PREFIX_LEN = 8
+# max number of concrete sequences an (ambiguous) primer prefix is expanded into
+MAX_PREFIX_EXPANSION = 4096
+# total size (in characters) of the buffered records of all the output files before they are written out
+WRITE_BUFFER_SIZE = 64 * 1024 * 1024
+
+
+def iupac_regex(primer):
+	'''
+	compile a primer (with IUPAC codes) into a regex with one character class per ambiguous base
+	'''
+	return re.compile(''.join(f'[{IUPAC_BASES[b]}]' if len(IUPAC_BASES.get(b, b)) > 1 else IUPAC_BASES.get(b, b)
+							  for b in primer.upper()))
+
+
+class PrimerIndex:
+	'''
+	Index over the 5' (anchored) primers of all primer pairs in the oligo file.
+	The first INDEX_PREFIX_LEN bases of every primer, with IUPAC codes expanded, map to the primer pairs
+	starting with them, so finding the primer a read starts with is one dictionary lookup plus
+	the verification of a handful of candidates, instead of trying all 2461 primers.
+	'''
+
+	def __init__(self, primers):
+		'''
+		primers: dictionary of key:primer (the primer the reads should start with)
+		'''
+		self.k = min(INDEX_PREFIX_LEN, min(len(p) for p in primers.values()))
+		self.patterns = {key: iupac_regex(primer) for key, primer in primers.items()}
+		self.index = {}
+		self.unindexed = [] # primers too ambiguous in their first k bases, checked for every read
+		for key, primer in primers.items():
+			choices = [IUPAC_BASES.get(b, b) for b in primer.upper()[:self.k]]
+			n_expansion = 1
+			for c in choices:
+				n_expansion *= len(c)
+			if n_expansion > MAX_PREFIX_EXPANSION:
+				self.unindexed.append(key)
+				continue
+			for prefix in itertools.product(*choices):
+				self.index.setdefault(''.join(prefix), []).append(key)
+
+	def match(self, seq):
+		'''
+		returns a dictionary of key:primer length for all primers the sequence starts with (no mismatches)
+		'''
+		found = {}
+		for key in itertools.chain(self.index.get(seq[:self.k], ()), self.unindexed):
+			m = self.patterns[key].match(seq)
+			if m:
+				found[key] = m.end()
+		return found
+
+
+def prefix_patterns(adapter):
+	'''
+	compile the 3' adapter along with all of its prefixes (for partial matches at the end of the read)
+	'''
+	return (iupac_regex(adapter), {i: iupac_regex(adapter[:i]) for i in range(1, len(adapter))})
+
+
+def trim_3prime(seq, adapter, min_overlap=3):
+	'''
+	returns the position where the 3' adapter (compiled by prefix_patterns) starts in seq, cutadapt style:
+	the leftmost full match, otherwise the longest partial match (at least min_overlap bases) at the 3' end
+	'''
+	pattern, prefixes = adapter
+	m = pattern.search(seq)
+	if m:
+		return m.start()
+	for overlap in range(min(len(prefixes), len(seq)), min_overlap - 1, -1):
+		if prefixes[overlap].fullmatch(seq, len(seq) - overlap):
+			return len(seq) - overlap
+	return len(seq)
+
+
+class BufferedWriter:
+	'''
+	Keeps one buffer of fastq records per output file, and appends all the buffers to their files once their
+	total size reaches max_size, so thousands of output files can be written without keeping thousands of
+	files open, and the memory used doesn't grow with the number of output files.
+	'''
+
+	def __init__(self, max_size=WRITE_BUFFER_SIZE):
+		self.max_size = max_size
+		self.size = 0
+		self.buffers = {}
+
+	def write(self, file_name, record):
+		self.buffers.setdefault(file_name, []).append(record)
+		self.size += len(record)
+		if self.size >= self.max_size:
+			self.close()
+
+	def flush(self, file_name):
+		buffer = self.buffers.pop(file_name, [])
+		if buffer:
+			with open(file_name, 'a') as f:
+				f.write(''.join(buffer))
+			self.size -= sum(len(record) for record in buffer)
+
+	def close(self):
+		for file_name in list(self.buffers):
+			self.flush(file_name)
+
+
+def read_fastq(fastq_gz):
+	'''
+	yields (header, seq, qual) of each record in a gzipped fastq file, decompressed only once
+	'''
+	with gzip.open(fastq_gz, 'rt') as f:
+		for header in f:
+			seq = next(f).rstrip('\n')
+			next(f)
+			qual = next(f).rstrip('\n')
+			yield header.rstrip('\n')[1:], seq, qual
+
+
+def demultiplex(sample, R1_gz, R2_gz, out_dir, oligo_file):
+	"""
+	Single pass alternative to remove_primer(): reads every read pair once, finds the primer pair(s) whose
+	forward primer anchors R1 and whose reverse primer anchors R2 (no mismatches, as with cutadapt -e 0),
+	trims those primers plus the reverse-complemented primer of the other end (full match, or
+	partial match at the 3' end) and writes {sample}.{key}.1/2.fastq like the per-primer cutadapt commands do.
+	A pair is discarded if either trimmed read is empty (cutadapt -m 1).
+
+	Params
+	------
+	sample: String
+		sample name, added to the read headers
+	R1_gz, R2_gz: String
+		R1 and R2 reads (fastq.gz)
+	out_dir: String
+		output folder
+	oligo_file: String
+		oligo file with the primer information
+
+	"""
+
+	primers = utilities.Primers(oligo_file)
+	fprimers, rprimers, adapters = {}, {}, {}
+	for key in primers.pseqs:
+		fprimer = primers.pseqs[key][0]
+		rc_rprimer = primers.pseqs[key][1]
+		fprimers[key] = fprimer
+		rprimers[key] = utilities.revcomp(rc_rprimer)
+		adapters[key] = (prefix_patterns(rc_rprimer), prefix_patterns(utilities.revcomp(fprimer)))
+	f_index = PrimerIndex(fprimers)
+	r_index = PrimerIndex(rprimers)
+
+	# cutadapt writes an output file for every primer, even if it's empty
+	for key in primers.pseqs:
+		for read in ('1', '2'):
+			open(f'{out_dir}/{sample}.{key}.{read}.fastq', 'w').close()
+
+	writer = BufferedWriter()
+	for (id1, seq1, qual1), (id2, seq2, qual2) in zip(read_fastq(R1_gz), read_fastq(R2_gz)):
+		f_found = f_index.match(seq1)
+		if not f_found:
+			continue
+		r_found = r_index.match(seq2)
+		for key in f_found.keys() & r_found.keys():
+			start1, start2 = f_found[key], r_found[key]
+			end1 = start1 + trim_3prime(seq1[start1:], adapters[key][0])
+			end2 = start2 + trim_3prime(seq2[start2:], adapters[key][1])
+			if end1 <= start1 or end2 <= start2:
+				continue
+			for read, read_id, seq, qual, start, end in (('1', id1, seq1, qual1, start1, end1),
+														 ('2', id2, seq2, qual2, start2, end2)):
+				name, _, comment = read_id.partition(' ')
+				header = f'{name}  adapter={key}={sample} {comment}'.rstrip()
+				writer.write(f'{out_dir}/{sample}.{key}.{read}.fastq',
+							 f'@{header}\n{seq[start:end]}\n+\n{qual[start:end]}\n')
+	writer.close()
+
+
 def main(args):
     
     R1_gz = args.read1
@@ -120,7 +302,10 @@ def main(args):
     out_dir = args.out_dir
     sample = args.sample
     
-    remove_primer(sample,R1_gz,R2_gz,out_dir,20, args.oligo_file)
+    if args.demux:
+        demultiplex(sample,R1_gz,R2_gz,out_dir, args.oligo_file)
+    else:
+        remove_primer(sample,R1_gz,R2_gz,out_dir,20, args.oligo_file)
             
             
 if __name__ == "__main__":
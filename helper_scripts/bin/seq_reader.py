@@ -0,0 +1 @@
+../seq_reader.py
\ No newline at end of file
@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 
 import argparse, os, csv
-import random, linecache, re
+import random, re
 import pandas as pd
 from tabulate import tabulate
 from Bio.Seq import Seq
 from numpy.core.defchararray import find
+from seq_reader import OffsetIndex
 
 def file_len(filename):
     """
@@ -71,27 +72,20 @@ def main():
 
     args = parser.parse_args()
 
-    # Generate a random sample of integers.
-    # Range of the random sample equals the number of reads in the pcr.seqs output fasta file
-    random_sample = random.sample(range(round(file_len(args.after)/2)), int(args.size))
+    # Take a random sample of the reads in the pcr.seqs output fasta file.
+    # The reads are looked up through the offset index of the fasta file (see seq_reader.py),
+    # so only the sampled records are read.
+    after = OffsetIndex(args.after)
+    random_sample = random.sample(list(after), int(args.size))
 
     # We need to get the reads based on our random sample.
     # Then we need to get the sequence info for these IDs (sequence after pcr.seqs and before it)
     # Then we need to merge this info with the primer sequence info, and print this table
 
     d = {} # Dictionary to hold random sample of read IDs and their sequences
-    for i in random_sample:
-        line = linecache.getline(args.after, i) # Get the line corresponding to the random integer
-        # If line is a READ ID, make that the key. If not, make the next line the key.
-        if line.startswith('>'):
-            key = line.rstrip().split()[0][1:]
-            key = key.split('|')[0]
-            seq = linecache.getline(args.after, i+1)
-        else:
-            key = linecache.getline(args.after, i+1).split()[0][1:]
-            key = key.split('|')[0]
-            seq = linecache.getline(args.after, i+2)
-        d[key] = seq.strip() # Key =  read ID, value = sequence after pcr.seqs cmd was run
+    for seq_id in random_sample:
+        key = seq_id.split('|')[0]
+        d[key] = after[seq_id].seq # Key =  read ID, value = sequence after pcr.seqs cmd was run
         
     # For the read IDs in dict, get the sequence before pcr.seqs command was run
     with open(args.before, 'r') as f:
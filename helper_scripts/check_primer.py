@@ -1,6 +1,7 @@
-import re
 import argparse
 from Bio.Seq import Seq
+from primer_match import get_matcher
+from seq_reader import read_records
 
 def check_primer_fasta():
     '''
@@ -29,15 +30,9 @@ def check_primer_fasta():
                 dict_primer[primer_id] = (fp,rp)
 
     dict_seq = {}
-    line_counter = 0
-    with open(fasta_file) as f:
-        for line in f.readlines():
-            if line_counter % 2 == 0:
-                # seq_id = line.split()[0].replace(':', '_')[1:]  # to get the part of seq_id we need
-                seq_id = line.split()[0][1:]
-            else:
-                dict_seq[seq_id] = line
-            line_counter += 1
+    for record in read_records(fasta_file):
+        # seq_id = record.id.replace(':', '_')  # to get the part of seq_id we need
+        dict_seq[record.id] = record.seq
 
     dict_group = {}
     with open(group_file) as g:
@@ -92,44 +87,18 @@ def check_primer_fasta():
     with open (out_put, 'w') as f:
         f.write(''.join(result))
 
-def match_primer(primer,seq):
+def match_primer(primer, seq, max_errors=3):
     '''
-    this method checks the primer against the seq, trying to find any matches
-    use regex fuzzy match {e<=2} allowing 2 mis-match
+    this method checks the (degenerate) primer against the seq, trying to find any matches
+    allowing max_errors errors (mismatch, insertion or deletion), see primer_match.PrimerMatcher
 
     param: primer (str)
     param: seq (str)
+    param: max_errors (int)
 
-    return: the first found matches or None if not found
+    return: the first found match (primer_match.PrimerMatch) or None if not found
     '''
-    primer_list = IUPAC_translation(primer)
-    for p in primer_list:
-        found = re.search(f"({p}){{e<=3}}", seq)
-        if found:
-            return found
-
-
-def IUPAC_translation(seq):
-    '''
-    this method translate the passed-in seq into a list of all possible IUPAC coded seq
-    param: seq (str)
-    return: the result list
-    '''
-    IUPAC_dict = {'Y':'CT','R':'AG','W':'AT','S':'CG','K':'TG','M':'AC',
-                  'D':'AGT','V':'ACG','H':'ACT','B':'CGT'}
-    result_list = [seq]
-    for key in IUPAC_dict:
-        temp_list = []
-        to_remove_list = []
-        for s in result_list:
-            if key in s:
-                to_remove_list.append(s)
-                for char in IUPAC_dict[key]:
-                    temp_list.append(s.replace(key,char))
-        result_list.extend(temp_list)
-        result_list = list(set(result_list) - set(to_remove_list))
-
-    return result_list
+    return get_matcher(primer, max_errors).search(seq)
 
 
 if __name__ == "__main__":
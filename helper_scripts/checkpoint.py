@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+import os, json, hashlib
+from datetime import datetime
+from configparser import ConfigParser
+
+MANIFEST_FILE = 'stage_manifest.json'
+HASH_CHUNK = 1024 * 1024
+
+# the sha256 of the files described in this process, by (path, size, mtime): a file which is the output of
+# a stage and the input of later ones (or the input of many stages) is only hashed once
+digests = {}
+
+
+def file_digest(path):
+    """
+    This utility function returns the sha256 digest of a file, read in 1MB chunks
+    so that multi-GB fasta/count files never sit in memory
+
+    Parameters
+    ----------
+    path: String name of the file
+
+    Returns
+    -------
+    the hex digest string
+
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def describe_param(param):
+    """
+    json friendly form of a stage parameter, a config object is recorded section by section
+    (its str() would differ from run to run)
+    """
+    if isinstance(param, ConfigParser):
+        return {section: dict(param[section]) for section in param.sections()}
+    return str(param)
+
+
+def describe_file(path):
+    """
+    build the manifest record (size, mtime, sha256) for a file, or None if it doesn't exist
+    """
+    path = os.path.expanduser(path)
+    if not os.path.isfile(path):
+        return None
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime)
+    if key not in digests:
+        digests[key] = file_digest(path)
+    return {'size': st.st_size, 'mtime': st.st_mtime, 'sha256': digests[key]}
+
+
+def batch_files(batch_file, input_dir=None):
+    """
+    the files listed in a mothur batch file (i.e. the R1/R2 fastq files of make.contigs(file=)), a relative name
+    is looked for in the mothur input folder, then in the folder of the batch file
+    """
+    batch_file = os.path.expanduser(batch_file)
+    folders = [os.path.expanduser(input_dir) if input_dir else '', os.path.dirname(batch_file)]
+    with open(batch_file) as f:
+        for line in f:
+            for name in line.split():
+                for folder in folders:
+                    path = os.path.join(folder, os.path.expanduser(name))
+                    if os.path.isfile(path):
+                        yield path
+                        break
+
+
+def input_files(params, input_dir=None):
+    """
+    the input files of a stage: the parameter values (and the values of a config object) which are existing files,
+    and the files listed in the batch file of a mothur 'file' parameter
+
+    Parameters
+    ----------
+    params: dictionary of the stage parameters (name: value)
+    input_dir: the mothur input folder, for the relative names of a batch file
+
+    Returns
+    -------
+    the list of the file names (without duplicates)
+    """
+    files = []
+    for name, param in params.items():
+        if isinstance(param, ConfigParser):
+            values = [value for section in param.sections() for _, value in param.items(section, raw=True)]
+        else:
+            values = [param]
+        for value in values:
+            if isinstance(value, str) and os.path.isfile(os.path.expanduser(value)):
+                files.append(value)
+                if name == 'file':
+                    files.extend(batch_files(value, input_dir))
+    return list(dict.fromkeys(files))
+
+
+def file_unchanged(path, record):
+    """
+    check a file on disk against its manifest record.
+    size and mtime are checked first, the (slow) content hash is only recomputed if mtime moved
+    """
+    path = os.path.expanduser(path)
+    if record is None or not os.path.isfile(path):
+        return False
+    st = os.stat(path)
+    if st.st_size != record['size']:
+        return False
+    if st.st_mtime == record['mtime']:
+        return True
+    return file_digest(path) == record['sha256']
+
+
+class StageManifest:
+    '''
+    Records every step of the mothur command chain in output_dir/stage_manifest.json, so that a failed
+    or killed run can be resumed from the first step that did not complete.
+
+    Each step is stored (in order) with its name, its parameters, its input files and the output files it produced
+    (with size/mtime/sha256), the mothur current files/dirs after it ran, and for python-side steps
+    the value it returned.  With resume=True the longest valid prefix of the recorded steps is skipped
+    (same parameters, and unchanged inputs and outputs), and mothur's current-file state is restored before
+    the first step that has to run again.
+    '''
+
+    def __init__(self, output_dir, resume=False):
+        self.mothur = None
+        self.path = os.path.join(os.path.expanduser(output_dir), MANIFEST_FILE)
+        self.previous = []
+        # a resumed run keeps appending to the MOTHUR log file of the run it resumes
+        self.logfile = None
+        if resume and os.path.isfile(self.path):
+            with open(self.path) as f:
+                manifest = json.load(f)
+            self.previous = manifest.get('stages', [])
+            self.logfile = manifest.get('logfile')
+        self.stages = []
+        self.resuming = bool(self.previous)
+        self.skipped = 0
+
+    def bind(self, mothur):
+        '''
+        attach the mothur-py object whose commands (and current files) are tracked
+        '''
+        self.mothur = mothur
+        self.logfile = mothur.logfile_name
+
+    def _matches(self, stage, params):
+        '''
+        return the recorded stage at the current position if it matches (stage, params)
+        and all of its inputs and outputs are still intact on disk, otherwise None
+        '''
+        if not self.resuming or len(self.stages) >= len(self.previous):
+            return None
+        record = self.previous[len(self.stages)]
+        if record['name'] != stage or record['params'] != params:
+            return None
+        if not all(file_unchanged(out, desc) for out, desc in record['outputs'].items()):
+            return None
+        # i.e. the batch file, the oligo file or the raw reads were edited since the recorded run
+        if not all(file_unchanged(path, desc) for path, desc in record.get('inputs', {}).items()):
+            return None
+        return record
+
+    def _skip(self, record):
+        self.stages.append(record)
+        self.skipped += 1
+        print(f"{datetime.now()}   resume: skipping completed stage {record['name']}")
+
+    def _stop_resuming(self):
+        '''
+        first step that has to run again: every later stage runs as well, and
+        mothur gets back the current files/dirs of the last completed stage
+        '''
+        if self.resuming and self.stages:
+            self.mothur.current_files = dict(self.stages[-1]['current_files'])
+            self.mothur.current_dirs = dict(self.stages[-1]['current_dirs'])
+            print(f"{datetime.now()}   resume: restored mothur current files {self.mothur.current_files}")
+            # have mothur write the restored current files into the (new) MOTHUR log file,
+            # the python-side steps look them up there with group.get_current_file()
+            self.mothur.get.current()
+        self.resuming = False
+
+    def _write(self):
+        # write to a temp file first so a killed job never leaves a truncated manifest
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'logfile': self.logfile, 'stages': self.stages}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def _inputs(self, params):
+        '''
+        the manifest records of the input files of a stage (see input_files), taken before it runs
+        '''
+        input_dir = self.mothur.current_dirs.get('input') if self.mothur is not None else None
+        return {path: describe_file(path) for path in input_files(params, input_dir)}
+
+    def _record(self, stage, params, inputs, outputs, value=None):
+        self.stages.append({'name': stage,
+                            'params': params,
+                            'inputs': inputs,
+                            'outputs': {out: describe_file(out) for out in outputs},
+                            'current_files': dict(self.mothur.current_files),
+                            'current_dirs': dict(self.mothur.current_dirs),
+                            'value': value,
+                            'finished': datetime.now().strftime("%Y%m%d%H%M%S")})
+        self._write()
+
+    def run(self, stage, command, **kwargs):
+        """
+        run a mothur-py command unless it already completed in the run being resumed
+
+        Parameters
+        ----------
+        stage: String name of the stage (e.g. 'make.contigs')
+        command: the mothur-py command object (e.g. m.make.contigs)
+        kwargs: the parameters passed to the command
+
+        Returns
+        -------
+        None
+
+        """
+        params = {k: describe_param(v) for k, v in kwargs.items()}
+        record = self._matches(stage, params)
+        if record:
+            return self._skip(record)
+        self._stop_resuming()
+
+        inputs = self._inputs(kwargs)
+        before = dict(self.mothur.current_files)
+        command(**kwargs)
+        # files which mothur made 'current' during this stage are its outputs
+        outputs = [v for k, v in self.mothur.current_files.items() if before.get(k) != v]
+        self._record(stage, params, inputs, outputs)
+
+    def value(self, stage, func, *args):
+        """
+        run a python-side step of the pipeline (i.e. parsing the MOTHUR log file, creating new group files)
+        unless it already completed, and return its (json serializable) value.
+        If the value is the name of an existing file, that file is treated as the output of the stage
+
+        Parameters
+        ----------
+        stage: String name of the stage
+        func: the function to call
+        args: the parameters passed to the function
+
+        Returns
+        -------
+        the value returned by func, or the recorded value if the stage is skipped
+
+        """
+        params = {'args': [describe_param(arg) for arg in args]}
+        record = self._matches(stage, params)
+        if record:
+            self._skip(record)
+            return record['value']
+        self._stop_resuming()
+
+        inputs = self._inputs({str(i): arg for i, arg in enumerate(args)})
+        result = func(*args)
+        outputs = [result] if isinstance(result, str) and os.path.isfile(os.path.expanduser(result)) else []
+        self._record(stage, params, inputs, outputs, result)
+        return result
+
+
+if __name__ == "__main__":
+    print("This module is called by pipeline.py.  Please run pipeline.py --help for more information")
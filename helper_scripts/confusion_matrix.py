@@ -10,6 +10,7 @@ from operator import truediv
 # pd.set_option('display.max_columns', None)
 # pd.set_option('display.max_rows', None)
 import count_parser as cp
+from count_matrix import CountMatrix
 import sys
 import utilities
 import settings
@@ -63,7 +64,7 @@ def get_oligo_primer_dict():
     return oligo_primers.pseqs
 
 
-def get_abundance(sample_list, df):
+def get_abundance(sample_list, count_matrix):
     '''
     this method reads the original count table from mothur, reformats it and outputs a dataframe of abundance values
     with sample name as index and primer pairs as columns
@@ -75,18 +76,13 @@ def get_abundance(sample_list, df):
 
     Parameters
     ----------
-    count_file: the original count table file from Mothur
     sample_list: a csv file of the list of samples used
-    ori_count_df: dataframe for the count_file
+    count_matrix: the original count table from Mothur, as a (sparse) CountMatrix
 
     Returns the abundance table as a dataframe
 
     '''
-    df.columns = df.columns.str.strip() # remove potential spaces
-    primer_list = [i for i in df.columns if i.split('.')[0] in sample_list]
-    df = df[primer_list]
-
-    sample_pp_df = df.sum() #total abundanceall high quality seqs
+    sample_pp_df = count_matrix.select_samples(sample_list).column_sums() #total abundanceall high quality seqs
     primer_list = list(set([i.split('.')[1] for i in sample_pp_df.index]))
     primer_list.sort(key=str.lower)
     sample_pp_df = cp.split_samle_primer(sample_pp_df, primer_list, sample_list)
@@ -98,7 +94,7 @@ def get_abundance(sample_list, df):
 
 
 
-def make_blast_dict(df):
+def make_blast_dict(df, ref):
     '''
     this method process the blast result dataframe, filter by pre-set threshold and generate a sample/primer dictionary
     with sample name as the key and all primers in that sample as the value
@@ -106,6 +102,7 @@ def make_blast_dict(df):
     Parameters
     ----------
     df: dataframe for the blast result
+    ref: the utilities.ReferenceContext, for the primer universe
 
     Returns a dictionary
 
@@ -119,7 +116,7 @@ def make_blast_dict(df):
     # filter out primers that's not in the original 2461 primer_list, off blast result
     for key in blast_dict:
         primers = set(blast_dict[key].split(','))
-        diff = primers - get_oligo_primer()
+        diff = primers - ref.primers
         primers = primers - diff
         blast_dict[key] = ','.join(primers)
     
@@ -144,7 +141,7 @@ def get_count_seq(df, sample_primer):
     return df[FILTER]['Representative_Sequence']
 
 
-def make_count_blast_dict(count_df, df):
+def make_count_blast_dict(count_df, df, ref):
     '''
     this method processes the blast result dataframe, filters by pre-set threshold and uses the remaining
     sequences to filter the count dataframe. Lastly it uses the sample/primer columns in count dataframe to 
@@ -154,6 +151,7 @@ def make_count_blast_dict(count_df, df):
     ----------
     df: dataframe for the blast result
     count_df: dataframe for the original count table
+    ref: the utilities.ReferenceContext, for the primer universe
 
     Returns a dictionary
 
@@ -175,13 +173,13 @@ def make_count_blast_dict(count_df, df):
     # filter out primers that's not in the original 2461 primer_list, off blast result
     for key in count_blast_dict:
         primers = set(count_blast_dict[key].split(','))
-        primers = primers & get_oligo_primer()
+        primers = primers & ref.primers
         count_blast_dict[key] = ','.join(primers)
     
     return count_blast_dict
 
 
-def make_blast_merge_dict(count_df, df):
+def make_blast_merge_dict(count_df, df, ref):
     '''
     this method merge the count dataframe with the blast dataframe on the same 'seq' and 'sample_primer' and filter
     the result by pre-set threshold value. Then it generates a sample/primer dictionary with sample name as the key 
@@ -191,6 +189,7 @@ def make_blast_merge_dict(count_df, df):
     ----------
     df: dataframe for the blast result
     count_df: dataframe for the original count table
+    ref: the utilities.ReferenceContext, for the primer universe
 
     Returns a dictionary
 
@@ -207,7 +206,7 @@ def make_blast_merge_dict(count_df, df):
     # filter out primers that's not in the original 2461 primer_list, off blast result
     for key in blast_dict:
         primers = set(blast_dict[key].split(','))
-        primers = primers & get_oligo_primer()
+        primers = primers & ref.primers
         blast_dict[key] = ','.join(primers)
     
     return blast_dict
@@ -217,26 +216,21 @@ def make_melt_count_df(df, sample_list):
     '''
     this method melts the original count table dataframe
     with sample name as the key and all primers in that sample as the value
+    The non-zero cells come straight from the sparse CountMatrix, so the (mostly 0) melted
+    dataframe of the whole table is never built
 
     Parameters
     ----------
-    df: dataframe for the original count table
+    df: the original count table, as a CountMatrix (or a dataframe)
     sample_list: a csv file of the list of samples used
 
     Returns the melted dataframe
 
     '''
+    if not isinstance(df, CountMatrix):
+        df = CountMatrix.from_dataframe(df)
     #filter columns to contain only sample names in sample_list
-    df.columns = df.columns.str.strip() # remove potential spaces
-    seq_df = df.iloc[:,0] # keep the 1st column (sequence)
-    primer_list = [i for i in df.columns if i.split('.')[0] in sample_list]
-    df = df[primer_list]
-    df['seq'] = seq_df
-
-    df = df.melt(id_vars=['seq'], var_name='sample_primer', value_name='count')
-    df = df[df['count'] > 0]
-
-    return df
+    return df.select_samples(sample_list).to_long_df()
   
 
 def get_set_intersection(set_list):
@@ -289,66 +283,58 @@ def parse_argument():
     return parser.parse_args()
 
 
-def build_confusion_matrix(count_dict, blast_nomerge_dict, tp_dict):
+def build_confusion_matrix(count_dict, blast_nomerge_dict, tp_dict, ref):
     '''
-    this method flattens a list of sets into one single list and generate the occurrence count for each item
-    as a dictionary
+    this method computes the TP/FP/FN/TN primers of all the samples at once: the observed, predicted and
+    true positive primers of each sample are rows of boolean (sample x primer) matrices (see
+    utilities.ReferenceContext.encode), and the confusion sets are a few element-wise operations on them
 
     Parameters
     ----------
     count_dict: a dictionary of observed primers (key: sample_name, value: a comma delimited string of primers)
     blast_nomerge_dict: a dictionary of our predicted primers 
     tp_dict: a dictionary of true positive primers
+    ref: the utilities.ReferenceContext, for the primer universe
 
     Returns
     ----------
-    df_dict: a dictionary of TP/FP/TN/FN metrics (key: sample_name, value: a list of number of TP/FP/TN/FN counts )
-    FP_list: a list of all FPs
-    FN_list: a list of all FNs
-    TN_list: a list of all TNs
+    df: a dataframe of the TP/FP/FN/TN counts and the derived metrics (index: sample_name)
+    FP, FN, TN: the (sample x primer) boolean dataframes of the FPs, FNs and TNs
 
     '''
     # a dictionary of fasta sequence, with seq_ID being the key and actual sequence being the value
     # fasta_dict = utilities.create_fasta_dict(args.fasta)
 
-    df_dict = {} #to hold the number of tp/tn/fp/fn for each sample
-    FP_list, FN_list, TN_list = ([] for i in range(3))
-
-    for key in dict(sorted(blast_nomerge_dict.items())):
-        if key not in settings.CONTROL_LIST:
-            logger.info(f"sample is: {key}")
-            blast_nomerge_primers = set(blast_nomerge_dict[key].split(','))     
-            count_primers = set(count_dict[key].split(','))
-            tp_primers = set(tp_dict[key].split(','))
-            total_primers = get_oligo_primer() # use all 2461 primers
- 
-            # TP: Predicted amplicons that are observed in the high-quality data
-            TP = tp_primers
-            logger.info (f" checking TP vs blast_nomerge_primers: {len(TP)} -- {len(TP & blast_nomerge_primers)}")
-            logger.info (f" checking TP vs count_primers: {len(TP)} -- {len(TP & count_primers)}")
-            # TN: Primer pairs that do not produce data and are not predicted to
-            TN = (total_primers - blast_nomerge_primers) & (total_primers - count_primers)
-            # FP: High-quality amplicons that are observed but not predicted for the isolate
-            FP = (total_primers - TP) & count_primers 
-            logger.info (f"checking FP size: {len(FP)} ------- {len(count_primers - TP)}")
-            # FN: Predicted amplicons that are not observed in the high-quality data
-            FN = (total_primers - count_primers) & blast_nomerge_primers
-
-            logger.info (f"sanity check: {len(total_primers)}, {len(total_primers) == (len(TP)+len(FP)+len(FN)+len(TN))}")
-            logger.info (f"more sanity check: TP & FP {len(TP & FP)}")
-            logger.info (f"more sanity check: TP & FN {len(TP & FN)}")
-            logger.info (f"more sanity check: TP & TN {len(TP & TN)}")
-            logger.info (f"more sanity check: FN & FP {len(FN & FP)}")
-            logger.info (f"more sanity check: TN & FP {len(TN & FP)}")
-            logger.info (f"more sanity check: FN & TN {len(TN & FN)}")
-
-            df_dict[key] = [len(TP),len(FP),len(FN),len(TN)]
-
-            FP_list.append(FP)
-            FN_list.append(FN)
-            TN_list.append(TN)
-
-    return df_dict, FP_list, FN_list, TN_list
+    samples = [key for key in sorted(blast_nomerge_dict) if key not in settings.CONTROL_LIST]
+    columns, (blast_nomerge_primers, count_primers, TP) = ref.encode(
+        samples, *({key: primer_dict[key].split(',') for key in samples}
+                   for primer_dict in (blast_nomerge_dict, count_dict, tp_dict)))
+    total_primers = ref.universe(columns) # use all 2461 primers
+
+    # TP: Predicted amplicons that are observed in the high-quality data (tp_dict)
+    # TN: Primer pairs that do not produce data and are not predicted to
+    TN = total_primers & ~blast_nomerge_primers & ~count_primers
+    # FP: High-quality amplicons that are observed but not predicted for the isolate
+    FP = total_primers & ~TP & count_primers
+    # FN: Predicted amplicons that are not observed in the high-quality data
+    FN = total_primers & ~count_primers & blast_nomerge_primers
+
+    df = utilities.confusion_metrics(samples, TP, FP, FN, TN)
+    logger.info (f"sanity check: {total_primers.sum()}, "
+                 f"{(df[['TP','FP','FN','TN']].sum(axis=1) == total_primers.sum()).all()}")
+
+    if logger.isEnabledFor(logging.DEBUG):
+        for i, key in enumerate(samples):
+            logger.debug(f"sample is: {key}")
+            logger.debug (f" checking TP vs blast_nomerge_primers: {TP[i].sum()} -- {(TP[i] & blast_nomerge_primers[i]).sum()}")
+            logger.debug (f" checking TP vs count_primers: {TP[i].sum()} -- {(TP[i] & count_primers[i]).sum()}")
+            logger.debug (f"checking FP size: {FP[i].sum()} ------- {(count_primers[i] & ~TP[i]).sum()}")
+            for name, other in (('TP & FP', TP & FP), ('TP & FN', TP & FN), ('TP & TN', TP & TN),
+                                ('FN & FP', FN & FP), ('TN & FP', TN & FP), ('FN & TN', TN & FN)):
+                logger.debug (f"more sanity check: {name} {other[i].sum()}")
+
+    FP, FN, TN = (pd.DataFrame(matrix, index=samples, columns=columns) for matrix in (FP, FN, TN))
+    return df, FP, FN, TN
 
 
 def main():
@@ -359,43 +345,36 @@ def main():
     sample_list = pd.read_csv(args.sample_file, names = ['sample'])['sample'].tolist()
     sample_list.sort(key=str.lower)
     
-    ori_count_df = cp.read_count_table(args.count_file)
-    melt_count_df = make_melt_count_df(ori_count_df, sample_list)
+    count_matrix = CountMatrix.from_count_table(args.count_file, sample_list)
+    melt_count_df = make_melt_count_df(count_matrix, sample_list)
     blast_df = cp.create_blast_df(args.blast, args.fasta, args.reference, 100)
-    abundance_df = get_abundance(sample_list, ori_count_df)
+    abundance_df = get_abundance(sample_list, count_matrix)
+    # the primer universe, read once from the oligo file
+    ref = utilities.ReferenceContext(settings.OLIGO_FILE)
  
     # this is our prediction
-    blast_nomerge_dict = make_blast_dict(blast_df)
+    blast_nomerge_dict = make_blast_dict(blast_df, ref)
     # this is our observation
-    count_dict = make_count_blast_dict(melt_count_df, blast_df)
+    count_dict = make_count_blast_dict(melt_count_df, blast_df, ref)
     # this is basically the true positives
-    tp_dict = make_blast_merge_dict(melt_count_df, blast_df)
+    tp_dict = make_blast_merge_dict(melt_count_df, blast_df, ref)
     #predicted primers for each sample
     # prediction_dict = run_grep.get_primer_prediction_dict_concurrent()
 
 
-    df_dict, FP_list, FN_list, TN_list = build_confusion_matrix(count_dict, blast_nomerge_dict, tp_dict)
+    df, FP, FN, TN = build_confusion_matrix(count_dict, blast_nomerge_dict, tp_dict, ref)
 
     
     # get_set_intersection(FP_list)
     # get_set_intersection(FN_list)
     # get_set_intersection(TN_list)
 
-    #list the primers in the order of most frequent appearance
-    logger.info (f"\n\nduplicate count in FP: "
-           f"{dict(sorted(get_setitem_occurrence(FP_list).items(), key=lambda x:x[1], reverse=True))}")
-    logger.info (f"\n\nduplicate count in FN: "
-           f"{dict(sorted(get_setitem_occurrence(FN_list).items(), key=lambda x:x[1], reverse=True))}")
-
-
-    df = pd.DataFrame.from_dict(df_dict, orient='index')
-    df.columns = ['TP','FP','FN','TN']
-    df['sensitivity (TP/P)'] = df['TP']/(df['TP'] + df['FN'])
-    df['sensitivity (TP/P)'] = df['sensitivity (TP/P)'].apply(lambda x:round(x,3))
-    df['specificity (TN/N)'] = (df['TN']/(df['TN'] + df['FP'])).apply(lambda x:round(x,3))
-    df['precision (TP/TP+FP)'] = (df['TP']/(df['TP'] + df['FP'])).apply(lambda x:round(x,3))
-    df['ACC'] = (df['TP'] + df['TN'])/(df['TP'] + df['TN'] + df['FP'] + df['FN'])
-    df['ACC'] = df['ACC'].apply(lambda x:round(x,3))
+    #list the primers in the order of most frequent appearance (number of samples they're in)
+    for name, matrix in (('FP', FP), ('FN', FN)):
+        occurrence = matrix.sum()
+        occurrence = occurrence[occurrence > 0].sort_values(ascending=False, kind='stable')
+        logger.info (f"\n\nduplicate count in {name}: {occurrence.to_dict()}")
+
 
     df.to_csv(args.output, sep='\t')
     
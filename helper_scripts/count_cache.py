@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+import os, json, shutil
+import numpy as np
+import pandas as pd
+try:
+    from checkpoint import describe_file, file_unchanged
+except ModuleNotFoundError: # imported as helper_scripts.count_cache (i.e. by parse_count_table_confusion_matrix.py)
+    from helper_scripts.checkpoint import describe_file, file_unchanged
+
+# max number of cells parsed per chunk of rows, when converting the count_table
+CHUNK_CELLS = 20000000
+INDEX_FILE = 'index.json'
+
+
+def cache_dir(count_file):
+    """
+    the cache of a count_table is the folder <count_table>.cache next to it
+    """
+    return f"{count_file}.cache"
+
+
+def scan_count_table(count_file):
+    '''
+    first pass over a full format count_table: its columns, number of rows and longest sequence name
+    '''
+    with open(count_file, 'r') as f:
+        columns = f.readline().rstrip('\n').split('\t')
+        rows, name_len = 0, 1
+        for line in f:
+            if line.strip():
+                rows += 1
+                name_len = max(name_len, line.find('\t'))
+    return columns, rows, name_len
+
+
+def build_cache(count_file):
+    """
+    This function converts a full format count_table into its columnar cache folder:
+    counts.npy, the abundance matrix (uint32) stored column by column (fortran order), so that a column
+    is one contiguous block which can be memory mapped on its own, names.npy, the sequence names,
+    and index.json with the column names and the size/mtime/sha256 of the count_table (for invalidation).
+    The count_table is parsed in chunks of rows, so it never sits in memory as a whole.
+
+    Parameters
+    ----------
+    count_file: String name of the full format count_table
+
+    Returns
+    -------
+    the cache index (dictionary)
+
+    """
+    columns, rows, name_len = scan_count_table(count_file)
+    cache = cache_dir(count_file)
+    shutil.rmtree(cache, ignore_errors=True)
+    os.makedirs(cache)
+
+    counts = np.lib.format.open_memmap(os.path.join(cache, 'counts.npy'), mode='w+', dtype=np.uint32,
+                                       shape=(rows, len(columns) - 1), fortran_order=True)
+    names = np.lib.format.open_memmap(os.path.join(cache, 'names.npy'), mode='w+', dtype=f'S{name_len}',
+                                      shape=(rows,))
+    start = 0
+    chunksize = max(1, CHUNK_CELLS // len(columns))
+    for chunk in pd.read_csv(count_file, sep='\t', chunksize=chunksize, dtype={columns[0]: str}):
+        end = start + len(chunk)
+        names[start:end] = chunk.iloc[:, 0].str.encode('utf-8').to_numpy()
+        values = chunk.iloc[:, 1:].to_numpy(dtype=np.int64)
+        if values.size and values.max() > np.iinfo(np.uint32).max:
+            raise ValueError(f"abundance larger than {np.iinfo(np.uint32).max} in {count_file}")
+        counts[start:end] = values
+        start = end
+    counts.flush()
+    names.flush()
+    del counts, names
+
+    index = {'source': describe_file(count_file), 'columns': columns, 'rows': rows}
+    # the index is written last (and atomically): a cache without it is incomplete
+    with open(os.path.join(cache, f'{INDEX_FILE}.tmp'), 'w') as f:
+        json.dump(index, f)
+    os.replace(os.path.join(cache, f'{INDEX_FILE}.tmp'), os.path.join(cache, INDEX_FILE))
+    return index
+
+
+def load_index(count_file):
+    """
+    This function returns the cache index of a count_table, (re)building the cache
+    if it is missing or if the count_table changed since the cache was built
+    """
+    index_file = os.path.join(cache_dir(count_file), INDEX_FILE)
+    if os.path.isfile(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+        if file_unchanged(count_file, index['source']):
+            return index
+        print(f"...{count_file} changed, rebuilding its cache")
+    else:
+        print(f"...building the cache of {count_file}")
+    return build_cache(count_file)
+
+
+def get_columns(count_file):
+    """
+    returns the column names of a count_table (the sequence name column first, then total and the groups)
+    """
+    return load_index(os.path.expanduser(count_file))['columns']
+
+
+def sample_columns(count_file, sample_list):
+    """
+    returns the sample.primer columns of a count_table whose sample is in sample_list
+    """
+    return [col for col in get_columns(count_file)[1:] if col.strip().split('.')[0] in sample_list]
+
+
+def open_cache(count_file):
+    """
+    This function memory maps the columnar cache of a full format count table (see build_cache)
+
+    Returns
+    -------
+    columns: the column names (the sequence name column first, then total and the groups)
+    names: the (memory mapped) sequence names, as bytes
+    counts: the (memory mapped) abundance matrix, without the sequence name column
+    """
+    count_file = os.path.expanduser(count_file)
+    index = load_index(count_file)
+    cache = cache_dir(count_file)
+    counts = np.load(os.path.join(cache, 'counts.npy'), mmap_mode='r')
+    names = np.load(os.path.join(cache, 'names.npy'), mmap_mode='r')
+    return index['columns'], names, counts
+
+
+def read_count_table(count_file, columns=None):
+    """
+    This function reads a full format count table through its columnar cache (see build_cache).
+    The abundance matrix is memory mapped, so only the requested columns are actually read from disk.
+
+    Parameters
+    ----------
+    count_file: String name of the full format count_table
+    columns: list of the column names (i.e. sample.primer groups) to load, default is all of them
+
+    Returns
+    -------
+    a dataframe with the sequence name column first, then the requested columns (the same as pd.read_csv would give)
+
+    """
+    all_columns, names, counts = open_cache(count_file)
+    position = {col: i for i, col in enumerate(all_columns[1:])}
+    if columns is None:
+        columns = all_columns[1:]
+
+    df = pd.DataFrame({all_columns[0]: names.astype(str)})
+    values = pd.DataFrame(counts[:, [position[col] for col in columns]].astype(np.int64), columns=columns)
+
+    return pd.concat([df, values], axis=1)
+
+if __name__ == "__main__":
+    print("This module is called by pipeline.py.  Please run pipeline.py --help for more information")
@@ -1,25 +1,10 @@
 import argparse, os
 import pandas as pd
 import numpy as np
-from pathlib import Path
+# full format count tables are read through their columnar cache
+from count_cache import read_count_table
 
 
-# helper method to read a full format count table, and/or save it as a pickle file for faster retrieval
-def read_count_table(count_file):
-
-    if Path(f"{count_file}.pkl").is_file():
-        print(f"...loading {count_file}.pkl")
-        df = pd.read_pickle(f"{count_file}.pkl")
-    else:
-        # read count_table
-        print("loading csv count file")
-        df = pd.read_csv(count_file, sep='\t')
-        print("done loading csv count file")
-        pd.to_pickle(df, f"{count_file}.pkl") 
-        print("done dumping pkl file")
-
-    return df
-
 
 # helper method to select only intended sample (sample-primer) groups from a count_table dataframe 
 def filter_count_table(df, sample_list):
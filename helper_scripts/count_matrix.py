@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+import numpy as np
+import pandas as pd
+try:
+    from count_cache import open_cache
+except ModuleNotFoundError: # imported as helper_scripts.count_matrix (i.e. by parse_count_table_confusion_matrix.py)
+    from helper_scripts.count_cache import open_cache
+
+
+def split_column(column):
+    """
+    a count table column (group) is named sample.primer
+    """
+    fields = column.strip().split('.')
+    return fields[0], fields[1] if len(fields) > 1 else ''
+
+
+def split_sample_primer(sr, primers, sample_list, raw_idx=None):
+    '''
+    this method will convert:
+
+    Sam1.PP1    2
+    Sam2.PP1    1
+    Sam1.PP2    1
+    Sam2.PP2    0
+
+    into:
+
+        PP1 PP2
+    Sam1    2   1
+    Sam2    1   0
+
+    The sample.primer index is split once into a (sample, primer) MultiIndex, which is then unstacked
+    and aligned on sample_list x primers (no lookup per cell).
+
+    Parameters
+    ----------
+    sr: the original dataframe Series (indexed by sample.primer)
+    primers: the list of intended column name ['PP1', 'PP2']
+    sample_list: the list of samples we're studying
+    raw_idx: index from the raw df, which is essentially the original columns from count_table.
+             A sample.primer missing from sr is 0 if it is in raw_idx, otherwise None (NaN).
+             Without raw_idx, every missing sample.primer is 0
+
+    Returns the converted dataframe
+
+    '''
+    def unstack(values, index):
+        parts = pd.Series(index, dtype=object).str.split('.', n=1, expand=True).reindex(columns=[0, 1])
+        table = pd.Series(values, index=pd.MultiIndex.from_arrays([parts[0], parts[1]]))
+        table = table[~table.index.duplicated()]
+        table = table.unstack().reindex(index=sample_list, columns=primers)
+        table.index.name, table.columns.name = None, None
+        return table
+
+    final_df = unstack(sr.to_numpy(), sr.index)
+    if raw_idx is None:
+        final_df = final_df.fillna(0)
+    else:
+        in_raw = unstack(np.ones(len(raw_idx), dtype=bool), raw_idx).notna()
+        final_df = final_df.mask(final_df.isna() & in_raw, 0)
+    if not final_df.isna().any().any(): # unstack gave floats for the missing cells
+        final_df = final_df.astype(sr.dtype)
+
+    return final_df
+
+
+class CountMatrix:
+    '''
+    Sparse (sequence x sample.primer) count matrix of a full format count table.
+
+    Only the non-zero cells are kept, in coordinate (COO) arrays sorted by column then sequence:
+    seq_idx (code of the sequence in seqs), col_idx (code of the column in columns) and counts.
+    Each column is further coded by its sample (col_sample, code in samples) and primer (col_primer,
+    code in primers), so the group-sums by sample or by primer are a single np.bincount.
+
+    The count table is overwhelmingly zeros (each unique sequence has reads in only a few of the
+    thousands of sample.primer columns), so this takes a small fraction of the memory of the dense dataframe.
+    '''
+
+    def __init__(self, seqs, columns, seq_idx, col_idx, counts):
+        self.seqs = np.asarray(seqs)
+        self.columns = [col.strip() for col in columns]
+        order = np.lexsort((seq_idx, col_idx))
+        self.seq_idx = np.asarray(seq_idx, dtype=np.int64)[order]
+        self.col_idx = np.asarray(col_idx, dtype=np.int64)[order]
+        self.counts = np.asarray(counts, dtype=np.int64)[order]
+
+        split = [split_column(col) for col in self.columns]
+        self.samples = sorted(set(sample for sample, _ in split), key=str.lower)
+        self.primers = sorted(set(primer for _, primer in split), key=str.lower)
+        sample_code = {sample: i for i, sample in enumerate(self.samples)}
+        primer_code = {primer: i for i, primer in enumerate(self.primers)}
+        self.col_sample = np.array([sample_code[sample] for sample, _ in split], dtype=np.int64)
+        self.col_primer = np.array([primer_code[primer] for _, primer in split], dtype=np.int64)
+
+    @classmethod
+    def from_count_table(cls, count_file, sample_list=None):
+        """
+        This method builds the sparse matrix of a full format count table, from its memory mapped
+        columnar cache (see count_cache.py), one column at a time.
+
+        Parameters
+        ----------
+        count_file: String name of the full format count_table
+        sample_list: only keep the sample.primer columns of these samples (default: all but 'total')
+
+        Returns
+        -------
+        a CountMatrix
+        """
+        all_columns, names, counts = open_cache(count_file)
+        positions = [i for i, col in enumerate(all_columns[1:])
+                     if col.strip() != 'total' and (sample_list is None or split_column(col)[0] in sample_list)]
+
+        seq_idx, col_idx, values = [], [], []
+        for code, i in enumerate(positions):
+            column = counts[:, i]
+            nonzero = np.flatnonzero(column)
+            seq_idx.append(nonzero)
+            col_idx.append(np.full(len(nonzero), code, dtype=np.int64))
+            values.append(column[nonzero])
+
+        return cls(names.astype(str), [all_columns[1:][i] for i in positions],
+                   np.concatenate(seq_idx) if positions else [],
+                   np.concatenate(col_idx) if positions else [],
+                   np.concatenate(values) if positions else [])
+
+    @classmethod
+    def from_dataframe(cls, df, sample_list=None):
+        """
+        This method builds the sparse matrix of a count table dataframe
+        (the sequence name as the first column, then the sample.primer columns)
+        """
+        columns = [col for col in df.columns[1:]
+                   if col.strip() != 'total' and (sample_list is None or split_column(col)[0] in sample_list)]
+        values = df[columns].to_numpy()
+        seq_idx, col_idx = np.nonzero(values)
+        return cls(df.iloc[:, 0].to_numpy(), columns, seq_idx, col_idx, values[seq_idx, col_idx])
+
+    def _subset(self, keep, columns=None):
+        '''
+        new CountMatrix with only the kept cells, and optionally another list of columns
+        '''
+        col_idx = self.col_idx[keep]
+        if columns is None:
+            columns = self.columns
+        else:
+            code = {col: i for i, col in enumerate(columns)}
+            remap = np.array([code.get(col, -1) for col in self.columns], dtype=np.int64)
+            col_idx = remap[col_idx] if len(remap) else col_idx
+        return CountMatrix(self.seqs, columns, self.seq_idx[keep], col_idx, self.counts[keep])
+
+    def select_samples(self, sample_list):
+        """
+        returns the CountMatrix of only the sample.primer columns of the given samples
+        """
+        columns = [col for col in self.columns if split_column(col)[0] in sample_list]
+        keep = np.isin(self.col_idx, [i for i, col in enumerate(self.columns) if col in set(columns)])
+        return self._subset(keep, columns)
+
+    def filter_seqs(self, seqs):
+        """
+        returns the CountMatrix of only the given sequences (the columns are unchanged)
+        """
+        keep = np.isin(self.seq_idx, np.flatnonzero(np.isin(self.seqs, list(set(seqs)))))
+        return self._subset(keep)
+
+    def filter_pairs(self, seqs, columns):
+        """
+        This method keeps only the cells of the given (sequence, sample.primer) pairs, i.e. the blast hits.
+        The columns of the new CountMatrix are those of the pairs (whose sequence is in the matrix),
+        even if all of their cells are 0, just like merging the melted dense table with the pairs.
+
+        Parameters
+        ----------
+        seqs: list of the sequence names of the pairs
+        columns: list of the sample.primer of the pairs
+
+        Returns
+        -------
+        a CountMatrix
+        """
+        seq_code = pd.Series(np.arange(len(self.seqs)), index=self.seqs)
+        col_code = pd.Series(np.arange(len(self.columns)), index=self.columns)
+        pairs = pd.DataFrame({'seq': seq_code.reindex(list(seqs)).to_numpy(),
+                              'col': col_code.reindex([col.strip() for col in columns]).to_numpy()}).dropna()
+        pair_keys = np.unique(pairs['seq'].to_numpy(dtype=np.int64) * len(self.columns) +
+                              pairs['col'].to_numpy(dtype=np.int64))
+        keep = np.isin(self.seq_idx * len(self.columns) + self.col_idx, pair_keys)
+        new_columns = sorted(set(self.columns[i] for i in pair_keys % max(1, len(self.columns))))
+        return self._subset(keep, new_columns)
+
+    def column_sums(self):
+        """
+        returns the total abundance of each sample.primer column, as a Series
+        """
+        sums = np.bincount(self.col_idx, weights=self.counts, minlength=len(self.columns)).astype(np.int64)
+        return pd.Series(sums, index=self.columns)
+
+    def sum_by_sample(self):
+        """
+        returns the total abundance of each sample, as a Series
+        """
+        sums = np.bincount(self.col_sample[self.col_idx], weights=self.counts, minlength=len(self.samples))
+        return pd.Series(sums.astype(np.int64), index=self.samples)
+
+    def sum_by_primer(self):
+        """
+        returns the total abundance of each primer, as a Series
+        """
+        sums = np.bincount(self.col_primer[self.col_idx], weights=self.counts, minlength=len(self.primers))
+        return pd.Series(sums.astype(np.int64), index=self.primers)
+
+    def sample_primer_df(self):
+        """
+        returns the total abundance of each sample.primer column as a (sample x primer) dataframe,
+        NaN for the sample.primer which are not a column of the count table
+        """
+        values = np.full((len(self.samples), len(self.primers)), np.nan)
+        values[self.col_sample, self.col_primer] = self.column_sums().to_numpy()
+        return pd.DataFrame(values, index=self.samples, columns=self.primers)
+
+    def to_long_df(self):
+        """
+        returns the non-zero cells as a long format dataframe with 3 columns 'seq', 'sample_primer' and 'count'
+        (the melted count table, without its 0 counts), column by column
+        """
+        return pd.DataFrame({'seq': self.seqs[self.seq_idx],
+                             'sample_primer': np.asarray(self.columns, dtype=object)[self.col_idx],
+                             'count': self.counts})
+
+    def to_dataframe(self):
+        """
+        returns the wide (dense) dataframe view: 'seq' and the sample.primer columns,
+        only for the sequences which have any count
+        """
+        rows, seq_idx = np.unique(self.seq_idx, return_inverse=True)
+        values = np.zeros((len(rows), len(self.columns)), dtype=np.int64)
+        values[seq_idx, self.col_idx] = self.counts
+        df = pd.DataFrame(values, columns=self.columns)
+        df.insert(0, 'seq', self.seqs[rows])
+        return df
+
+
+if __name__ == "__main__":
+    print("This module is called by pipeline.py.  Please run pipeline.py --help for more information")
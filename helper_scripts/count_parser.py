@@ -4,7 +4,9 @@ import argparse, os
 import pandas as pd
 import numpy as np
 import datetime
-from pathlib import Path
+# full format count tables are read through their columnar cache
+from count_matrix import CountMatrix, split_sample_primer
+from utilities import peak_memory_mb
 import run_blast as blast
 import count_plot
 from operator import truediv
@@ -28,21 +30,6 @@ def move_column_inplace(df, col, pos):
     df.insert(pos, col.name, col)
 
 
-# helper method to read a full format count table, and/or save it as a pickle file for faster retrieval
-def read_count_table(count_file):
-
-    if Path(f"{count_file}.pkl").is_file():
-        print(f"...loading {count_file}.pkl")
-        df = pd.read_pickle(f"{count_file}.pkl")
-    else:
-        # read count_table
-        print("loading csv count file")
-        df = pd.read_csv(count_file, sep='\t')
-        print("done loading csv count file")
-        pd.to_pickle(df, f"{count_file}.pkl") 
-        print("done dumping pkl file")
-
-    return df
 
 def create_blast_df(blast_file, query_fasta, reference, max_hit):
 
@@ -50,10 +37,10 @@ def create_blast_df(blast_file, query_fasta, reference, max_hit):
     bcolnames = ["seq", "primer", "query_len", "subj_len", "len_aln", "eval", "cov", "pident", "mismatch"]
 
     if not blast_file: #if we don't already have blast result as a text file
-        blast_file = blast.blast(query_fasta, reference, os.path.basename(query_fasta), max_hit)
-        
-    # blast_df = pd.read_csv(blast_file, sep='\t', names=bcolnames, index_col=False, header=None)
-    blast_df = pd.read_csv(blast_file, sep='\t', names=bcolnames)
+        blast_df = blast.blast_table(query_fasta, reference, os.path.basename(query_fasta), max_hit, bcolnames)
+    else:
+        # blast_df = pd.read_csv(blast_file, sep='\t', names=bcolnames, index_col=False, header=None)
+        blast_df = pd.read_csv(blast_file, sep='\t', names=bcolnames)
     blast_df['sample'] = blast_df['primer'].str.split('-').str[2]
     blast_df['primer'] = blast_df['primer'].str.split('-').str[1]
     blast_df['sample_primer'] = blast_df['sample'] + '.' + blast_df['primer']
@@ -61,47 +48,34 @@ def create_blast_df(blast_file, query_fasta, reference, max_hit):
     return blast_df
 
 
-def merge_count_blast(df, primer_list, blast_df):
+def merge_count_blast(count_matrix, blast_df):
     '''
     this method filters the original full-format count table (below), so that seqs 
-    all have matches in blast result and their pident == 100 & cov >= 90
+    all have matches in blast result and their pident == 100 & cov >= 90, and sums the filtered counts
+    of each sample.primer column
 
     Rep_Seq Sam1_PP1    Sam2_PP1    Sam1_PP2    Sam2_PP2
     Seq1    10  42  0   0
     Seq2    0   0   86  0
     Seq3    4   0   0   0
 
+    The count table is held as a sparse CountMatrix (no 0 counts, integer coded seqs and columns), so neither
+    the melted table, its merge with the blast result, nor the pivoted table is ever built.
+
     Parameters
     ----------
-    df: the original count table dataframe
-    primer_list: the list of targeted sample.primer ['Sam1_PP1', 'Sam1_PP2'] etc.
+    count_matrix: the original count table as a CountMatrix (of the targeted sample.primer columns)
     blast_df: blast result dataframe
 
-    Returns the filtered dataframe
+    Returns the filtered abundance of each sample.primer column (Series)
 
     '''
 
-    #1.1 melt the df 
-    df = df.melt(id_vars=['seq'],value_vars=primer_list,var_name='sample_primer_orig',value_name='count')
-
-    # if it's a dilution sample, we change it from 2011K_0052_C.OG0002271primerGroup6
-    # to 2011K_0052.OG0002271primerGroup6 so it can match blast result
-    # df['sample_primer'] = [sp.split('.')[0][:-2] + "." + sp.split('.')[1] \
-    #                         if sp.split('.')[0][:-2] in dilution_samples_list else sp for sp in df['sample_primer_orig']]
-    df['sample_primer'] = df['sample_primer_orig'] # skip all the dilution data
-
-    #1.2 merge 2 dfs (count table and blast result)
-    df = pd.merge(df,blast_df,on=['seq','sample_primer'])
+    #1.1 filter by pident == 100 & cov >= 90
+    blast_df = blast_df[(blast_df['pident'] == 100) & (blast_df['cov'] >= 90)]
 
-    #1.3 filter by pident == 100 & cov >= 90
-    df = df[(df['pident'] == 100) & (df['cov'] >= 90)]
-    df.drop_duplicates(subset=['seq','sample_primer_orig'], inplace=True)
-
-    #1.4 reverse the melt, and return to original format of df
-    df = df.drop(columns = ["query_len", "subj_len", "eval", "cov", "pident", "mismatch", "primer", "sample", "sample_primer"])
-    df = df.pivot(index='seq',columns='sample_primer_orig',values='count')
-
-    return df
+    #1.2 keep only the count table cells with a blast hit (the duplicated pairs are dropped), and sum them
+    return count_matrix.filter_pairs(blast_df['seq'], blast_df['sample_primer']).column_sums()
 
 
 def split_samle_primer(sr, primers, sample_list):
@@ -129,18 +103,8 @@ def split_samle_primer(sr, primers, sample_list):
 
     '''
 
-    #1. construct lists of count values(as columns) for the final df
-    n_column_list = []
-    _idx = sr.index
-    for pp in primers:
-        # check if sample.pp is in the index, otherwise make it blank
-        n_column_list.append([sr[f"{sample}.{pp}"] if f"{sample}.{pp}" in _idx else 0 for sample in sample_list])
-
-    #2. create the final_df from the list, transpose and reset the index name
-    final_df = pd.DataFrame(n_column_list, index=primers).T
-    final_df.index = sample_list
-
-    return final_df
+    # vectorized: the sample.primer index is split once and unstacked
+    return split_sample_primer(sr, primers, sample_list)
 
 # helper method to:
 # 1. find the most abundant unique sequence for each sample-primer
@@ -295,8 +259,6 @@ def main():
     parser.add_argument('-r', '--reference', metavar = '', required = False, help = 'Specify fasta file containing the positive control targets.')
     args = parser.parse_args()
 
-    df = read_count_table(args.count_file)
-
     # read sample list file
     sample_list = pd.read_csv(args.sample_file, names = ['sample'])['sample'].tolist()
     sample_list.sort(key=str.lower)
@@ -306,24 +268,20 @@ def main():
     print (blast_df.head(n=5))
     print (blast_df.shape)
 
-    #1. filter columns to contain only sample names in sample_list
-    df.columns = df.columns.str.strip() # remove potential spaces
-    seq_df = df.iloc[:,0] # keep the 1st column (sequence)
-    primer_list = [i for i in df.columns if i.split('.')[0] in sample_list]
-    df = df[primer_list]
-    df['seq'] = seq_df
+    #1. sparse count matrix of only the sample.primer columns of the samples in sample_list
+    count_matrix = CountMatrix.from_count_table(args.count_file, sample_list)
 
-    old_df = df.sum() #total abundanceall high quality seqs
+    old_df = count_matrix.column_sums() #total abundanceall high quality seqs
     
     # df_copy = df.copy() # df_copy will be changed within plot_perfect_match()
     # plot_perfect_match(df_copy, blast_df, sample_list) #plot the most abundant hit was a perfect match
 
     # # filter out sequences so that seqs left all have matches in blast result and their pident == 100 & cov >= 90
-    df = merge_count_blast(df, primer_list, blast_df)
+    new_df = merge_count_blast(count_matrix, blast_df)
+    print (f"peak memory: {peak_memory_mb()} MB")
     # # df.set_index('seq', inplace=True) # required if without merge_count_blast step !
     # create_hit_table(df, sample_list, args.output)
 
-    new_df = df.sum()
     # pd.to_pickle(new_df, f"perfect_match_sum_dilution.pkl")
     
     # new_df = pd.read_pickle(f"perfect_match_sum_dilution.pkl")
@@ -336,7 +294,6 @@ def main():
 
     new_df = split_samle_primer(new_df, get_column_list(new_df), sample_list)
     # plot all perfect matches abundance / total abundanceall high quality seqs
-    old_df.drop(['seq'], inplace=True)
     old_df = split_samle_primer(old_df, get_column_list(old_df), sample_list)
     # print (old_df.mean(axis=1)) #print out mean coverage value
     # print (new_df.mean(axis=1))
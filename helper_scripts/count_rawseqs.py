@@ -2,43 +2,157 @@ import argparse
 import glob
 import os
 import gzip
+import shutil
+import subprocess
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import utilities
+from primer_index import PrimerIndex
+from seq_reader import read_batches
 
 ### this script is used to count the number of raw sequences per primer pair (2461 total) in fastg.gz file
 
-# Create an argument parser
-parser = argparse.ArgumentParser(description="Count lines in files with specified extension")
-
-# Add the arguments
-parser.add_argument("folder_path", help="Path to the folder containing the files")
-parser.add_argument("output_file", help="Path to the output file")
-
-# Parse the arguments
-args = parser.parse_args()
-
-# Get the folder path and output file path from the arguments
-folder_path = args.folder_path
-output_file = args.output_file
-
-# Get a list of files with the specified extension
-files = glob.glob(folder_path + "/*_R1_001.fastq.gz")
-
-print (len(files))
-
-# Open the output file for writing
-with open(output_file, "w") as f:
-    # Iterate over each file
-    for file in files:
-        line_count = 0
-        # # Open the file in binary mode
-        # with open(file, "rb") as infile:
-        # Open the gz-compressed file using gzip.open()
-        with gzip.open(file, "rt") as infile:
-            # Count the number of lines
-            for _ in infile:
-                line_count += 1
-        # Calculate the result with one decimal precision
-        result = round(line_count / 9844, 1) #4 lines per seq in fastq, and total 2461 primers
-        # Get the relative file name without preceding path
-        relative_file_name = os.path.basename(file)
-        # Write the relative file name, line count, and result to the output file, separated by a tab
-        f.write("{}\t{}\n".format(relative_file_name, result))
\ No newline at end of file
+# 4 lines per seq in fastq
+FASTQ_LINES = 4
+# total number of primers in our oligo file, used when no oligo file is given
+PRIMER_COUNT = 2461
+# size of the decompressed blocks which are read (and counted) at a time
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# the primer index of a pool worker, see init_worker
+worker = {}
+
+
+def parse_argument():
+    # Create an argument parser
+    parser = argparse.ArgumentParser(description="Count lines in files with specified extension")
+
+    # Add the arguments
+    parser.add_argument("folder_path", help="Path to the folder containing the files")
+    parser.add_argument("output_file", help="Path to the output file")
+    parser.add_argument('-n', '--cores', metavar = '', type = int, default = os.cpu_count(),
+                        help = 'Specify the number of files counted in parallel (default: number of cpus)')
+    parser.add_argument('-t', '--threads', metavar = '', type = int, default = 1,
+                        help = 'Specify the number of decompression threads per file, more than 1 uses pigz if it is installed '
+                               '(not used with --primer_table)')
+    parser.add_argument('-l', '--oligos', metavar = '', required = False,
+                        help = 'Specify oligos file, for the number of primers (default: 2461) and the primers of --primer_table')
+    parser.add_argument('-p', '--primer_table', metavar = '', required = False,
+                        help = 'Specify output file of the expected vs observed read counts per primer (requires --oligos)')
+
+    # Parse the arguments
+    args = parser.parse_args()
+    if args.primer_table and not args.oligos:
+        parser.error("--primer_table requires --oligos")
+    return args
+
+
+def decompressor(file, threads=1):
+    '''
+    returns the (binary) stream of the decompressed gz file, from pigz when more than 1 thread is asked
+    and pigz is installed (the pigz process is returned too, None otherwise)
+    '''
+    pigz = shutil.which('pigz') if threads > 1 else None
+    if pigz is None:
+        return gzip.open(file, 'rb'), None
+    process = subprocess.Popen([pigz, '-dc', '-p', str(threads), file], stdout=subprocess.PIPE)
+    return process.stdout, process
+
+
+def count_lines(file, threads=1):
+    '''
+    This method counts the lines of a gz file: it is decompressed in binary, CHUNK_SIZE at a time,
+    and the newlines of each block are counted at once (bytes.count)
+
+    Parameters
+    ----------
+    file: String name of the gz file
+    threads: number of decompression threads (see decompressor)
+
+    Returns the number of lines
+    '''
+    stream, process = decompressor(file, threads)
+    line_count, last = 0, b'\n'
+    with stream:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            line_count += chunk.count(b'\n')
+            last = chunk[-1:]
+    if process is not None and process.wait() != 0:
+        raise RuntimeError(f"pigz failed on {file}, return_code={process.returncode}")
+    if last != b'\n': # the last line has no newline
+        line_count += 1
+    return line_count
+
+
+def count_primer_reads(file, index, batch_size=100000):
+    '''
+    This method counts the reads of a fastq(.gz) file, and the reads of each primer: the reads are assigned
+    to the primer(s) they have (forward or reverse, either strand) with a PrimerIndex, a batch at a time
+
+    Returns
+    -------
+    the number of reads, and the Counter of the reads per primer
+    '''
+    reads, primer_counts = 0, Counter()
+    for batch in read_batches(file, batch_size):
+        reads += len(batch)
+        for assigned in index.assign([record.seq for record in batch], both=False):
+            primer_counts.update(set(primer for primer, _ in assigned))
+    return reads, primer_counts
+
+
+def init_worker(index):
+    '''
+    the primer index (or None) is sent once to each worker of the pool, not with every file
+    '''
+    worker['index'] = index
+
+
+def count_file(parameters):
+    '''
+    returns the file name, its number of lines and its Counter of reads per primer (None without a primer index)
+    '''
+    file, threads = parameters
+    index = worker.get('index')
+    if index is None:
+        return os.path.basename(file), count_lines(file, threads), None
+    reads, primer_counts = count_primer_reads(file, index)
+    return os.path.basename(file), reads * FASTQ_LINES, primer_counts
+
+
+def main():
+
+    args = parse_argument()
+
+    # Get a list of files with the specified extension
+    files = glob.glob(args.folder_path + "/*_R1_001.fastq.gz")
+
+    print (len(files))
+
+    primers = utilities.Primers(args.oligos) if args.oligos else None
+    primer_count = len(primers.pseqs) if primers is not None else PRIMER_COUNT
+    # the reads are assigned to their primers (much slower than counting lines) only for the primer table
+    index = PrimerIndex(primers) if args.primer_table else None
+
+    with ProcessPoolExecutor(max_workers=args.cores, initializer=init_worker, initargs=(index,)) as executor:
+        results = list(executor.map(count_file, [(file, args.threads) for file in files]))
+
+    # Open the output file for writing
+    with open(args.output_file, "w") as f:
+        for relative_file_name, line_count, _ in results:
+            # Calculate the result (expected reads per primer) with one decimal precision
+            result = round(line_count / (FASTQ_LINES * primer_count), 1)
+            # Write the relative file name and result to the output file, separated by a tab
+            f.write("{}\t{}\n".format(relative_file_name, result))
+
+    if args.primer_table:
+        rows = []
+        for relative_file_name, line_count, primer_counts in results:
+            expected = round(line_count / (FASTQ_LINES * primer_count), 1)
+            rows.extend((relative_file_name, primer, expected, primer_counts.get(primer, 0)) for primer in index.names)
+        pd.DataFrame(rows, columns=['file', 'primer', 'expected', 'observed']).to_csv(args.primer_table, sep='\t', index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+import os
+from array import array
+import numpy as np
+
+# number of reads (from the names file) processed per batch, this bounds the memory used by the names pass
+BATCH_READS = 1000000
+# max number of cells in a dense block of rows, when writing the full format count_table
+BLOCK_CELLS = 2000000
+# the 64 bit key of a read name, the reads whose keys collide are looked up by name instead (see read_group_file)
+read_hash = hash
+
+
+def read_group_file(group_file):
+    """
+    This function reads a MOTHUR group file (read_name  group) in a single streaming pass.
+    Read names are kept only as their 64 bit hash, and groups as integer codes, so the whole
+    file takes 12 bytes per read in memory (i.e. 12 GB for 1e9 reads, it is not bounded by BATCH_READS).
+    If some hashes collide (which happens on very large runs), the file is read a second time to keep
+    the names of the colliding reads, so that they are looked up by name (see count_batch).
+
+    Parameters
+    ----------
+    group_file: String name of the group file
+
+    Returns
+    -------
+    read_hashes: sorted numpy array of the read name hashes
+    read_codes: numpy array of the group code for each of the above hashes
+    groups: list of group names, sorted the way MOTHUR sorts them (the group code is the position in this list)
+    collisions: dictionary of read name: group code, for the reads whose hash is shared by another read
+
+    """
+    group_codes = {}
+    hashes = array('q')
+    codes = array('i')
+    with open(group_file, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            code = group_codes.setdefault(fields[1], len(group_codes))
+            hashes.append(read_hash(fields[0]))
+            codes.append(code)
+
+    # re-code the groups so that the codes follow the sorted group names
+    groups = sorted(group_codes)
+    remap = np.empty(len(groups), dtype=np.int32)
+    remap[[group_codes[g] for g in groups]] = np.arange(len(groups), dtype=np.int32)
+
+    read_hashes = np.frombuffer(hashes, dtype=np.int64)
+    order = np.argsort(read_hashes, kind='stable')
+    read_hashes = read_hashes[order]
+    read_codes = remap[np.frombuffer(codes, dtype=np.int32)[order]]
+
+    collisions = {}
+    collided = set(read_hashes[1:][read_hashes[1:] == read_hashes[:-1]].tolist())
+    if collided:
+        with open(group_file, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and read_hash(fields[0]) in collided:
+                    collisions[fields[0]] = groups.index(fields[1])
+
+    return read_hashes, read_codes, groups, collisions
+
+
+def count_batch(reps, rep_sizes, hashes, read_hashes, read_codes, n_groups, names=None, collisions=None):
+    '''
+    this method counts the reads of a batch of representative sequences by group,
+    the reads whose hash collides (see read_group_file) are looked up by their names instead
+
+    Returns
+    -------
+    keys: sorted numpy array of (rep index in the batch * n_groups + group code)
+    counts: numpy array of the number of reads for each key
+    '''
+    h = np.frombuffer(hashes, dtype=np.int64)
+    pos = np.searchsorted(read_hashes, h)
+    pos[pos == len(read_hashes)] = 0
+    missing = read_hashes[pos] != h
+    codes = read_codes[pos]
+    if collisions:
+        collided = np.array([read_hash(name) for name in collisions], dtype=np.int64)
+        for i in np.flatnonzero(np.isin(h, collided)):
+            codes[i] = collisions.get(names[i], -1)
+            missing[i] = codes[i] < 0
+    if missing.any():
+        rep = reps[np.repeat(np.arange(len(reps)), rep_sizes)[missing][0]]
+        raise RuntimeError(f"************************************************************\n"
+                           f"return_code=None   Alert! ERROR\n"
+                           f"reads of {rep} in the names file are not in the group file\n"
+                           f"************************************************************")
+
+    rep_idx = np.repeat(np.arange(len(reps), dtype=np.int64), rep_sizes)
+    return np.unique(rep_idx * n_groups + codes, return_counts=True)
+
+
+def write_batch(out, reps, keys, counts, n_groups, compress):
+    '''
+    this method writes the rows of a batch of representative sequences to the count_table
+    '''
+    rep_idx = keys // n_groups
+    group_idx = keys % n_groups
+    totals = np.bincount(rep_idx, weights=counts, minlength=len(reps)).astype(np.int64)
+
+    if compress:
+        # groupIndex (1-based),abundance for the non-zero groups only
+        bounds = np.searchsorted(rep_idx, np.arange(len(reps) + 1))
+        cells = np.char.add(np.char.add((group_idx + 1).astype(str), ','), counts.astype(str))
+        for i, rep in enumerate(reps):
+            out.write(f"{rep}\t{totals[i]}\t" + '\t'.join(cells[bounds[i]:bounds[i+1]]) + '\n')
+    else:
+        block = max(1, BLOCK_CELLS // n_groups)
+        for start in range(0, len(reps), block):
+            end = min(start + block, len(reps))
+            in_block = (rep_idx >= start) & (rep_idx < end)
+            dense = np.zeros((end - start, n_groups), dtype=np.int64)
+            dense[rep_idx[in_block] - start, group_idx[in_block]] = counts[in_block]
+            for i, row in enumerate(dense, start=start):
+                out.write(f"{reps[i]}\t{totals[i]}\t" + '\t'.join(row.astype(str)) + '\n')
+
+
+def build_count_table(name_file, group_file, compress=True):
+    """
+    This function is the in-process replacement of MOTHUR's count.seqs(name=, group=).
+    It reads the group file once (see read_group_file), then streams through the names file
+    in batches of BATCH_READS reads and writes each batch of rows as soon as it is counted.
+    The output is named the way MOTHUR names it: names file without extension + .count_table
+
+    Parameters
+    ----------
+    name_file: String name of the MOTHUR names file (representative_seq  read1,read2,...)
+    group_file: String name of the MOTHUR group file (read  group)
+    compress: boolean, write the compressed (default) or full format count_table
+
+    Returns
+    -------
+    the count_table file name
+
+    """
+    name_file = os.path.expanduser(name_file)
+    count_file = f"{os.path.splitext(name_file)[0]}.count_table"
+    read_hashes, read_codes, groups, collisions = read_group_file(os.path.expanduser(group_file))
+    n_groups = len(groups)
+
+    with open(name_file, 'r') as f, open(count_file, 'w') as out:
+        if compress:
+            out.write(f"#Compressed Format: groupIndex,abundance. For example 1,6 would mean the read has "
+                      f"an abundance of 6 for group {groups[0]}.\n")
+            out.write('#' + '\t'.join(f"{i},{group}" for i, group in enumerate(groups, start=1)) + '\n')
+            out.write("Representative_Sequence\ttotal\n")
+        else:
+            out.write("Representative_Sequence\ttotal\t" + '\t'.join(groups) + '\n')
+
+        # the read names of a batch are only kept if some hashes collide
+        reps, rep_sizes, hashes, names = [], [], array('q'), []
+        for line in f:
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            reads = fields[1].split(',')
+            reps.append(fields[0])
+            rep_sizes.append(len(reads))
+            hashes.extend(read_hash(read) for read in reads)
+            if collisions:
+                names.extend(reads)
+            if len(hashes) >= BATCH_READS:
+                keys, counts = count_batch(reps, rep_sizes, hashes, read_hashes, read_codes, n_groups, names, collisions)
+                write_batch(out, reps, keys, counts, n_groups, compress)
+                reps, rep_sizes, hashes, names = [], [], array('q'), []
+        if reps:
+            keys, counts = count_batch(reps, rep_sizes, hashes, read_hashes, read_codes, n_groups, names, collisions)
+            write_batch(out, reps, keys, counts, n_groups, compress)
+
+    return count_file
+
+
+def read_count_header(f):
+    """
+    This function reads the header of a count_table (either format) from an open file
+
+    Returns
+    -------
+    groups: list of the group names, in the order of the count_table columns (group indexes)
+    compressed: boolean, whether the count_table is in the compressed format
+    """
+    line = f.readline()
+    if line.startswith('#Compressed'):
+        groups = [cell.split(',', 1)[1] for cell in f.readline()[1:].split()]
+        f.readline()  # Representative_Sequence  total
+        return groups, True
+    return line.split()[2:], False
+
+
+def merge_count_tables(count_files, merged_file):
+    """
+    This function merges count_tables of different samples (i.e. from the per sample pipeline runs) into
+    one full format count_table over all of their groups, with 0 abundance for the groups a sample doesn't have.
+    The tables are streamed row by row, the representative sequences of different samples are assumed to be distinct.
+
+    Parameters
+    ----------
+    count_files: list of count_table file names (either format)
+    merged_file: String name of the merged count_table
+
+    Returns
+    -------
+    the merged count_table file name
+
+    """
+    headers = []
+    for count_file in count_files:
+        with open(count_file, 'r') as f:
+            headers.append(read_count_header(f))
+    groups = sorted(set(group for file_groups, _ in headers for group in file_groups))
+    position = {group: i for i, group in enumerate(groups)}
+
+    with open(merged_file, 'w') as out:
+        out.write("Representative_Sequence\ttotal\t" + '\t'.join(groups) + '\n')
+        for count_file, (file_groups, compressed) in zip(count_files, headers):
+            columns = [position[group] for group in file_groups]
+            with open(count_file, 'r') as f:
+                read_count_header(f)
+                for line in f:
+                    fields = line.split()
+                    if len(fields) < 2:
+                        continue
+                    row = ['0'] * len(groups)
+                    if compressed:
+                        for cell in fields[2:]:
+                            group_index, abundance = cell.split(',')
+                            row[columns[int(group_index) - 1]] = abundance
+                    else:
+                        for column, abundance in zip(columns, fields[2:]):
+                            row[column] = abundance
+                    out.write(f"{fields[0]}\t{fields[1]}\t" + '\t'.join(row) + '\n')
+
+    return merged_file
+
+
+if __name__ == "__main__":
+    print("This module is called by pipeline.py.  Please run pipeline.py --help for more information")
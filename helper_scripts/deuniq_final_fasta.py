@@ -5,7 +5,7 @@ import argparse
 import pandas as pd
 import run_grep
 import confusion_matrix as cm
-import count_parser as cp
+from count_matrix import CountMatrix
 import utilities as u
 import random
 
@@ -71,8 +71,8 @@ if __name__ == '__main__':
     
     ## read full count table and convert it to long format (from wide format)
     #  with 3 columns 'seq', 'sample_primer' and 'count'
-    ori_count_df = cp.read_count_table(args.count_file)
-    melt_count_df = cm.make_melt_count_df(ori_count_df, sample_list)
+    count_matrix = CountMatrix.from_count_table(args.count_file, sample_list)
+    melt_count_df = cm.make_melt_count_df(count_matrix, sample_list)
 
     ## this is to create a list of random 100 primer pairs
     # oligo_primers = u.Primers(settings.OLIGO_FILE)
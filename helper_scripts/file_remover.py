@@ -2,7 +2,7 @@
 import glob, os
 
 
-def remove_vsearch_files(config):
+def remove_vsearch_files(config, primers_only=False):
     """
     This function parse the oligo file (in the config object), and use the primer ID/barcode ID as a pattern
     to search and remove the temp files generated from m.chimera.vsearch()
@@ -11,6 +11,9 @@ def remove_vsearch_files(config):
     Parameters
     ----------
     config object
+    primers_only: only the primer IDs are used as search patterns, not the barcode IDs (i.e. in per sample mode,
+                  every file of a sample's folder is named after the sample, which is also its barcode ID, and
+                  another barcode ID may be a substring of it: S1 and S10)
 
     Returns
     -------
@@ -22,7 +25,8 @@ def remove_vsearch_files(config):
     with open(path) as f:
     #parse the oligo file and use the primer_id (4th column) as
     #search pattern, to remove the temp files from m.chimera.vsearch
-        for label_id in (line.split()[3] for line in f.readlines() if ('primer' in line or 'barcode' in line)):
+        labels = ('primer',) if primers_only else ('primer', 'barcode')
+        for label_id in (line.split()[3] for line in f.readlines() if any(label in line for label in labels)):
             for file_to_remove in glob.glob(rf"{dir}/*{label_id}*"):
                 os.remove(file_to_remove)
 
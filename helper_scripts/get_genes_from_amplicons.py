@@ -35,10 +35,9 @@ def create_blast_df(query_fasta, subject_fasta, max_hits):
 
     bcolnames = ["query", "subject", "query_len", "subj_len", "len_aln", "eval", "cov", "pident", "mismatch"]
 
-    blast_file = blast.blast(query_fasta, subject_fasta, os.path.basename(query_fasta), max_hits)
-    blast_df = pd.read_csv(blast_file, sep='\t', names=bcolnames)
-    # requires 100% match for now
-    blast_df = blast_df[ (blast_df["pident"] >= 100) & (blast_df["cov"] >= 100) ]
+    # requires 100% match for now (filtered as blast produces the hits)
+    blast_df = blast.blast_table(query_fasta, subject_fasta, os.path.basename(query_fasta), max_hits, bcolnames,
+                                 pident=100, pcov=100)
     blast_df = blast_df[["query", "subject"]] # we only need these 2 fields
     
     return blast_df
@@ -3,27 +3,122 @@ import re
 import os
 import pandas as pd
 
+class LogIndex:
+    '''
+    Incremental index of a MOTHUR log file.
+    It keeps the byte offset it has read up to, and on every lookup only reads (tails) the part of the log
+    written since then, updating a running map of the most current file for each file type
+    (fasta/group/count/accnos/name and any other type asked for) and the first match of any searched pattern.
+    Lookups then cost O(new log lines) instead of re-reading and re-scanning the whole log.
+    '''
+    FILE_TYPES = ('fasta', 'group', 'count', 'accnos', 'name')
+
+    def __init__(self, mothur_log_file):
+        self.log_file = mothur_log_file
+        self.offset = 0
+        self.patterns = {}  # file_type: compiled regex
+        self.current = {}   # file_type: most current file
+        self.searches = {}  # pattern: compiled regex
+        self.first = {}     # pattern: first match
+        for file_type in LogIndex.FILE_TYPES:
+            self.patterns[file_type] = re.compile(rf"{file_type}=.*{file_type}[^\s]*")
+
+    def _scan_line(self, line, file_types, searches):
+        if '=' in line:
+            for file_type in file_types:
+                if f'{file_type}=' in line:
+                    found = self.patterns[file_type].search(line)
+                    if found:  # we want to keep the last find
+                        self.current[file_type] = found.group(0)[len(file_type)+1:]  # strip the 'file_type='
+        for pattern in searches:
+            if pattern not in self.first:
+                found = self.searches[pattern].search(line)
+                if found:
+                    self.first[pattern] = found.group(0)
+
+    def _scan(self, start, end, file_types, searches):
+        '''
+        scan the complete lines of the log between byte offsets start and end (None: end of file),
+        returns the offset after the last complete line
+        '''
+        with open(self.log_file, 'rb') as f:
+            f.seek(start)
+            for line in f:
+                if not line.endswith(b'\n'):  # incomplete line, mothur is still writing it
+                    break
+                if end is not None and start >= end:
+                    break
+                start += len(line)
+                self._scan_line(line.decode(errors='ignore'), file_types, searches)
+        return start
+
+    def refresh(self):
+        '''
+        read the part of the log written since the last refresh
+        '''
+        if not os.access(self.log_file, os.R_OK):
+            return
+        if os.path.getsize(self.log_file) < self.offset:  # the log was rewritten (i.e. by log_parser), start over
+            self.offset = 0
+            self.current, self.first = {}, {}
+        self.offset = self._scan(self.offset, None, self.patterns, self.searches)
+
+    def _add_patterns(self, file_types=(), searches=()):
+        # new file types / patterns are first looked up in the part of the log we've already read
+        file_types = [t for t in file_types if t not in self.patterns]
+        searches = [p for p in searches if p not in self.searches]
+        for file_type in file_types:
+            self.patterns[file_type] = re.compile(rf"{file_type}=.*{file_type}[^\s]*")
+        for pattern in searches:
+            self.searches[pattern] = re.compile(pattern)
+        if (file_types or searches) and self.offset:
+            self._scan(0, self.offset, file_types, searches)
+
+    def current_file(self, file_type='group'):
+        """
+        returns the most current file of the given type in the MOTHUR log file, or None if there isn't any
+        """
+        self._add_patterns(file_types=[file_type])
+        self.refresh()
+        return self.current.get(file_type)
+
+    def search(self, *patterns):
+        """
+        returns the first match (within a line) of each given regex pattern in the MOTHUR log file
+        (None for a pattern without any match)
+        """
+        self._add_patterns(searches=patterns)
+        self.refresh()
+        return [self.first.get(pattern) for pattern in patterns]
+
+
+log_indexes = {} # one LogIndex per MOTHUR log file
+
+def get_log_index(mothur_log_file):
+    """
+    returns the (shared) LogIndex of the given MOTHUR log file
+    """
+    if mothur_log_file not in log_indexes:
+        log_indexes[mothur_log_file] = LogIndex(mothur_log_file)
+    return log_indexes[mothur_log_file]
+
+
 def get_current_file(mothur_log_file, file_type='group'):
     """
-    This utility function parses the MOTHUR log file, and retrieve the most current file for the specified type
+    This utility function looks up the most current file for the specified type in the MOTHUR log file
+    (see LogIndex, only the part of the log written since the last lookup is read)
 
     Returns
     -------
     the most current file name
     """
-    current_file = ''
-    if os.access(mothur_log_file, os.R_OK):
-        with open(mothur_log_file, 'r', errors='ignore') as f:
-            log_file = f.read()
-        current_file_s = re.finditer(rf"{file_type}=.*{file_type}[^\s]*", log_file)
-        for current_file in current_file_s:  # we want to get the last find
-            pass
-        if not current_file:  # in case MOTHUR log file doesn't have group file
-            raise RuntimeError(f"************************************************************\n"
-                               f"return_code=None   Alert! ERROR\n"
-                               f"can't find {file_type} file in MOTHUR log\n"
-                               f"************************************************************")
-    return current_file.group(0)[len(file_type)+1:]  # strip the 'file_type='
+    current_file = get_log_index(mothur_log_file).current_file(file_type)
+    if not current_file:  # in case MOTHUR log file doesn't have group file
+        raise RuntimeError(f"************************************************************\n"
+                           f"return_code=None   Alert! ERROR\n"
+                           f"can't find {file_type} file in MOTHUR log\n"
+                           f"************************************************************")
+    return current_file
 
 
 def create_new_Group(oldgroup, label='barcode'):
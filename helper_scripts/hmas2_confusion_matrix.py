@@ -1,13 +1,11 @@
-import os
-import configparser
-import subprocess
+import os, sys
+import importlib.util
 from concurrent.futures import ProcessPoolExecutor
 import argparse
-import csv
 import pandas as pd
 
-# Define the fixed section for the config.ini file
-fixed_section = 'file_inputs'
+# the state shared (read only) by the folders processed in a worker process, see init_worker
+worker = {}
 
 
 def parse_argument():
@@ -18,6 +16,8 @@ def parse_argument():
     parser.add_argument('-m', '--metasheet', metavar = '', required = True, help = 'metasheet file')
     parser.add_argument('-p', '--mapping', metavar = '', required = True, help = 'sample isolates mapping file')
     parser.add_argument('-s', '--script', metavar = '', required = True, help = 'python confusio_matrix script')
+    parser.add_argument('-n', '--cores', metavar = '', type = int, default = os.cpu_count(),
+                        help = 'number of folders processed in parallel (default: all cores)')
     return parser.parse_args()
 
 
@@ -46,71 +46,100 @@ def get_fixed_options(args):
     
     return fixed_options
 
-# Define a function that creates a config.ini file and runs another script with it
+
+def load_script(script):
+    '''
+    imports the confusion matrix script (parse_count_table_confusion_matrix.py) as a module,
+    with its folder on sys.path for its own helper_scripts imports
+    '''
+    script = os.path.abspath(os.path.expanduser(script))
+    if os.path.dirname(script) not in sys.path:
+        sys.path.insert(0, os.path.dirname(script))
+    spec = importlib.util.spec_from_file_location('parse_count_table_confusion_matrix', script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def init_worker(script, ref, blast_db, blast_shards):
+    '''
+    initializer of the worker processes: the script module, the reference lookups and the
+    Blast database are loaded once per process and shared by all the folders it processes
+    '''
+    worker['script'] = load_script(script)
+    # the cores are shared between the folders (workers) and the blast shards of each folder
+    worker['script'].blast.BLAST_SHARDS = blast_shards
+    worker['ref'] = ref
+    worker['blast_db'] = blast_db
+
+
+# Define a function that runs the confusion matrix analysis of a folder (within the worker process)
 def process_folder(parameters):
     
     folder_name, fixed_options, args = parameters
-    
-    # Create a new configparser instance
-    config = configparser.ConfigParser()
-    config[fixed_section] = {} #this step seems to be a must ?
+    script = worker['script']
 
-    # Set the fixed options for the config.ini file
-    for key, value in fixed_options.items():
-        config.set(fixed_section, key, value)
+    # the inputs of the analysis (what used to be saved as a config.ini file in the folder)
+    options = dict(fixed_options)
 
-    # Set the customized options for the config.ini file based on the folder name
+    # Set the customized options based on the folder name
     # count_table might be saved in temp folder
     count_table_file = f'{args.input}/{folder_name}/{folder_name}.final.count_table'
     if not os.path.isfile(count_table_file):
         count_table_file = f'{args.input}/{folder_name}/temp/{folder_name}.final.count_table'
         
-    config.set(fixed_section, 'count_table', count_table_file)
-    config.set(fixed_section, 'unique_fasta', f'{args.input}/{folder_name}/{folder_name}.final.unique.fasta')
+    options['count_table'] = count_table_file
+    options['unique_fasta'] = f'{args.input}/{folder_name}/{folder_name}.final.unique.fasta'
+    options['output_file'] = f'{args.input}/{folder_name}/confusion_matrix_{folder_name}'
+    # the folders run in parallel, so each one saves its DEBUG files (raw_df/blast_df) in its own folder
+    options['debug_dir'] = f'{args.input}/{folder_name}'
+
+    script.logger.setLevel(int(options['logging_flag']))
+    confusion_matrix_df = script.run_confusion_matrix(options, [folder_name], worker['ref'], worker['blast_db'])
+    confusion_matrix_df.to_csv(options['output_file'], sep='\t')
     
-    # create a sample.csv for this folder
-    csv_file_path = f'{args.input}/{folder_name}/{folder_name}.sample.csv'
-    with open(csv_file_path, 'w', newline='') as csv_file:
-        csv_writer = csv.writer(csv_file)
-        csv_writer.writerow([f'{folder_name}'])
-        
-    config.set(fixed_section, 'sample_list', csv_file_path)
-    config.set(fixed_section, 'output_file', f'{args.input}/{folder_name}/confusion_matrix_{folder_name}')
+    return confusion_matrix_df
 
-    # Save the config.ini file in the current folder
-    with open(f'{args.input}/{folder_name}/config.ini', 'w') as configfile:
-        config.write(configfile)
 
-    # Execute another Python script with the created config.ini file
-    subprocess.run(['python3', args.script, '-c', f'{args.input}/{folder_name}/config.ini'])
-    confusion_matrix_df = pd.read_csv(f'{args.input}/{folder_name}/confusion_matrix_{folder_name}', index_col=[0])
+def run_folders(args, cores=None):
+    '''
+    This function runs the confusion matrix analysis of all the sample folders in args.input, in parallel.
+    The reference lookups (oligo file, metasheet, mapping file) and the Blast database of the reference are
+    built once, here, and shared read only by the worker processes: building the Blast database in each run
+    (next to the reference fasta) is what made the parallel runs fail.
+
+    Parameters
+    ----------
+    args: the parsed arguments (see parse_argument)
+    cores: number of folders processed in parallel (default: all cores)
+
+    Returns
+    -------
+    the combined confusion matrix dataframe (in the order of the folders)
+    '''
+    fixed_options = get_fixed_options(args)
+    #skip those isolates without any valid unique sequences
+    folder_names = [folder_name for folder_name in get_folders(args)
+                    if os.path.getsize(f'{args.input}/{folder_name}/{folder_name}.final.unique.fasta') > 0]
+
+    script = load_script(args.script)
+    ref = script.load_reference(args.metasheet, args.mapping)
+    blast_db = script.blast.build_blast_db(args.reference)
+
+    cores = cores or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=cores, initializer=init_worker,
+                             initargs=(args.script, ref, blast_db, max(1, (os.cpu_count() or 1) // cores))) as executor:
+        df_list = list(executor.map(process_folder, [(folder_name, fixed_options, args) for folder_name in folder_names]))
+
+    #concat all individual confusion_matrix output into a single one
+    return pd.concat(df_list)
 
-    # Delete the config.ini file and the sample.csv file
-    os.remove(f'{args.input}/{folder_name}/config.ini')
-    os.remove(csv_file_path)
-    
-    return confusion_matrix_df
 
 if __name__ == "__main__":
     
     args = parse_argument()
-    folder_names = get_folders(args)
-    fixed_options = get_fixed_options(args)
-    
-    # # Create a ThreadPoolExecutor with max_workers set to the number of folders
-    #I tried to run multiple processes in parallel, but ran into errors related to blast ?
-    #so we run them one by one for now
-    df_list = []
-    for folder_name in folder_names:
-        #skip those isolates without any valid unique sequences
-        if os.path.getsize(f'{args.input}/{folder_name}/{folder_name}.final.unique.fasta') <= 0:
-            continue
-        parameters = (folder_name, fixed_options, args)
-        df_list.append(process_folder(parameters))
-        
-    #concat all individual confusion_matrix output into a single one
-    confusion_matrix = pd.concat(df_list)
-    confusion_matrix.to_csv(f'{args.output}')
+    confusion_matrix = run_folders(args, args.cores)
+    confusion_matrix.to_csv(f'{args.output}', sep='\t')
 
 
 
@@ -1,69 +1,209 @@
 #!/usr/bin/env python
-import re
-
-
-counter = 0
-def replace(matched):
+import os, re, tempfile
+
+# the chimera.vsearch output is truncated to its first and last TRUNCATE_CHARS characters
+TRUNCATE_CHARS = 2000
+# a block being matched is kept in memory up to this size, beyond that it is spooled to a temp file
+SPOOL_SIZE = 4 * 1024 * 1024
+READ_CHUNK = 1024 * 1024
+
+#match(non-greedy) any contents between get.current() and mothur > quit()
+GET_CURRENT = re.compile(r'mothur > get.current\(\)', re.I)
+QUIT = re.compile(r'mothur > quit\(\)', re.I)
+#match any contents between Linux version (or Windows version) and mothur >'
+VERSION = re.compile(r'(Linux|Windows) version', re.I)
+PROMPT = re.compile(r'mothur >', re.I)
+#match any contents between mothur > set.logfile and 3 or more new lines followed by mothur >'
+SET_LOGFILE = re.compile(r'mothur > set.logfile', re.I)
+# match any contents between Linux version (or Windows version) and mothur > chimera.vsearch'
+CHIMERA = re.compile(r'mothur > chimera.vsearch', re.I)
+
+
+class Block:
+    '''
+    The text matched so far between a start and an end pattern.
+    Only its size, its last TRUNCATE_CHARS characters, its trailing new lines and whether it has
+    an ERROR are kept in memory, the text itself goes to a spooled temp file.
+    '''
+
+    def __init__(self):
+        self.spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE, mode='w+', errors='ignore')
+        self.size = 0
+        self.tail = ''
+        self.newlines = 0
+        self.error = False
+
+    def write(self, text):
+        if not text:
+            return
+        self.spool.write(text)
+        self.size += len(text)
+        self.tail = (self.tail + text)[-TRUNCATE_CHARS:]
+        stripped = text.rstrip('\n')
+        self.newlines = len(text) - len(stripped) + (0 if stripped else self.newlines)
+        self.error = self.error or 'ERROR' in text
+
+    def head(self, size):
+        self.spool.seek(0)
+        return self.spool.read(size)
+
+    def chunks(self):
+        self.spool.seek(0)
+        return iter(lambda: self.spool.read(READ_CHUNK), '')
+
+    def close(self):
+        self.spool.close()
+
+
+def pattern_end(pattern):
+    '''
+    returns a find_end function for stream_sub, for an end pattern within a line
+    '''
+    def find_end(block, line, pos):
+        found = pattern.search(line, pos)
+        return found.end() if found else None
+    return find_end
+
+
+def blank_lines_end(block, line, pos):
+    '''
+    find_end function for stream_sub: 3 or more new lines followed by mothur >
+    '''
+    if pos == 0 and block.newlines >= 3 and PROMPT.match(line):
+        return PROMPT.match(line).end()
+    return None
+
+
+def split_lines(chunks):
+    """
+    This helper method re-splits a stream of text chunks into lines
     """
-    This helper method substitutes all but the first matched occurrence with a literal string
+    partial = ''
+    for chunk in chunks:
+        lines = (partial + chunk).splitlines(keepends=True)
+        if lines and not lines[-1].endswith('\n'):
+            partial = lines.pop()
+        else:
+            partial = ''
+        yield from lines
+    if partial:
+        yield partial
+
+
+def stream_sub(lines, start, find_end, replace):
+    """
+    This method is the streaming equivalent of re.sub(start.*?end, replace, text, flags=re.DOTALL):
+    every block of text from the start pattern to the first end after it is passed to replace,
+    and the text chunks it returns are written instead of the block.
+    A block without an end (at the end of the file) is left unchanged.
 
     Parameters
     ----------
-    A regex match object
+    lines: iterable of the lines of text
+    start: compiled regex of the start pattern
+    find_end: function(block, line, pos) returning the index in line where the block ends, or None
+    replace: function(block) returning an iterable of text chunks
 
     Returns
     -------
-    either the match object itself or literal string mothur >
+    a generator of text chunks
 
     """
-    global counter
-    if counter == 0:
-        counter += 1
-        return matched.group(0)
-    else:
-        counter += 1
-        return 'mothur >'
+    block = None
+    for line in lines:
+        pos = 0
+        while True:
+            if block is None:
+                found = start.search(line, pos)
+                if not found:
+                    yield line[pos:]
+                    break
+                yield line[pos:found.start()]
+                block = Block()
+                block.write(found.group(0))
+                pos = found.end()
+            else:
+                end = find_end(block, line, pos)
+                if end is None:
+                    block.write(line[pos:])
+                    break
+                block.write(line[pos:end])
+                pos = end
+                yield from replace(block)
+                block.close()
+                block = None
+    if block is not None:
+        yield from block.chunks()
+        block.close()
+
+
+def remove(block):
+    """
+    This helper method removes the matched block
+    """
+    return ()
+
 
-def replace_no_error(matched):
+def replace_all_but_first():
     """
-    This helper method substitutes the matched occurrence with a literal string,
+    This helper method returns a replace function which substitutes all but the first
+    matched block with a literal string mothur >
+    """
+    first = True
+    def replace(block):
+        nonlocal first
+        if first:
+            first = False
+            return block.chunks()
+        return ('mothur >',)
+    return replace
+
+
+def replace_no_error(block):
+    """
+    This helper method substitutes the matched block with a literal string,
     if there is no ERROR in it
 
     Parameters
     ----------
-    A regex match object
+    A matched Block
 
     Returns
     -------
-    either the match object itself or literal string mothur >
+    either the block itself or literal string mothur >
     """
-    if ('ERROR' in matched.group(0)):
-        return matched.group(0)
+    if block.error:
+        return block.chunks()
     else:
-        return 'mothur >'
+        return ('mothur >',)
+
 
-def replace_chi(matched):
+def replace_chi(block):
     """
-    This helper method substitutes the matched occurrence with only the first and last 2000 characters
+    This helper method substitutes the matched block with only the first and last 2000 characters
 
     Parameters
     ----------
-    A regex match object
+    A matched Block
 
     Returns
     -------
-    the first and last 2000 characters of the matched string
+    the first and last 2000 characters of the matched block
     """
-    if len(matched.group(0)) > 4000:
-        return (f'{matched.group(0)[:2000]} \n\n\n ### we deleted some output ### \n\n\n {matched.group(0)[-2000:]}')
+    if block.size > 2 * TRUNCATE_CHARS:
+        return (f'{block.head(TRUNCATE_CHARS)} \n\n\n ### we deleted some output ### \n\n\n {block.tail}',)
     else:
-        return matched.group(0)
+        return block.chunks()
 
 
 def parse(file_to_parse):
     """
     This function parses a given file (MOTHUR LOG FILE), makes substitutions based on certain patterns,
     and overwrites the MOTHUR LOG FILE.
+    The log is streamed line by line through the substitutions, in the same order as they used to be applied
+    on the whole log: truncate the chimera.vsearch output, drop the get.current() ... quit() blocks,
+    keep only the first version banner, and drop the set.logfile blocks which have no ERROR.
+    The result is written to a temp file which then atomically replaces the log.
 
     Parameters
     ----------
@@ -74,30 +214,16 @@ def parse(file_to_parse):
     None
 
     """
-    with open(file_to_parse, 'r', errors='ignore') as f:
-        file = f.read()
-
-    #match(non-greedy) any contents between get.current() and mothur > quit()
-    pattern_1 = r'mothur > get.current\(\).*?mothur > quit\(\)'
-
-    #match any contents between Linux version (or Windows version) and mothur >'
-    pattern_2 = r'(Linux|Windows) version.*?mothur >'
-
-    #match any contents between mothur > set.logfile and 3 or more new lines followed by mothur >'
-    pattern_3 = r'mothur > set.logfile.*?[\n]{3,}mothur >'
-
-    # match any contents between Linux version (or Windows version) and mothur > chimera.vsearch'
-    pattern_chi = r'mothur > chimera.vsearch.*?(Linux|Windows) version'
-    file = re.sub(pattern_chi, replace_chi, file, flags=re.DOTALL|re.I)
-
-    file = re.sub(pattern_1, '', file, flags=re.DOTALL|re.I)
-    #keep the first occurrence of Linux version etc. information
-    file = re.sub(pattern_2,replace,file, flags=re.DOTALL|re.I)
-    #replace redundancy if there is no error information in it
-    file = re.sub(pattern_3,replace_no_error,file, flags=re.DOTALL|re.I)
-
-    with open(file_to_parse, 'w') as f:
-        f.write(file)
+    tmp_file = f'{file_to_parse}.tmp'
+    with open(file_to_parse, 'r', errors='ignore') as f, open(tmp_file, 'w') as out:
+        lines = split_lines(stream_sub(f, CHIMERA, pattern_end(VERSION), replace_chi))
+        lines = split_lines(stream_sub(lines, GET_CURRENT, pattern_end(QUIT), remove))
+        #keep the first occurrence of Linux version etc. information
+        lines = split_lines(stream_sub(lines, VERSION, pattern_end(PROMPT), replace_all_but_first()))
+        #replace redundancy if there is no error information in it
+        for chunk in stream_sub(lines, SET_LOGFILE, blank_lines_end, replace_no_error):
+            out.write(chunk)
+    os.replace(tmp_file, file_to_parse)
 
 if __name__ == "__main__":
-    print("This module is called by pipeline.py.  Please run pipeline.py --help for more information")
\ No newline at end of file
+    print("This module is called by pipeline.py.  Please run pipeline.py --help for more information")
@@ -5,7 +5,7 @@ from pathlib import Path
 import glob
 import subprocess
 import utilities
-from Bio import SeqIO
+from seq_reader import OffsetIndex
 import argparse
 
 import random
@@ -64,29 +64,36 @@ def pairwise_by_allprimers(file_dir, full_primer_list, numeric_flag):
     # same_seq_list = []
     # diff_seq_list = []
     
+    # each fasta file is indexed once (lazy dict of its records, see seq_reader.OffsetIndex),
+    # and the seq_ids of each primer are looked up once per file instead of for every pair of files
+    fasta_files = glob.glob(f'{file_dir}/*.fasta')
+    indexes = {fasta: OffsetIndex(fasta) for fasta in fasta_files}
+    primer_keys = {fasta: {primer: [key for key in indexes[fasta] if primer in key] for primer in full_primer_list}
+                   for fasta in fasta_files}
+
     df_list = []
-    for f in glob.glob(f'{file_dir}/*.fasta'):
+    for f in fasta_files:
     # for f in glob.glob(f'{file_dir}/2012K-1532_extractedAmplicons.fasta'):
 
-        row_dict = SeqIO.to_dict(SeqIO.parse(f, "fasta"))
+        row_dict = indexes[f]
         row_list = []
-        for k in glob.glob(f'{file_dir}/*.fasta'):
+        for k in fasta_files:
         # for k in glob.glob(f'{file_dir}/Sal_JKX_2015K-0074_extractedAmplicons.fasta'):
 
-            col_dict = SeqIO.to_dict(SeqIO.parse(k, "fasta"))
+            col_dict = indexes[k]
             diff_count = 0
             total_primer = len(full_primer_list)
             for primer in full_primer_list:
                 
-                row_seq_list = [val for key,val in row_dict.items() if primer in key]
-                col_seq_list = [val for key,val in col_dict.items() if primer in key]   
+                row_seq_list = primer_keys[f][primer]
+                col_seq_list = primer_keys[k][primer]
                 
                 if len(row_seq_list) < 1 or len(col_seq_list) < 1:
                     total_primer -= 1
                 else:
                     if len(row_seq_list) > 1 or len(col_seq_list) > 1:
                         print (f"{primer} has more than 1 match in {f} or {k}")
-                    if check_diff_by_primer(row_seq_list[0].seq, col_seq_list[0].seq):
+                    if check_diff_by_primer(row_dict[row_seq_list[0]].seq, col_dict[col_seq_list[0]].seq):
                         diff_count += 1
                         
                     #     diff_seq_list.append((primer,row_seq_list[0].seq, col_seq_list[0].seq))
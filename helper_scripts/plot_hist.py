@@ -3,6 +3,7 @@ import argparse
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
+from seq_reader import read_records
 
 '''
 this script is ued to generate histograms of primer counts for Jo
@@ -95,21 +96,17 @@ def create_amplicon_count_dict(folder, primer_list):
     # fasta_file = os.path.join(folder,f"{folder_name}.final.unique.fasta") # this is after QC
     fasta_file = os.path.join(folder,'temp', f"{folder_name}.unique.fasta") # this is after primer trimming
 
-    # Open the fasta file
-    with open(fasta_file) as file:
-        # Read the file line by line
-        for line in file:
-            # Check if the line starts with '>'
-            if line.startswith('>'):
-                # Extract the primer name from the line
-                primer_name = line.split('=')[1]
-                # Extract the size value from the line
-                size = float(line.split('=')[-1].split(';')[0].replace('size=', '')) / raw_seq_count[folder_name]
-                
-                # Check if the primer is in the primer list
-                if primer_name in primer_list['primer'].values:
-                    # Add the size to the counts dictionary
-                    counts[primer_name] = counts.get(primer_name, 0) + size
+    # Read the fasta file record by record
+    for record in read_records(fasta_file):
+        # Extract the primer name from the header
+        primer_name = record.header.split('=')[1]
+        # Extract the size value from the header
+        size = float(record.header.split('=')[-1].split(';')[0].replace('size=', '')) / raw_seq_count[folder_name]
+
+        # Check if the primer is in the primer list
+        if primer_name in primer_list['primer'].values:
+            # Add the size to the counts dictionary
+            counts[primer_name] = counts.get(primer_name, 0) + size
                     
     return counts
 
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+from collections import deque
+import numpy as np
+import pandas as pd
+try:
+    import utilities
+    from primer_match import IUPAC_CODES
+except ModuleNotFoundError: # imported as helper_scripts.primer_index
+    from helper_scripts import utilities
+    from helper_scripts.primer_match import IUPAC_CODES
+
+# the automaton alphabet: A, C, G, T and anything else (N, padding...), which never matches a primer base
+BASES = 'ACGT'
+OTHER = len(BASES)
+SYMBOL_CODES = np.full(256, OTHER, dtype=np.uint8)
+for code, base in enumerate(BASES):
+    SYMBOL_CODES[ord(base)] = SYMBOL_CODES[ord(base.lower())] = code
+
+
+class PrimerIndex:
+    '''
+    Aho-Corasick index of all the primer pairs of an oligo file, to find which primer pair(s) and strand
+    each read belongs to, in a single linear scan of the reads (instead of one search per primer).
+
+    Each primer pair gives 4 patterns: on the '+' strand the forward primer (head) and the reverse complemented
+    reverse primer (tail), on the '-' strand the reverse primer (head) and the reverse complemented forward primer
+    (tail). The IUPAC codes of the primers are expanded into the transitions of the automaton (the trie branches
+    at each degenerate position and its expansions share their prefixes), which is then completed into a
+    (state x base) transition table, so a batch of reads is scanned one position at a time for all the reads at once.
+
+    Only numpy arrays and lists are kept, so the index is picklable (i.e. can be passed to a process pool).
+    '''
+
+    def __init__(self, primers):
+        '''
+        Parameters
+        ----------
+        primers: utilities.Primers of the oligo file ({name: [forward primer, reverse complemented reverse primer]})
+        '''
+        self.names = list(primers.pseqs)
+        patterns = []
+        for pair, name in enumerate(self.names):
+            forward, rc_reverse = (primer.strip().upper() for primer in primers.pseqs[name])
+            patterns += [(pair, '+', 'head', forward), (pair, '+', 'tail', rc_reverse),
+                         (pair, '-', 'head', utilities.revcomp(rc_reverse)), (pair, '-', 'tail', utilities.revcomp(forward))]
+        self.pattern_pair = np.array([pattern[0] for pattern in patterns], dtype=np.int64)
+        self.pattern_strand = np.array([pattern[1] for pattern in patterns], dtype=object)
+        self.pattern_role = np.array([pattern[2] for pattern in patterns], dtype=object)
+        self.pattern_len = np.array([len(pattern[3]) for pattern in patterns], dtype=np.int64)
+        self.build([pattern[3] for pattern in patterns])
+
+    @classmethod
+    def from_oligo_file(cls, oligo_file):
+        return cls(utilities.Primers(oligo_file))
+
+    def build(self, patterns):
+        '''
+        This method builds the automaton of the patterns: the trie (with the IUPAC codes expanded), the failure links,
+        and then the complete transition table (delta) and the patterns ending at each state (out_ptr/out_ids, CSR style)
+        '''
+        children = [{}]
+        outputs = [[]]
+        for pattern_id, pattern in enumerate(patterns):
+            nodes = [0]
+            for code in pattern:
+                next_nodes = []
+                for node in nodes:
+                    for base in IUPAC_CODES.get(code, code):
+                        if base not in BASES:
+                            continue
+                        symbol = BASES.index(base)
+                        if symbol not in children[node]:
+                            children[node][symbol] = len(children)
+                            children.append({})
+                            outputs.append([])
+                        next_nodes.append(children[node][symbol])
+                nodes = list(dict.fromkeys(next_nodes))
+            for node in nodes:
+                if node:
+                    outputs[node].append(pattern_id)
+
+        delta = np.zeros((len(children), OTHER + 1), dtype=np.int32)
+        fail = [0] * len(children)
+        queue = deque()
+        for symbol in range(OTHER):
+            child = children[0].get(symbol)
+            if child is not None:
+                delta[0, symbol] = child
+                queue.append(child)
+        while queue:
+            node = queue.popleft()
+            # a state also reports the patterns of its failure state (the suffixes of its string)
+            outputs[node] += outputs[fail[node]]
+            for symbol in range(OTHER):
+                child = children[node].get(symbol)
+                if child is None:
+                    delta[node, symbol] = delta[fail[node], symbol]
+                else:
+                    fail[child] = delta[fail[node], symbol]
+                    delta[node, symbol] = child
+                    queue.append(child)
+
+        self.delta = delta
+        self.out_ptr = np.cumsum([0] + [len(out) for out in outputs]).astype(np.int64)
+        self.out_ids = np.array([pattern_id for out in outputs for pattern_id in out], dtype=np.int64)
+
+    @staticmethod
+    def encode(reads):
+        '''
+        This method converts a batch of reads into the (read x position) array of the automaton symbols
+
+        Parameters
+        ----------
+        reads: a list of sequences (str, bytes or memoryview, see seq_reader.read_batches),
+               or a 2D uint8 array of ASCII bytes (one read per row, 0 padded)
+
+        Returns a 2D uint8 array
+        '''
+        if not isinstance(reads, np.ndarray) or reads.dtype != np.uint8:
+            reads = np.array([read.encode() if isinstance(read, str) else bytes(read) for read in reads], dtype=bytes)
+            reads = reads.view(np.uint8).reshape(len(reads), reads.dtype.itemsize)
+        return SYMBOL_CODES[reads]
+
+    def scan(self, reads):
+        '''
+        This method finds all the primer occurrences in a batch of reads
+
+        Parameters
+        ----------
+        reads: a list of sequences, or a 2D uint8 array of ASCII bytes (see encode)
+
+        Returns
+        -------
+        a dataframe with one row per occurrence: read (position in the batch), pattern, end (in the read)
+        '''
+        symbols = self.encode(reads)
+        matches = np.diff(self.out_ptr) > 0
+        states = np.zeros(len(symbols), dtype=np.int32)
+        found_reads, found_states, found_ends = [], [], []
+        for position in range(symbols.shape[1]):
+            states = self.delta[states, symbols[:, position]]
+            hit = np.flatnonzero(matches[states])
+            if len(hit):
+                found_reads.append(hit)
+                found_states.append(states[hit])
+                found_ends.append(np.full(len(hit), position + 1, dtype=np.int64))
+
+        found_states = np.concatenate(found_states) if found_states else np.zeros(0, dtype=np.int64)
+        counts = self.out_ptr[found_states + 1] - self.out_ptr[found_states]
+        # the patterns of each found state, one row per pattern
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return pd.DataFrame({'read': np.repeat(np.concatenate(found_reads) if found_reads else found_states, counts),
+                             'pattern': self.out_ids[np.repeat(self.out_ptr[found_states], counts) + offsets],
+                             'end': np.repeat(np.concatenate(found_ends) if found_ends else found_states, counts)})
+
+    def assign(self, reads, both=True, min_gap=0):
+        '''
+        This method assigns each read of a batch to its primer pair(s) and strand
+
+        Parameters
+        ----------
+        reads: a list of sequences, or a 2D uint8 array of ASCII bytes (see encode)
+        both: if True, the read must have the head primer, then (at least min_gap bases further) the tail primer
+              of the pair, otherwise any of them is enough
+        min_gap: the minimum number of bases between the head and the tail primers
+
+        Returns
+        -------
+        a list (one item per read) of the lists of (primer name, strand)
+        '''
+        hits = self.scan(reads)
+        pattern = hits['pattern'].to_numpy()
+        hits = hits.assign(pair=self.pattern_pair[pattern], strand=self.pattern_strand[pattern],
+                           role=self.pattern_role[pattern], start=hits['end'].to_numpy() - self.pattern_len[pattern])
+        keys = ['read', 'pair', 'strand']
+        if both:
+            head = hits[hits['role'] == 'head'].groupby(keys)['end'].min()
+            tail = hits[hits['role'] == 'tail'].groupby(keys)['start'].max()
+            pairs = pd.concat([head, tail], axis=1, join='inner')
+            pairs = pairs[pairs['start'] - pairs['end'] >= min_gap].reset_index()
+        else:
+            pairs = hits.drop_duplicates(keys)
+
+        assigned = [[] for _ in range(len(reads))]
+        for read, pair, strand in pairs.sort_values(keys)[keys].itertuples(index=False):
+            assigned[read].append((self.names[pair], strand))
+        return assigned
+
+
+if __name__ == "__main__":
+    print("This module is called by pipeline.py.  Please run pipeline.py --help for more information")
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+from functools import lru_cache
+
+# the bases each IUPAC code of a (degenerate) primer stands for
+IUPAC_CODES = {'A':'A', 'C':'C', 'G':'G', 'T':'T', 'U':'T',
+               'Y':'CT', 'R':'AG', 'W':'AT', 'S':'CG', 'K':'TG', 'M':'AC',
+               'D':'AGT', 'V':'ACG', 'H':'ACT', 'B':'CGT', 'N':'ACGT'}
+
+
+class PrimerMatch:
+    '''
+    a match of a primer in a sequence: seq[start:end], with its number of errors (edit distance).
+    group() returns the matched part of the sequence, like a regex match object
+    '''
+
+    def __init__(self, seq, start, end, errors):
+        self.seq = seq
+        self.start = start
+        self.end = end
+        self.errors = errors
+
+    def group(self):
+        return self.seq[self.start:self.end]
+
+    def span(self):
+        return self.start, self.end
+
+
+class PrimerMatcher:
+    '''
+    Approximate matcher of a degenerate (IUPAC coded) primer, allowing up to max_errors
+    substitutions, insertions or deletions.
+
+    The primer is compiled once into one bit mask per base (bit i is set if the base is allowed at position i),
+    and a sequence is scanned with Myers' bit-parallel algorithm: a whole column of the edit distance matrix
+    is updated with a few integer operations per base of the sequence, whatever the number of ambiguity codes
+    (the concrete sequences of the primer are never enumerated).
+    '''
+
+    def __init__(self, primer, max_errors=3):
+        self.primer = primer.strip().upper()
+        self.max_errors = max_errors
+        self.length = len(self.primer)
+        self.mask = (1 << self.length) - 1
+        self.high_bit = 1 << (self.length - 1) if self.length else 0
+
+        self.peq = {}
+        for i, code in enumerate(self.primer):
+            for base in IUPAC_CODES.get(code, code):
+                self.peq[base] = self.peq.get(base, 0) | (1 << i)
+        for base in list(self.peq):
+            self.peq[base.lower()] = self.peq[base]
+
+    def allowed(self, code, base):
+        '''
+        True if the base of a sequence is allowed by the IUPAC code of the primer
+        '''
+        return base.upper() in IUPAC_CODES.get(code, code)
+
+    def search_end(self, seq):
+        '''
+        This method scans the sequence for the first position where the primer ends with at most max_errors errors
+
+        Parameters
+        ----------
+        seq: the sequence (str)
+
+        Returns
+        -------
+        (end, errors): seq[:end] is the first prefix of seq with a match ending at its end, or None if not found
+        '''
+        if self.length <= self.max_errors:
+            return (0, self.length) if self.length else (0, 0)
+
+        mask, high_bit, peq = self.mask, self.high_bit, self.peq
+        pv, mv, score = mask, 0, self.length
+        for j, base in enumerate(seq):
+            eq = peq.get(base, 0)
+            xv = eq | mv
+            xh = (((eq & pv) + pv) ^ pv) | eq
+            ph = mv | (~(xh | pv) & mask)
+            mh = pv & xh
+            if ph & high_bit:
+                score += 1
+            elif mh & high_bit:
+                score -= 1
+            ph = (ph << 1) & mask
+            mh = (mh << 1) & mask
+            pv = mh | (~(xv | ph) & mask)
+            mv = ph & xv
+            if score <= self.max_errors:
+                return j + 1, score
+        return None
+
+    def search_start(self, seq, end):
+        '''
+        This method aligns the whole primer against the sequence ending at end (a small dynamic programming
+        over the last len(primer) + max_errors bases only), and returns where the best alignment starts
+        '''
+        offset = max(0, end - self.length - self.max_errors)
+        window = seq[offset:end]
+        # each cell holds (errors, start in window) of the best alignment of primer[:i] ending at window[:j]
+        previous = [(0, j) for j in range(len(window) + 1)]
+        for i, code in enumerate(self.primer, start=1):
+            current = [(i, 0)]
+            for j, base in enumerate(window, start=1):
+                diagonal = previous[j - 1]
+                current.append(min((diagonal[0] + (not self.allowed(code, base)), diagonal[1]),
+                                   (previous[j][0] + 1, previous[j][1]),
+                                   (current[j - 1][0] + 1, current[j - 1][1]),
+                                   key=lambda cell: cell[0]))
+            previous = current
+        return offset + previous[-1][1]
+
+    def search(self, seq):
+        '''
+        This method finds the first approximate match of the primer in the sequence
+
+        Parameters
+        ----------
+        seq: the sequence (str)
+
+        Returns
+        -------
+        a PrimerMatch, or None if not found
+        '''
+        found = self.search_end(seq)
+        if found is None:
+            return None
+        end, errors = found
+        return PrimerMatch(seq, self.search_start(seq, end), end, errors)
+
+
+@lru_cache(maxsize=None)
+def get_matcher(primer, max_errors=3):
+    '''
+    returns the (compiled once) PrimerMatcher of a primer
+    '''
+    return PrimerMatcher(primer, max_errors)
+
+
+if __name__ == "__main__":
+    print("This module is called by check_primer.py.  Please run check_primer.py --help for more information")
@@ -1,7 +1,35 @@
 #!/usr/bin/env python3
 
-import os, sys, shutil, subprocess
+import os, sys, shutil, subprocess, tempfile, hashlib, sqlite3
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+try:
+    import fcntl
+except ImportError: # no file locking on Windows, the atomic publish (rename) still holds
+    fcntl = None
+try:
+    from checkpoint import file_digest
+    from utilities import revcomp
+    from seq_reader import read_records
+except ModuleNotFoundError: # imported as helper_scripts.run_blast (i.e. by parse_count_table_confusion_matrix.py)
+    from helper_scripts.checkpoint import file_digest
+    from helper_scripts.utilities import revcomp
+    from helper_scripts.seq_reader import read_records
+
+# the Blast databases are cached by the content (sha256) of their reference fasta in this folder,
+# which can be set with the HMAS_BLAST_DB_CACHE environment variable
+BLAST_DB_CACHE = os.environ.get('HMAS_BLAST_DB_CACHE', os.path.join('~', '.cache', 'hmas_qc_pipeline', 'blast_db'))
+
+# the blast hits of each query sequence are cached (across runs) in this sqlite file,
+# which can be set with the HMAS_BLAST_HIT_CACHE environment variable
+BLAST_HIT_CACHE = os.environ.get('HMAS_BLAST_HIT_CACHE', os.path.join('~', '.cache', 'hmas_qc_pipeline', 'blast_hits.sqlite'))
+
+# number of query shards blasted concurrently by run_blast_sharded (HMAS_BLAST_SHARDS environment variable)
+BLAST_SHARDS = int(os.environ.get('HMAS_BLAST_SHARDS', os.cpu_count() or 1))
+# the tabular (outfmt 6) blast output, and the type of each of its fields
+BLAST_OUTFMT = '6 qseqid sseqid qlen slen length evalue qcovs pident mismatch'
+BLAST_TYPES = (str, str, int, int, int, float, int, float, int)
 
 """
 This script is mostly from the blast portion of hmas_validation.py by Jessica Rowell
@@ -119,13 +147,468 @@ def run_blast(db, fasta, outfile, blastn, maxhits=10):
             "format: query ID, subject ID, query length, subj length, e val, query cov/subj, percent identical matches, # mismatches")
         return blast_out
 
-def blast(q_fasta, r_fasta, out_file, max_hits):
+def amplicon_self_hits(r_fasta, db, blastn, maxhits=10):
+    """Blasts the reference amplicons, and their reverse complements, against their own database (db),
+    with the same blastn output parameters as the queries (see blast_params). This is done once per database
+    and maxhits: the hits are saved next to the database, as <db>.self_hits_<maxhits>.tsv
+    (or only kept in memory if that folder is read only).
 
-    query_fasta = file_exists(q_fasta)
-    reference_fasta = file_exists(r_fasta)
+    Params
+    ------
+    r_fasta: String
+        Path to reference amplicon set (the fasta of db)
+
+    db: String
+        Path to reference blast database
+
+    Returns
+    ------
+    rows: dictionary
+        {amplicon sequence (upper case, either strand): list of its BLAST_OUTFMT lines, without the query id}
+    """
+    sequences = set()
+    for record in read_records(r_fasta):
+        seq = record.seq.upper()
+        if seq:
+            sequences.update((seq, revcomp(seq)))
+    rows = {seq: [] for seq in sequences}
+
+    hits_file = f"{db}.self_hits_{maxhits}.tsv"
+
+    def read_rows():
+        with open(hits_file, 'r') as f:
+            for line in f:
+                seq, _, fields = line.rstrip('\n').partition('\t')
+                if seq in rows:
+                    rows[seq].append(fields)
+        return rows
+
+    if os.path.isfile(hits_file):
+        return read_rows()
+    try: # concurrent workers blast the amplicons only once (no lock in a read only database folder)
+        lock = open(f"{hits_file}.lock", 'w')
+    except OSError:
+        lock = None
+    try:
+        if lock is not None and fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.isfile(hits_file): # written by another worker while we waited for the lock
+            return read_rows()
+        return blast_amplicons(r_fasta, db, blastn, maxhits, rows, hits_file)
+    finally:
+        if lock is not None:
+            lock.close()
+
+def blast_amplicons(r_fasta, db, blastn, maxhits, rows, hits_file):
+    """Blasts the sequences of rows (see amplicon_self_hits), adds their hits to rows and saves them in hits_file
+    """
+    queries = sorted(rows)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        query_fasta = os.path.join(tmp_dir, 'amplicons.fasta')
+        with open(query_fasta, 'w') as f:
+            f.writelines(f">{i}\n{seq}\n" for i, seq in enumerate(queries))
+        raw_out = os.path.join(tmp_dir, 'amplicons_blast.out')
+        p = subprocess.run([blastn, '-db', db, '-query', query_fasta, '-out', raw_out] + blast_params(maxhits)
+                           + ['-num_threads', str(BLAST_SHARDS)])
+        if p.returncode != 0:
+            raise RuntimeError(f"blastn failed on the amplicons of {r_fasta}, return_code={p.returncode}")
+        lines = []
+        with open(raw_out, 'r') as f:
+            for line in f:
+                qseqid, _, fields = line.rstrip('\n').partition('\t')
+                rows[queries[int(qseqid)]].append(fields)
+                lines.append(f"{queries[int(qseqid)]}\t{fields}\n")
+
+    try:
+        # written atomically (unique temp file, then renamed), so a reader never sees half of it
+        fd, tmp_file = tempfile.mkstemp(prefix=f"{os.path.basename(hits_file)}.", dir=os.path.dirname(os.path.abspath(hits_file)))
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(lines)
+        os.replace(tmp_file, hits_file)
+    except OSError: # i.e. a read only database folder
+        pass
+    return rows
+
+class AmpliconIndex:
+    """In memory index of the blast hits of the reference amplicons (see amplicon_self_hits), to resolve
+    the queries identical to an amplicon without BLAST.
+
+    A query identical to an amplicon, or to its reverse complement, gets the hits of that sequence with its
+    own query id: identical sequences have identical hits, so its imperfect hits (i.e. to the amplicons of
+    the other isolates) are kept too, as if it had been blasted.
+    """
+
+    def __init__(self, r_fasta, db, blastn, maxhits=10):
+        self.fname = r_fasta
+        self.maxhits = maxhits
+        self.index = amplicon_self_hits(r_fasta, db, blastn, maxhits)
+
+    def hits(self, record):
+        """Returns the BLAST_OUTFMT lines of a fasta record (list of its lines) which is identical to
+        an amplicon (either strand), None otherwise
+        """
+        rows = self.index.get(''.join(line.strip() for line in record[1:]).upper())
+        if rows is None:
+            return None
+        qseqid = record[0][1:].split()[0]
+        return [f"{qseqid}\t{row}\n" for row in rows]
+
+class BlastCache:
+    """On disk (sqlite) cache of the blast hits of each query sequence, so that the sequences seen in
+    previous runs are not blasted again. The hits (BLAST_OUTFMT rows, without the query id) are keyed by
+    the sha256 of the query sequence, the sha256 of the reference fasta and the blast parameters.
+    A sequence without any hit is cached too (no rows).
+
+    lookup() returns the cached rows of a fasta record and remembers the records which are not cached,
+    store() then caches the blast output of those records.
+    """
+
+    def __init__(self, reference, params, cache_file=None):
+        cache_file = os.path.expanduser(cache_file or BLAST_HIT_CACHE)
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+        self.reference = file_digest(reference)
+        self.params = params
+        self.pending = dict()
+        # several workers (processes) can share the cache: wait for each other's writes
+        self.conn = sqlite3.connect(cache_file, timeout=600)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS hits (query TEXT, reference TEXT, params TEXT, rows TEXT,"
+                          " PRIMARY KEY (query, reference, params))")
+
+    def lookup(self, record):
+        """Returns the BLAST_OUTFMT lines of a fasta record (list of its lines) from the cache, or None
+        """
+        qseqid = record[0][1:].split()[0]
+        query = hashlib.sha256(''.join(line.strip() for line in record[1:]).upper().encode()).hexdigest()
+        row = self.conn.execute("SELECT rows FROM hits WHERE query=? AND reference=? AND params=?",
+                                (query, self.reference, self.params)).fetchone()
+        if row is None:
+            self.pending[qseqid] = query
+            return None
+        return [f"{qseqid}\t{line}\n" for line in row[0].split('\n') if line]
+
+    def store(self, raw_files):
+        """Caches the hits of the records which were not in the cache, from the raw blast output files
+        """
+        rows = {qseqid: [] for qseqid in self.pending}
+        for raw_file in raw_files:
+            with open(raw_file, 'r') as raw_out:
+                for line in raw_out:
+                    qseqid, _, fields = line.rstrip('\n').partition('\t')
+                    if qseqid in rows:
+                        rows[qseqid].append(fields)
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO hits VALUES (?, ?, ?, ?)",
+                                  [(self.pending[qseqid], self.reference, self.params, '\n'.join(lines))
+                                   for qseqid, lines in rows.items()])
+        self.pending = dict()
+
+    def close(self):
+        self.conn.close()
+
+def shard_fasta(fasta, shards, out_dir, resolve=None, resolved_out=None):
+    """Splits a fasta file into (at most) `shards` fasta files of about the same total sequence length.
+    The records are streamed, each one going to the shard with the least sequence so far.
+    The records whose hits are already known (resolve, i.e. hits of an identical amplicon in an AmpliconIndex
+    or hits in a BlastCache) are not sharded: their hits are written (in BLAST_OUTFMT) to resolved_out instead.
+
+    Params
+    ------
+    fasta: String
+        Path to the fasta file
+
+    shards: int
+        Number of shards
+
+    out_dir: String
+        Folder of the shard files
+
+    resolve: function
+        Returns the BLAST_OUTFMT lines of a record (list of its lines) when they are known, None otherwise (optional)
+
+    resolved_out: file object
+        Where the known hits are written
+
+    Returns
+    ------
+    shard_files: list
+        Names of the (non empty) shard files
+    """
+    files, sizes = {}, [0] * max(1, shards)
+
+    def write_record(record, seq_len):
+        if resolve is not None:
+            hits = resolve(record)
+            if hits is not None:
+                resolved_out.writelines(hits)
+                return
+        shard = sizes.index(min(sizes))
+        sizes[shard] += seq_len
+        if shard not in files:
+            files[shard] = open(os.path.join(out_dir, f"shard_{shard}.fasta"), 'w')
+        files[shard].writelines(record)
+
+    try:
+        record, seq_len = [], 0
+        with open(fasta, 'r') as infile:
+            for line in infile:
+                if line.startswith('>') and record:
+                    write_record(record, seq_len)
+                    record, seq_len = [], 0
+                record.append(line)
+                if not line.startswith('>'):
+                    seq_len += len(line.strip())
+        if record:
+            write_record(record, seq_len)
+    finally:
+        for f in files.values():
+            f.close()
+
+    return [files[shard].name for shard in sorted(files)]
+
+def hit_filter(pident=None, pcov=None, p_align=None):
+    """Builds the filter of the blast hits (rows typed as BLAST_TYPES): percent identity >= pident,
+    query coverage >= pcov and alignment length / subject length >= p_align (None: no threshold)
+    """
+    def keep(row):
+        return ((pident is None or row[7] >= pident) and
+                (pcov is None or row[6] >= pcov) and
+                (p_align is None or row[4]/row[3] >= p_align))
+    return keep
+
+def blast_params(maxhits):
+    """The blastn parameters which determine its output (also part of the BlastCache key)
+    """
+    return ['-outfmt', BLAST_OUTFMT, '-max_target_seqs', str(maxhits), '-max_hsps', '1']
+
+def read_hits(stream, raw_out, names, keep=None):
+    """Parses the tabular blast output of a running blastn as it is produced, into typed columns.
+    Only the rows passing `keep` are kept (the raw rows are only copied to raw_out).
+
+    Returns
+    ------
+    a dataframe of the kept rows, with the given column names
+    """
+    columns = [[] for _ in names]
+    for line in stream:
+        raw_out.write(line)
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) != len(BLAST_TYPES):
+            continue
+        row = [to_type(field) for to_type, field in zip(BLAST_TYPES, fields)]
+        if keep is None or keep(row):
+            for column, value in zip(columns, row):
+                column.append(value)
+    return pd.DataFrame({name: pd.Series(column, dtype=object if to_type is str else to_type)
+                         for name, column, to_type in zip(names, columns, BLAST_TYPES)})
+
+def run_blast_sharded(db, fasta, outfile, blastn, names, maxhits=10, shards=None, threads=1, keep=None, index=None,
+                      cache=None):
+    """Runs Blast on a fasta against a reference database: the fasta is split into balanced shards
+    (see shard_fasta) which are blasted concurrently (each blastn with -num_threads threads), and the
+    hits are parsed and filtered (keep) as they stream out of each blastn, so that the unfiltered hit
+    table is never held in memory. The raw blast output is still saved, as <outfile>_blast.out
+    With an AmpliconIndex of the reference, the queries identical to an amplicon skip blastn altogether
+    (they get the hits of the amplicon),
+    and with a BlastCache, so do the queries blasted in previous runs (the new ones are then cached).
+
+    Params
+    ------
+    db: String
+        Path to reference blast database
+
+    fasta: String
+        Specify query fasta sequence
 
+    outfile: String
+        Specify output file name
+
+    names: list
+        The column names of the BLAST_OUTFMT fields
+
+    shards: int
+        Number of shards, default is BLAST_SHARDS
+
+    keep: function
+        Filter of the hits, see hit_filter
+
+    index: AmpliconIndex
+        Index of the hits of the reference amplicons, to bypass blastn for the queries identical to one (optional)
+
+    cache: BlastCache
+        Cache of the hits of the query sequences, for this reference and blast parameters (optional)
+
+    Returns
+    ------
+    blast_df: DataFrame
+        The (filtered) blast hits
+    """
+    blast_out = outfile + '_blast.out'
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(blast_out))) as tmp_dir:
+        def resolve(record):
+            # the amplicon hits first, then the cache (None: the record has to be blasted)
+            if index is not None:
+                hits = index.hits(record)
+                if hits is not None:
+                    return hits
+            return cache.lookup(record) if cache is not None else None
+
+        resolved_file = os.path.join(tmp_dir, 'resolved_blast.out')
+        with open(resolved_file, 'w') as resolved_out:
+            shard_files = shard_fasta(fasta, shards or BLAST_SHARDS, tmp_dir, resolve, resolved_out)
+        with open(resolved_file, 'r') as resolved_hits, open(os.devnull, 'w') as raw_out:
+            resolved_df = read_hits(resolved_hits, raw_out, names, keep)
+        print(f"Running blast with {maxhits} maximum hits to generate, on {len(shard_files)} shards"
+              f" ({len(resolved_df)} hits resolved without blast)")
+        procs = [subprocess.Popen([blastn, '-db', db, '-query', shard] + blast_params(maxhits) + ['-num_threads', str(threads)],
+                                  stdout=subprocess.PIPE, text=True) for shard in shard_files]
+
+        def read_shard(i):
+            with open(f"{shard_files[i]}_blast.out", 'w') as raw_out:
+                df = read_hits(procs[i].stdout, raw_out, names, keep)
+            procs[i].stdout.close()
+            return df, procs[i].wait()
+
+        with ThreadPoolExecutor(max_workers=max(1, len(procs))) as executor:
+            results = list(executor.map(read_shard, range(len(procs))))
+
+        for df, returncode in results:
+            if returncode != 0:
+                print("blastn could not be executed.  Error encountered.")
+                print(returncode)
+                raise RuntimeError(f"blastn failed on {fasta}, return_code={returncode}")
+        print("blastn run successfully.")
+        if cache is not None:
+            cache.store([f"{shard}_blast.out" for shard in shard_files])
+
+        with open(blast_out, 'w') as out:
+            for raw_file in [resolved_file] + [f"{shard}_blast.out" for shard in shard_files]:
+                with open(raw_file, 'r') as raw_out:
+                    shutil.copyfileobj(raw_out, out)
+
+    return pd.concat([resolved_df] + [df for df, _ in results], ignore_index=True)
+
+def cached_blast_db(reference, dbtype, makeblastdb, cache_dir=None):
+    """Returns the Blast database of a reference from the cache, building it only if the cache
+    doesn't have it yet. The database is keyed by the sha256 of the reference content (and dbtype), so
+    repeated runs and parallel workers all reuse one prebuilt database, wherever the reference lives.
+
+    The database is built in a temp folder of the cache and published by renaming that folder (atomic),
+    under a lock on <key>.lock so that concurrent workers build it only once. It is always named
+    <key>/db, not after the reference, so a copy of the reference under another name finds it too.
+
+    Params
+    ------
+    reference: String
+        Path to reference amplicon set
+
+    dbtype: String
+        Specify nucleotide or protein database
+
+    cache_dir: String
+        The cache folder, default is BLAST_DB_CACHE
+
+    Returns
+    ------
+    db_name: String
+        Name of the Blast database (None if makeblastdb failed)
+    """
+    cache_dir = os.path.expanduser(cache_dir or BLAST_DB_CACHE)
+    os.makedirs(cache_dir, exist_ok=True)
+    key = f"{file_digest(reference)}.{dbtype}"
+    db_dir = os.path.join(cache_dir, key)
+    db_name = os.path.join(db_dir, 'db')
+    if os.path.isdir(db_dir):
+        return db_name
+
+    with open(os.path.join(cache_dir, f"{key}.lock"), 'w') as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.isdir(db_dir): # built by another worker while we waited for the lock
+            return db_name
+
+        tmp_dir = tempfile.mkdtemp(prefix=f"{key}.", dir=cache_dir)
+        try:
+            # make_blast_db names the database (-out) after the reference without its extension, i.e. db
+            tmp_reference = os.path.join(tmp_dir, 'db.fasta')
+            os.symlink(os.path.abspath(reference), tmp_reference)
+            if make_blast_db(tmp_reference, dbtype, makeblastdb) is None:
+                return None
+            os.remove(tmp_reference)
+            try:
+                os.rename(tmp_dir, db_dir)
+            except OSError: # published by a worker without the lock (no fcntl)
+                if not os.path.isdir(db_dir):
+                    raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return db_name
+
+def build_blast_db(r_fasta, cache_dir=None):
+    """Gets the nucleotide Blast database of a reference fasta from the cache (see cached_blast_db),
+    so that it can be shared (read only) by many blast runs: blast(..., db=build_blast_db(r_fasta))
+
+    Params
+    ------
+    r_fasta: String
+        Path to reference amplicon set
+
+    cache_dir: String
+        The cache folder, default is BLAST_DB_CACHE
+
+    Returns
+    ------
+    db_name: String
+        Name of the Blast database
+    """
+    reference_fasta = file_exists(r_fasta)
     path_to_makeblastdb = cmd_exists('makeblastdb')
+
+    return cached_blast_db(reference_fasta, 'nucl', path_to_makeblastdb, cache_dir)
+
+def blast(q_fasta, r_fasta, out_file, max_hits, db=None):
+
+    query_fasta = file_exists(q_fasta)
+    path_to_blastn = cmd_exists('blastn')
+
+    # the database comes from the cache (built only once per reference content), see cached_blast_db
+    if db is None:
+        db = build_blast_db(r_fasta)
+    return run_blast(db, query_fasta, out_file, path_to_blastn, max_hits)
+
+# AmpliconIndex of the reference fasta files, see get_amplicon_index
+amplicon_indexes = {}
+
+def get_amplicon_index(r_fasta, db, blastn, maxhits=10):
+    """Returns the AmpliconIndex of a reference fasta (and its database), built once per process
+    (and per version of the file)
+    """
+    st = os.stat(r_fasta)
+    key = (os.path.abspath(r_fasta), st.st_size, st.st_mtime, db, maxhits)
+    if key not in amplicon_indexes:
+        amplicon_indexes[key] = AmpliconIndex(r_fasta, db, blastn, maxhits)
+    return amplicon_indexes[key]
+
+def blast_table(q_fasta, r_fasta, out_file, max_hits, names, db=None, pident=None, pcov=None, p_align=None,
+                shards=None, threads=1, exact=False, cache=False):
+    """Same as blast(), but the query is blasted in concurrent shards and the hits are returned as a dataframe,
+    filtered on pident/pcov/p_align as they are produced (see run_blast_sharded and hit_filter).
+
+    With exact=True, the queries identical to a reference amplicon (either strand) get the hits of that amplicon
+    from the AmpliconIndex of r_fasta instead of running blastn (the amplicons are blasted once per database).
+    With cache=True, the hits of the query sequences are cached across runs (see BlastCache),
+    and only the sequences which are not in the cache yet are blasted.
+    """
+    query_fasta = file_exists(q_fasta)
     path_to_blastn = cmd_exists('blastn')
 
-    db = make_blast_db(reference_fasta, 'nucl', path_to_makeblastdb)
-    return run_blast(db, query_fasta, out_file, path_to_blastn, max_hits)
\ No newline at end of file
+    if db is None:
+        db = build_blast_db(r_fasta)
+    index = get_amplicon_index(file_exists(r_fasta), db, path_to_blastn, max_hits) if exact else None
+    hit_cache = BlastCache(file_exists(r_fasta), ' '.join(blast_params(max_hits))) if cache else None
+    try:
+        return run_blast_sharded(db, query_fasta, out_file, path_to_blastn, names, max_hits, shards, threads,
+                                 hit_filter(pident, pcov, p_align), index, hit_cache)
+    finally:
+        if hit_cache is not None:
+            hit_cache.close()
\ No newline at end of file
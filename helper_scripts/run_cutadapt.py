@@ -2,11 +2,22 @@
 import sys, os, shutil, subprocess, argparse
 import glob
 import re
+import time
+import logging
 from collections import deque
 from datetime import datetime
 import concurrent.futures
 import utilities
 
+try: # run cutadapt in-process if it's importable, this saves the start up time of 2461 cutadapt processes
+	from cutadapt.__main__ import main as cutadapt_main
+except ImportError:
+	cutadapt_main = None
+
+# number of tasks per worker process, the split fasta files are balanced (by size) among the tasks
+TASKS_PER_PROCESS = 4
+PRIMER_REPORT = 'cutadapt_primer_report.tsv'
+
 def cmd_exists(command):
 	"""Checks for existence of a command on user's path
 
@@ -43,12 +54,143 @@ def run_cutadapt(command):
 	else:
 		print (f"{datetime.now()}   done with {command[len(command)-1]}")
 
+def count_fasta_records(fasta):
+	'''
+	count the number of sequences in a fasta file
+	'''
+	if not os.path.isfile(fasta):
+		return 0
+	with open(fasta, 'rb') as f:
+		return sum(1 for line in f if line.startswith(b'>'))
+
+def index_split_files(output_dir, primers):
+	"""
+	scan the output directory once and map each primer to its split.groups fasta file
+	({fasta_root}.{primer}.fasta), in place of a glob over the directory for every primer
+
+	Params
+	------
+	output_dir: String
+		the directory holding the split fasta files
+	primers: Primers object
+
+	Returns
+	------
+	a dictionary of primer:split fasta file
+
+	"""
+	split_files = {}
+	with os.scandir(output_dir) as entries:
+		for entry in entries:
+			if entry.name.endswith('.fasta') and entry.is_file():
+				key = entry.name[:-len('.fasta')].rsplit('.', 1)[-1]
+				if key in primers.pseqs and key not in split_files:
+					split_files[key] = entry.path
+	return split_files
+
+def make_tasks(commands, num_tasks):
+	'''
+	distribute the cutadapt commands into num_tasks lists of about the same total input size
+	(largest input first, each to the currently smallest task)
+	'''
+	tasks = [[] for i in range(max(1, min(num_tasks, len(commands))))]
+	task_sizes = [0] * len(tasks)
+	for key, command in sorted(commands, key=lambda c: os.path.getsize(c[1][-1]), reverse=True):
+		i = task_sizes.index(min(task_sizes))
+		tasks[i].append((key, command))
+		task_sizes[i] += os.path.getsize(command[-1])
+	return tasks
+
+def reset_logging(handlers):
+	'''
+	remove (and close) the handlers of the root logger which are not in handlers: cutadapt's main adds its own
+	handler at each call, so they would pile up (and each message be logged many times) in a worker process
+	'''
+	root = logging.getLogger()
+	for handler in root.handlers[:]:
+		if handler not in handlers:
+			root.removeHandler(handler)
+			handler.close()
+
+def run_cutadapt_task(task):
+	"""
+	run a list of cutadapt commands one after another in the same worker process,
+	timing each command and counting the reads it took in and wrote out
+	(the logging handlers added by an in-process cutadapt run are removed after it)
+
+	Params
+	------
+	task: list of (primer, command) tuples
+
+	Returns
+	------
+	a list of (primer, seconds, reads in, reads out, output file) tuples
+
+	"""
+	report = []
+	for key, command in task:
+		start = time.perf_counter()
+		if cutadapt_main:
+			handlers = logging.getLogger().handlers[:]
+			try:
+				cutadapt_main(['--quiet'] + command[1:])
+			except SystemExit as e:
+				print(f"cutadapt could not be executed.  Error encountered.")
+				print(e.code)
+			finally:
+				reset_logging(handlers)
+		else:
+			run_cutadapt(command)
+		report.append((key, round(time.perf_counter() - start, 3),
+					   count_fasta_records(command[-1]), count_fasta_records(command[-2]), command[-2]))
+	return report
+
+def append_file(src, wfd):
+	'''
+	append the content of file src to the (unbuffered) file object wfd, with a kernel side copy
+	(copy_file_range, or sendfile) if the platform supports it, otherwise a regular buffered copy.
+	Both file positions advance as we copy, so each fallback picks up where the previous method stopped
+	'''
+	with open(src, 'rb') as rfd:
+		remaining = os.fstat(rfd.fileno()).st_size
+		if hasattr(os, 'copy_file_range'):
+			try:
+				while remaining > 0:
+					copied = os.copy_file_range(rfd.fileno(), wfd.fileno(), remaining)
+					if copied == 0:
+						break
+					remaining -= copied
+				return
+			except OSError: # i.e. file systems without copy_file_range support
+				pass
+		if hasattr(os, 'sendfile'):
+			try:
+				while remaining > 0:
+					copied = os.sendfile(wfd.fileno(), rfd.fileno(), None, remaining)
+					if copied == 0:
+						break
+					remaining -= copied
+				return
+			except OSError:
+				pass
+		shutil.copyfileobj(rfd, wfd)
+
+def merge_task_outputs(report, wfd):
+	'''
+	append the cutadapt outputs of a finished task to the merged fasta, and delete them
+	'''
+	for key, seconds, reads_in, reads_out, cutadapt_file in report:
+		if os.path.isfile(cutadapt_file):
+			append_file(cutadapt_file, wfd)
+			os.remove(cutadapt_file)
+
 def run_cutadapt_mothur(config, new_fasta, num_process):
 	"""
 	run cutadapt to remove primers in the middle of a Mothur run.
 	It is customized to run after the split.groups command and use cutadapt to remove primers in 
-	a multi-process fashion. After the cutadapt part is done, it will also merge all fasta files 
-	into a 'new_fasta' fasta file
+	a multi-process fashion. The outputs of each task of cutadapt commands are appended to the 'new_fasta'
+	fasta file (and deleted) in the order the tasks were submitted, as soon as the task and all the tasks
+	before it are done, so the merged fasta has the same record order from run to run
 	*** split.groups will split the original fasta file based on primer groups
 	*** cutadapt will run on each of those smaller fasta file
 
@@ -63,36 +205,49 @@ def run_cutadapt_mothur(config, new_fasta, num_process):
 	num-process: int
 		designated number of process to run the script
 
+	Returns
+	------
+	the name of the merged fasta file
+
 	"""
 
 	#1. prep for cutadapt commands
+	output_dir = os.path.expanduser(config['file_inputs']['output_dir'])
 	cutadapt_commands = deque()
 	primers = utilities.Primers(os.path.expanduser(config['file_inputs']['oligos']))
 	cutadapt_cmd = cmd_exists('cutadapt')
+	split_files = index_split_files(output_dir, primers)
 	for key in primers.pseqs:
-		for current_file in glob.glob(rf"{os.path.expanduser(config['file_inputs']['output_dir'])}/*{key}.fasta"):
+		if key in split_files:
+			current_file = split_files[key]
 			# cutadapt_commands.append([cutadapt_cmd, f'--info-file={primers.pseqs[key][0]}_info.tsv', '-g', \
-			cutadapt_commands.append([cutadapt_cmd, '-g', \
+			cutadapt_commands.append((key, [cutadapt_cmd, '-g', \
 				f'{primers.pseqs[key][0]}...{primers.pseqs[key][1]}', '-o', \
 				f'{current_file}_cutadapt', \
-				f'{current_file}'])
-			break
+				f'{current_file}']))
 	print(datetime.now())
 	print(len(cutadapt_commands))
 
 
-	#2. run cutadapt 
-	with concurrent.futures.ProcessPoolExecutor(max_workers=num_process) as executor:
-		executor.map(run_cutadapt, cutadapt_commands)
+	#2. run cutadapt, many primers per task
+	#3. merge the fastas of each task as soon as it's done, in the task order (unique.seqs picks its
+	#   representative sequences by record order, so the merged fasta must not depend on the timing of the tasks)
+	primer_report = []
+	with open(new_fasta, 'wb', buffering=0) as wfd:
+		with concurrent.futures.ProcessPoolExecutor(max_workers=num_process) as executor:
+			futures = [executor.submit(run_cutadapt_task, task)
+					   for task in make_tasks(cutadapt_commands, num_process * TASKS_PER_PROCESS)]
+			for future in futures:
+				report = future.result()
+				merge_task_outputs(report, wfd)
+				primer_report.extend(report)
+
+	with open(f'{output_dir}/{PRIMER_REPORT}', 'w') as f:
+		f.write('primer\tseconds\treads_in\treads_out\n')
+		for row in sorted(primer_report):
+			f.write('\t'.join(map(str, row[:4])) + '\n')
 
 	print(datetime.now()) 
-	print(f"done with cutadapt")
-
-	#3. merge all fastas 
-	with open(new_fasta,'wb') as wfd:
-		for f in glob.glob(rf"{os.path.expanduser(config['file_inputs']['output_dir'])}/*_cutadapt"):
-			with open(f,'rb') as fd:
-				shutil.copyfileobj(fd, wfd)
+	print(f"done with cutadapt and merging files, per primer report in {output_dir}/{PRIMER_REPORT}")
 
-	print(datetime.now()) 
-	print(f"done with merging files")
\ No newline at end of file
+	return new_fasta
\ No newline at end of file
@@ -7,6 +7,8 @@ import pandas as pd
 import logging
 import settings
 import utilities
+from primer_index import PrimerIndex
+from seq_reader import read_batches, read_records
 
 sys.path.insert(0,r'..') # to allow import packages in parent folder
 import group
@@ -50,6 +52,22 @@ def exec_grep(command):
 		print (f"{command[2]} no matches")
 	return int(process.stdout)
 
+
+# this method counts, for every primer of the oligos file, the reads of the fasta file
+# which have its forward primer, then at least min_gap bases, then its reverse complemented reverse primer
+# (the same as the grep commands of get_grep_commands_oligo, but for all the primers in one pass over the fasta file)
+def count_primer_reads(oligos, fasta, min_gap=50, batch_size=100000):
+
+	index = PrimerIndex.from_oligo_file(oligos)
+	counts = dict.fromkeys(index.names, 0)
+
+	for batch in read_batches(fasta, batch_size):
+		for assigned in index.assign([record.seq for record in batch], min_gap=min_gap):
+			for primer in set(primer for primer, strand in assigned if strand == '+'):
+				counts[primer] += 1
+
+	return counts
+
 # this method uses the shell=True option because 
 # it need to use pipe in shell
 def exec_grep_shell(grep_command):
@@ -132,16 +150,12 @@ def check_dup_seq(fasta):
 def check_dup_seq_dict(fasta):
 
 	seq_dict = {}
-	with open(fasta, 'r') as f:
-		for ind, row in enumerate(f.readlines(), start=1):
-			if ind%2 == 1:
-				last_seqID = '-'.join(row.strip().split('-')[1:])
-			else:
-				last_key = row.strip()
-				if last_key in seq_dict:
-					seq_dict[last_key].append(last_seqID)
-				else:
-					seq_dict[last_key] = [last_seqID]
+	for record in read_records(fasta):
+		last_seqID = '-'.join(record.header.strip().split('-')[1:])
+		if record.seq in seq_dict:
+			seq_dict[record.seq].append(last_seqID)
+		else:
+			seq_dict[record.seq] = [last_seqID]
 
 	print (list(seq_dict.items())[:3])
 
@@ -165,28 +179,8 @@ def check_dup_seq_dict(fasta):
 
 def check_seq_in_2fasta_set(fasta1, fasta2):
 
-	set_fasta1 = set()
-	set_fasta2 = set()
-
-	with open(fasta1, 'r') as f:
-
-	    for ind, row in enumerate(f.readlines(), start=1):
-	        if ind%2 == 1:
-	            seq_ID = row.strip().split()[0]
-	            # print (seq_ID)
-	            set_fasta1.add(seq_ID)
-	        else:
-	            continue
-
-	with open(fasta2, 'r') as f:
-
-	    for ind, row in enumerate(f.readlines(), start=1):
-	        if ind%2 == 1:
-	            seq_ID = row.strip().split()[0]
-	            # print (seq_ID)
-	            set_fasta2.add(seq_ID)
-	        else:
-	            continue
+	set_fasta1 = set(f">{record.id}" for record in read_records(fasta1))
+	set_fasta2 = set(f">{record.id}" for record in read_records(fasta2))
 
 	# print (len(set_fasta1-set_fasta2))
 	# print (set_fasta1-set_fasta2)
@@ -205,21 +199,12 @@ def filter_design_fasta(fasta, new_fasta):
 	new_fasta_list = []
 	primers = utilities.Primers(settings.OLIGO_FILE)
 
-	with open(fasta, 'r') as f:
-
-		flag = False
-		for ind, row in enumerate(f.readlines(), start=1):
-
-			if ind%2 == 1:
+	for record in read_records(fasta):
 
-				last_key = row.strip().split('-')[1]
-				if last_key in primers.pseqs.keys():
-					new_fasta_list.append(row.strip())
-					flag = True
-			else:
-				if flag:
-					new_fasta_list.append(row.strip())
-					flag = False
+		last_key = record.header.split('-')[1]
+		if last_key in primers.pseqs.keys():
+			new_fasta_list.append(f">{record.header}")
+			new_fasta_list.append(record.seq)
 
 	with open(new_fasta, 'w') as f:
 		f.write('\n'.join(new_fasta_list))
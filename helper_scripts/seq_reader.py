@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+import os
+import json
+import gzip
+import mmap
+import tempfile
+from collections import namedtuple
+from collections.abc import Mapping
+
+GZIP_MAGIC = b'\x1f\x8b'
+# size of the decompressed blocks of a gzip file, which is streamed (a plain file is memory mapped instead)
+CHUNK_SIZE = 16 * 1024 * 1024
+WHITESPACE = b' \t\r\n'
+# the offset index of a file is the sidecar file <file>.seqidx next to it
+INDEX_EXTENSION = '.seqidx'
+
+
+class Record(namedtuple('Record', ['header', 'seq', 'qual'])):
+    '''
+    a fasta/fastq record: the header line (without the > or @), the sequence and the quality (None for fasta),
+    either memoryviews (read_batches) or str (read_records)
+    '''
+    __slots__ = ()
+
+    @property
+    def id(self):
+        '''
+        the seq ID, i.e. the first word of the header
+        '''
+        header = self.header if isinstance(self.header, str) else bytes(self.header).decode()
+        fields = header.split()
+        return fields[0] if fields else ''
+
+
+def is_gzip(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def trim(buf, start, end):
+    '''
+    returns end moved back over the trailing whitespace (i.e. \\r\\n) of buf[start:end]
+    '''
+    while end > start and buf[end - 1] in WHITESPACE:
+        end -= 1
+    return end
+
+
+def line_end(buf, start):
+    end = buf.find(b'\n', start)
+    return len(buf) if end == -1 else end
+
+
+def detect_format(buf):
+    '''
+    returns 'fasta' or 'fastq' from the first record of buf, None if buf is empty (or only whitespace)
+    '''
+    for byte in bytes(buf[:1024]):
+        if byte in WHITESPACE:
+            continue
+        if byte == ord('>'):
+            return 'fasta'
+        if byte == ord('@'):
+            return 'fastq'
+        raise ValueError(f"neither a fasta nor a fastq file (starts with {chr(byte)!r})")
+    return None
+
+
+def record_spans(buf, fmt, final=True):
+    '''
+    This generator finds the records of a buffer (mmap or bytes), without copying anything
+
+    Parameters
+    ----------
+    buf: the buffer, starting at a record (or whitespace)
+    fmt: 'fasta' or 'fastq'
+    final: False if more data follows buf (a streamed file), then the last, possibly incomplete, record is not yielded
+
+    Yields
+    ------
+    (header start, header end, seq start, seq end, qual start, qual end, wrapped, record end) offsets in buf,
+    qual start/end are None for fasta, wrapped is True if the sequence spans several lines
+    '''
+    size = len(buf)
+    pos = 0
+    while pos < size and buf[pos] in WHITESPACE:
+        pos += 1
+    marker = ord('>') if fmt == 'fasta' else ord('@')
+
+    while pos < size:
+        if buf[pos] != marker:
+            raise ValueError(f"not a {fmt} record at byte {pos}")
+        header_end = line_end(buf, pos)
+        if fmt == 'fasta':
+            end = buf.find(b'\n>', header_end)
+            if end == -1:
+                if not final:
+                    return
+                end = size
+            else:
+                end += 1
+            seq_start = min(header_end + 1, size)
+            seq_end = trim(buf, seq_start, end)
+            qual_start = qual_end = None
+            wrapped = buf.find(b'\n', seq_start, seq_end) != -1
+        else:
+            seq_start = min(header_end + 1, size)
+            seq_line_end = line_end(buf, seq_start)
+            qual_start = min(line_end(buf, min(seq_line_end + 1, size)) + 1, size)
+            qual_line_end = buf.find(b'\n', qual_start)
+            if qual_line_end == -1:
+                if not final:
+                    return
+                qual_line_end = size
+            end = qual_line_end + 1
+            seq_end = trim(buf, seq_start, seq_line_end)
+            qual_end = trim(buf, qual_start, qual_line_end)
+            wrapped = False
+        yield pos + 1, trim(buf, pos + 1, header_end), seq_start, seq_end, qual_start, qual_end, wrapped, end
+        pos = end
+        while pos < size and buf[pos] in WHITESPACE:
+            pos += 1
+
+
+def read_spans(path):
+    '''
+    This generator memory maps a plain file (or streams a gzip file, CHUNK_SIZE at a time)
+    and yields (buffer, memoryview of the buffer, spans of a record) for each record (see record_spans)
+    '''
+    if is_gzip(path):
+        with gzip.open(path, 'rb') as f:
+            pending, fmt = b'', None
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                final = not chunk
+                buf = pending + chunk
+                fmt = fmt or detect_format(buf)
+                consumed = 0
+                if fmt is not None:
+                    view = memoryview(buf)
+                    for spans in record_spans(buf, fmt, final):
+                        yield buf, view, spans
+                        consumed = spans[-1]
+                pending = buf[consumed:]
+                if final:
+                    break
+        return
+
+    with open(path, 'rb') as f:
+        if f.seek(0, 2) == 0: # an empty file can't be memory mapped
+            return
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # the map is not closed explicitly: it is unmapped once the last record (memoryview) using it is released
+    fmt = detect_format(buf)
+    if fmt is not None:
+        view = memoryview(buf)
+        for spans in record_spans(buf, fmt):
+            yield buf, view, spans
+
+
+def read_batches(path, batch_size=10000):
+    '''
+    This generator reads a fasta (single line or wrapped) or fastq file, plain or gzipped, in batches of records.
+    The header, seq and qual of a record are zero-copy memoryview slices of the memory mapped file
+    (or of the current gzip block), except for a wrapped sequence whose lines are joined (copied).
+
+    Parameters
+    ----------
+    path: String name of the fasta/fastq file
+    batch_size: the number of records per batch
+
+    Yields
+    ------
+    a list of Record (of memoryviews)
+    '''
+    batch = []
+    for buf, view, (header_start, header_end, seq_start, seq_end, qual_start, qual_end, wrapped, _) in read_spans(path):
+        seq = memoryview(buf[seq_start:seq_end].translate(None, WHITESPACE)) if wrapped else view[seq_start:seq_end]
+        qual = None if qual_start is None else view[qual_start:qual_end]
+        batch.append(Record(view[header_start:header_end], seq, qual))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def read_records(path):
+    '''
+    This generator reads a fasta (single line or wrapped) or fastq file, plain or gzipped, one record at a time
+
+    Parameters
+    ----------
+    path: String name of the fasta/fastq file
+
+    Yields
+    ------
+    a Record (of str)
+    '''
+    for batch in read_batches(path):
+        for header, seq, qual in batch:
+            yield Record(bytes(header).decode(), bytes(seq).decode(), None if qual is None else bytes(qual).decode())
+
+
+class SeqIndex(Mapping):
+    '''
+    Dictionary index of a fasta/fastq file: {seq ID: sequence (str)}, if a seq ID is duplicated only its first
+    record is kept (the duplicated IDs are listed in duplicates).
+
+    A plain file stays memory mapped and only the offsets of the sequences are kept, so a sequence is read
+    (from the page cache) when it is looked up. A gzip file can't be randomly accessed, so its sequences are kept.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.duplicates = []
+        self.buf = None
+        self.offsets = {}
+        for buf, view, (header_start, header_end, seq_start, seq_end, _, _, wrapped, _) in read_spans(path):
+            seq_id = Record(view[header_start:header_end], None, None).id
+            if seq_id in self.offsets:
+                self.duplicates.append(seq_id)
+            elif isinstance(buf, mmap.mmap):
+                self.buf = buf
+                self.offsets[seq_id] = (seq_start, seq_end, wrapped)
+            else:
+                self.offsets[seq_id] = buf[seq_start:seq_end].translate(None, WHITESPACE).decode()
+
+    def __getitem__(self, seq_id):
+        value = self.offsets[seq_id]
+        if isinstance(value, str):
+            return value
+        seq_start, seq_end, wrapped = value
+        seq = self.buf[seq_start:seq_end]
+        return (seq.translate(None, WHITESPACE) if wrapped else seq).decode()
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+def index_file(path):
+    return f"{path}{INDEX_EXTENSION}"
+
+
+def build_offset_index(path):
+    """
+    This function scans a plain fasta/fastq file once, and writes its offset index (see OffsetIndex) next to it.
+    The first line of the index records the size/mtime (for invalidation) and the format of the file,
+    then each line is: seq ID, offset and length (in bytes) of its record.
+
+    Parameters
+    ----------
+    path: String name of the fasta/fastq file
+
+    Returns
+    -------
+    source: dictionary with the size, mtime and format of the file
+    offsets: dictionary {seq ID: (offset, length)}, only the first record of a duplicated seq ID is kept
+    """
+    if is_gzip(path):
+        raise ValueError(f"{path} is gzipped, only a plain fasta/fastq file can be indexed")
+    with open(path, 'rb') as f:
+        fmt = detect_format(f.read(1024))
+    offsets = {}
+    for buf, view, (header_start, header_end, *_, end) in read_spans(path):
+        seq_id = Record(view[header_start:header_end], None, None).id
+        if seq_id not in offsets:
+            offsets[seq_id] = (header_start - 1, end - header_start + 1)
+
+    st = os.stat(path)
+    source = {'size': st.st_size, 'mtime': st.st_mtime, 'format': fmt}
+    try:
+        # written atomically (unique temp file, then renamed), so a concurrent reader never sees half of it
+        # and concurrent builders of the same index don't write into the same temp file
+        fd, tmp_file = tempfile.mkstemp(prefix=f"{os.path.basename(index_file(path))}.",
+                                        dir=os.path.dirname(os.path.abspath(path)))
+    except OSError: # i.e. a read only folder, the index is then only kept in memory
+        return source, offsets
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(f"#{json.dumps(source)}\n")
+            f.writelines(f"{seq_id}\t{offset}\t{length}\n" for seq_id, (offset, length) in offsets.items())
+        os.replace(tmp_file, index_file(path))
+    except OSError: # i.e. a full disk
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return source, offsets
+
+
+def load_offset_index(path):
+    """
+    This function loads the offset index of a fasta/fastq file, (re)building it if it is missing
+    or if the size or the mtime of the file changed since it was built
+    """
+    st = os.stat(path)
+    try:
+        with open(index_file(path)) as f:
+            source = json.loads(f.readline()[1:])
+            if source['size'] == st.st_size and source['mtime'] == st.st_mtime:
+                offsets = {}
+                for line in f:
+                    seq_id, offset, length = line.rstrip('\n').split('\t')
+                    offsets[seq_id] = (int(offset), int(length))
+                return source, offsets
+    except (OSError, ValueError, KeyError):
+        pass
+    return build_offset_index(path)
+
+
+class OffsetIndex(Mapping):
+    '''
+    Lazy dictionary of a (plain) fasta/fastq file: {seq ID: Record (of str)}, on top of its persistent offset index
+    (<file>.seqidx, faidx style). A lookup seeks to the record and reads only that record, so whole genomes
+    or read files never sit in memory, and the index is only rebuilt when the file changes.
+
+    The open file handle is not pickled, so the index can be passed to a process pool.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.source, self.offsets = load_offset_index(path)
+        self.file = None
+
+    def __getitem__(self, seq_id):
+        offset, length = self.offsets[seq_id]
+        if self.file is None:
+            self.file = open(self.path, 'rb')
+        self.file.seek(offset)
+        buf = self.file.read(length)
+        header_start, header_end, seq_start, seq_end, qual_start, qual_end, wrapped, _ = \
+            next(record_spans(buf, self.source['format']))
+        seq = buf[seq_start:seq_end]
+        return Record(buf[header_start:header_end].decode(), (seq.translate(None, WHITESPACE) if wrapped else seq).decode(),
+                      None if qual_start is None else buf[qual_start:qual_end].decode())
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['file'] = None
+        return state
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    print("This module is called by pipeline.py.  Please run pipeline.py --help for more information")
@@ -10,6 +10,11 @@ LOG_FILE = "confusion_matrix.log"
 PIDENT = 96
 PCOV = 90
 P_ALIGN = 0.9
+# resolve the queries identical to a reference amplicon without BLAST: they get the hits of the amplicon,
+# which is blasted once against the reference database (see run_blast.AmpliconIndex)
+BLAST_EXACT_BYPASS = True
+# cache the blast hits of each sequence across runs (see run_blast.BlastCache), only the new sequences are blasted
+BLAST_CACHE = True
 
 # list of 'negative' controls
 CONTROL_LIST = ['2013K_0676',
@@ -1,3 +1,16 @@
+import sys
+import numpy as np
+import pandas as pd
+try:
+    import seq_reader
+except ModuleNotFoundError: # imported as helper_scripts.utilities
+    from helper_scripts import seq_reader
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+
 def revcomp(myseq):
     rc = {'A' : 'T', 'T' : 'A', 'G' : 'C', 'C' : 'G', 'U' : 'A', 'Y' : 'R', 'R' : 'Y', 'K':'M', 'M':'K','B':'V',\
             'D':'H', 'H':'D', 'V':'B', 'N':'N'}
@@ -22,6 +35,125 @@ class Primers:
                     pseqs[tmp[3].strip('\n')] = [tmp[1], revcomp(tmp[2])]
 
 
+class ReferenceContext:
+    '''
+    The reference lookups of a confusion matrix run, loaded once and then passed around
+    (instead of re-reading the oligo file and the metasheet for every sample)
+
+    primers: the primer universe, the frozenset of the primer names in the oligo file
+    primer_list: the primer names in the order of the oligo file (their positions are the columns of encode)
+    sample_to_primer: {isolate: frozenset of its predicted primers} (from the metasheet)
+    sample_to_isolate: {sample: list of its isolates} (from the mapping file)
+    amplicons: the metasheet table of the reference amplicons (index: seq_id, columns: primer, sample)
+    '''
+
+    def __init__(self, oligo_file, sample_to_primer=None, sample_to_isolate=None, amplicons=None):
+        self.primer_list = list(Primers(oligo_file).pseqs)
+        self.primers = frozenset(self.primer_list)
+        self.sample_to_primer = {key: frozenset(value) for key, value in (sample_to_primer or {}).items()}
+        self.sample_to_isolate = sample_to_isolate or {}
+        self.amplicons = amplicons
+
+    def predicted_primers(self, sample):
+        '''
+        this method collects the predicted primers (within the primer universe) of all the isolates of a sample
+
+        Parameters
+        ----------
+        sample: the sample name
+
+        Returns
+        ----------
+        a frozenset of the predicted primers, and the list of the isolates which can't be found in the metasheet
+        '''
+        primers, missing = set(), []
+        for isolate in self.sample_to_isolate.get(sample, []):
+            if isolate in self.sample_to_primer:
+                primers.update(self.sample_to_primer[isolate])
+            else:
+                missing.append(isolate)
+        return frozenset(primers) & self.primers, missing
+
+    def encode(self, samples, *primer_sets):
+        '''
+        this method encodes the primer sets of the samples as boolean matrices (row: sample, column: primer),
+        with the primers at their positions in the oligo file. Primers which are not in the primer universe
+        get extra columns after it, so that the set algebra on the rows is the same as on the original sets.
+
+        Parameters
+        ----------
+        samples: the list of samples (rows)
+        primer_sets: one {sample: iterable of primer names} dictionary per matrix,
+                     or a (sample x primer) dataframe whose non-null cells are the primers of the sample
+
+        Returns
+        ----------
+        columns: the list of primer names (columns), the first len(primer_list) of them being the primer universe
+        matrices: the list of boolean matrices, one per primer_sets
+        '''
+        position = {primer: i for i, primer in enumerate(self.primer_list)}
+        columns = list(self.primer_list)
+        cells = []
+        for sets in primer_sets:
+            if isinstance(sets, pd.DataFrame):
+                rows, cols = np.nonzero(sets.reindex(index=samples).notna().to_numpy())
+                names = sets.columns[cols]
+            else:
+                rows = [i for i, sample in enumerate(samples) for _ in sets[sample]]
+                names = [primer for sample in samples for primer in sets[sample]]
+            for primer in names:
+                if primer not in position:
+                    position[primer] = len(columns)
+                    columns.append(primer)
+            cells.append((rows, [position[primer] for primer in names]))
+
+        matrices = []
+        for rows, cols in cells:
+            matrix = np.zeros((len(samples), len(columns)), dtype=bool)
+            matrix[rows, cols] = True
+            matrices.append(matrix)
+        return columns, matrices
+
+    def universe(self, columns):
+        '''
+        the boolean mask of the primer universe over the columns returned by encode
+        '''
+        return np.arange(len(columns)) < len(self.primer_list)
+
+
+def confusion_metrics(samples, TP, FP, FN, TN):
+    '''
+    this method counts the TP/FP/FN/TN primers of every sample and derives the sensitivity, specificity,
+    precision and accuracy of each sample, all at once
+
+    Parameters
+    ----------
+    samples: the list of samples
+    TP, FP, FN, TN: the boolean (sample x primer) matrices of the true/false positive/negative primers
+
+    Returns a dataframe (index: samples, columns: TP/FP/FN/TN and the derived metrics)
+    '''
+    df = pd.DataFrame({name: matrix.sum(axis=1) for name, matrix in zip(['TP','FP','FN','TN'], (TP, FP, FN, TN))},
+                      index=samples)
+    df['sensitivity (TP/P)'] = (df['TP']/(df['TP'] + df['FN'])).round(3)
+    df['specificity (TN/N)'] = (df['TN']/(df['TN'] + df['FP'])).round(3)
+    df['precision (TP/TP+FP)'] = (df['TP']/(df['TP'] + df['FP'])).round(3)
+    df['ACC'] = ((df['TP'] + df['TN'])/(df['TP'] + df['TN'] + df['FP'] + df['FN'])).round(3)
+
+    return df
+
+
+def peak_memory_mb():
+    '''
+    returns the peak resident memory (MB) of this process so far, or None if it can't be measured (Windows)
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, in kilobytes on Linux
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
 def create_fasta_dict(fasta):
     '''
     this method reads a fasta file and convert it into a dictionary, with seq_ID being the key and actual sequence
@@ -31,20 +163,15 @@ def create_fasta_dict(fasta):
 
     Parameters
     ----------
-    fasta: String name of the fasta file
+    fasta: String name of the fasta file (single line or wrapped, see seq_reader.py)
 
     Returns a dictionary
 
     '''
     seq_dict = {}
-    with open(fasta, 'r') as f:
-        for ind, row in enumerate(f.readlines(), start=1):
-            if ind%2 == 1:
-                last_seqID = row.strip().split()[0][1:] #removes the '>'
-            else:
-                last_seq = row.strip()
-                if last_seqID in seq_dict:
-                    print (f"warning ! has a duplicate seq ID {last_seqID}")
-                else:
-                    seq_dict[last_seqID] = last_seq
+    for record in seq_reader.read_records(fasta):
+        if record.id in seq_dict:
+            print (f"warning ! has a duplicate seq ID {record.id}")
+        else:
+            seq_dict[record.id] = record.seq
     return seq_dict
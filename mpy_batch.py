@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 import sys, os, shutil, subprocess
 from datetime import datetime
+from configparser import ConfigParser
 from mothur_py import Mothur
 import re
-import group, run_cutadapt
+import group, run_cutadapt, checkpoint, count_table, log_parser, file_remover
 import glob
 from collections import deque
 import concurrent.futures
@@ -15,16 +16,13 @@ def check_filesize():
     """
     This utility function checks and makes sure the good fasta file size is larger than scrap fasta file size
     , otherwise it will throw out an RuntimeError
-    It does so by parsing the MOTHUR log file, and grab those 2 fasta file names, then compare their sizes.
+    It does so by looking up those 2 fasta file names in the MOTHUR log file (index), then compare their sizes.
 
     """
     if (os.access(MOTHUR_LOG_FILE, os.R_OK)):
-        with open(MOTHUR_LOG_FILE, 'r', errors='ignore') as f:
-            log_file = f.read()
-        try:
-            good_fasta_file = re.search(r'.+trim\.contigs\.fasta', log_file).group(0)
-            scrap_fasta_file = re.search(r'.+scrap\.contigs\.fasta',log_file).group(0)
-        except AttributeError: #in case MOTHUR log file doesn't have trim/scrap fasta file
+        good_fasta_file, scrap_fasta_file = group.get_log_index(MOTHUR_LOG_FILE).search(r'.+trim\.contigs\.fasta',
+                                                                                         r'.+scrap\.contigs\.fasta')
+        if not (good_fasta_file and scrap_fasta_file): #in case MOTHUR log file doesn't have trim/scrap fasta file
             raise RuntimeError(f"************************************************************\n"
                                f"return_code=None   Alert! ERROR\n"
                                f"can't find either trim or scrap fasta file in MOTHUR log\n"
@@ -39,19 +37,42 @@ def check_filesize():
                                f"************************************************************")
 
 
-def main(config):
+def remove_empty_accnos(dir):
+    """
+    This utility function removes all empty accnos files in the given directory
+
+    Returns
+    -------
+    True if any empty accnos file was found (and removed), otherwise False
+    """
+    found_empty = False
+    for accnos_file in glob.glob(rf"{dir}/*.accnos"):
+        if os.path.getsize(accnos_file) == 0:
+            os.remove(accnos_file)
+            found_empty = True
+    return found_empty
+
+
+def main(config, resume=False):
 
     global MOTHUR_LOG_FILE
     currentDir = os.getcwd()
     now = datetime.now()
     runDateTime = now.strftime("%Y%m%d%H%M%S")
-    MOTHUR_LOG_FILE = os.path.expanduser(config['file_inputs']['output_dir'])+'/mothur.'+runDateTime+'.logfile'
+    dir = os.path.expanduser(config['file_inputs']['output_dir'])
+    # every mothur call (and the python steps in between) is recorded in the stage manifest
+    # with resume=True, the stages completed by the previous run are skipped
+    stages = checkpoint.StageManifest(dir, resume)
+    MOTHUR_LOG_FILE = stages.logfile or dir+'/mothur.'+runDateTime+'.logfile'
     m = Mothur(logfile_name = MOTHUR_LOG_FILE)
+    stages.bind(m)
 
-    m.set.dir(input = config.get('file_inputs', 'input_dir', fallback = currentDir),
+    stages.run('set.dir', m.set.dir,
+              input = config.get('file_inputs', 'input_dir', fallback = currentDir),
               output = config.get('file_inputs', 'output_dir', fallback = currentDir),
               tempdefault = config.get('file_inputs','output_dir', fallback = currentDir))
-    m.make.contigs(file = config.get('file_inputs','batch_file'),
+    stages.run('make.contigs', m.make.contigs,
+                    file = config.get('file_inputs','batch_file'),
                     processors= config.getint('contigs_params', 'processors', fallback = 40), 
                     format=config.get('contigs_params', 'format', fallback = 'illumina1.8+'), 
                     oligos=config.get('file_inputs', 'oligos'), 
@@ -64,86 +85,91 @@ def main(config):
 
     # this serves as a check point and make sure that:
     # good fasta file (trim.contigs.fasta) size > scrap fasta file size
-    check_filesize()
+    stages.value('check_filesize', check_filesize)
 
-    m.rename.file(fasta='current', group='current',
+    stages.run('rename.file', m.rename.file, fasta='current', group='current',
                     prefix=config.get('rename_param', 'prefix'))
 
-    m.screen.seqs(fasta='current', group='current',
+    stages.run('screen.seqs', m.screen.seqs, fasta='current', group='current',
                     maxambig=config.getint('screen_params', 'maxambig', fallback = 0),
                     maxlength=config.getint('screen_params', 'maxlength', fallback = 325))
 
-    m.unique.seqs(fasta='current')
-    m.summary.seqs(fasta='current', name='current')
+    stages.run('unique.seqs', m.unique.seqs, fasta='current')
+    stages.run('summary.seqs', m.summary.seqs, fasta='current', name='current')
 
     print(datetime.now()) 
-    old_group = group.get_current_file(MOTHUR_LOG_FILE)
+    old_group = stages.value('old_group', group.get_current_file, MOTHUR_LOG_FILE)
     print (f"old group is: {old_group}")
-    new_group = group.create_new_Group(old_group)
+    new_group = stages.value('new_group', group.create_new_Group, old_group)
     print (f"new group is: {new_group}")
     print(datetime.now()) 
 
-    old_accnos = group.get_current_file(MOTHUR_LOG_FILE, 'accnos') 
+    old_accnos = stages.value('old_accnos', group.get_current_file, MOTHUR_LOG_FILE, 'accnos') 
     
-    old_fasta = group.get_current_file(MOTHUR_LOG_FILE, 'fasta')
+    old_fasta = stages.value('old_fasta', group.get_current_file, MOTHUR_LOG_FILE, 'fasta')
     print (f"old fasta is: {old_fasta}")
     print (f"old accnos is: {old_accnos}")
 
     #1. create primer pair group file
-    new_group_primer = group.create_new_Group(old_group, 'primer')
+    new_group_primer = stages.value('new_group_primer', group.create_new_Group, old_group, 'primer')
     print (f"new group primer is: {new_group_primer}")
     print(datetime.now()) 
 
     #2. count.seqs()
-    m.count.seqs(name='current', group=new_group_primer)
+    stages.run('count.seqs', m.count.seqs, name='current', group=new_group_primer)
     print(datetime.now()) 
     print(f"done with count.seqs")
 
     #3. split.groups()
-    m.split.groups(fasta=old_fasta, count='current')
+    stages.run('split.groups', m.split.groups, fasta=old_fasta, count='current')
     print(datetime.now()) 
     print(f"done with split.groups")
 
 
     new_fasta = f'{old_fasta[:-5]}merged.fasta'
-    run_cutadapt.run_cutadapt_mothur(config, new_fasta, 36)
+    # cutadapt stays within the processors budget of this session (i.e. in per sample mode)
+    stages.value('cutadapt', run_cutadapt.run_cutadapt_mothur, config, new_fasta,
+                 min(36, config.getint('contigs_params', 'processors', fallback = 40)))
 
     # reverse-expand ~, to avoid hypen issue in directory name
     new_fasta = new_fasta.replace(os.path.expanduser('~'), '~', 1)
 
     # add these to avoid potential duplicate name issue in fasta file
-    m.list.seqs(fasta=new_fasta) #list all the unique names in the fasta file
-    m.get.seqs(fasta='current', accnos='current') #remove any duplicate names
+    stages.run('list.seqs', m.list.seqs, fasta=new_fasta) #list all the unique names in the fasta file
+    stages.run('get.seqs', m.get.seqs, fasta='current', accnos='current') #remove any duplicate names
     #6. unique.seqs
-    m.unique.seqs(fasta='current', name='current')
-    m.summary.seqs(fasta='current', name='current')
+    stages.run('unique.seqs', m.unique.seqs, fasta='current', name='current')
+    stages.run('summary.seqs', m.summary.seqs, fasta='current', name='current')
     
 
-    dir = os.path.expanduser(config['file_inputs']['output_dir'])
-    for accnos_file in glob.glob(rf"{dir}/*.accnos"):
-        if os.path.getsize(accnos_file) == 0: # we shouldn't find any accnos file at this stage, but we check anyway
-            os.remove(accnos_file)
+    # we shouldn't find any accnos file at this stage, but we check anyway
+    stages.value('remove_empty_accnos', remove_empty_accnos, dir)
 
     # Search for chimeras
     # need to use proper path for vsearch
-    m.chimera.vsearch(fasta='current', name='current', group=new_group, dereplicate='t', vsearch=config.get('chimera_params', 'vsearch'))
+    stages.run('chimera.vsearch', m.chimera.vsearch, fasta='current', name='current', group=new_group, dereplicate='t', vsearch=config.get('chimera_params', 'vsearch'))
     # m.chimera.vsearch(fasta='current', count='current', dereplicate='t', vsearch=r'~/HMAS-QC-Pipeline/mothur/vsearch')
     # check for emptry accnos file
     # because we checked already, if we find another accnos file, it must come from chimera.vsearch()
-    chimera_accnos_empty = False
-    for accnos_file in glob.glob(rf"{dir}/*.accnos"):
-        if os.path.getsize(accnos_file) == 0:
-            os.remove(accnos_file)
-            chimera_accnos_empty = True
+    chimera_accnos_empty = stages.value('chimera_accnos_empty', remove_empty_accnos, dir)
 
     if chimera_accnos_empty:
-        m.set.current(group=old_group, accnos=old_accnos)
+        stages.run('set.current', m.set.current, group=old_group, accnos=old_accnos)
     else:
-        m.set.current(group=old_group)
-        m.remove.seqs(fasta='current', accnos='current', group='current', name='current')
+        stages.run('set.current', m.set.current, group=old_group)
+        stages.run('remove.seqs', m.remove.seqs, fasta='current', accnos='current', group='current', name='current')
 
     # this works, but just takes too long,  over 3 days for Juno data M347-21-026 M347-21-027..
-    m.count.seqs(name='current', group='current')
+    # stages.run('count.seqs', m.count.seqs, name='current', group='current')
+    # so we build the (compressed) count_table in python instead, and make it the current count file for mothur
+    def native_count_seqs(name_file, group_file):
+        count_file = count_table.build_count_table(name_file, group_file)
+        m.current_files['count'] = count_file
+        return count_file
+
+    current_name = stages.value('current_name', group.get_current_file, MOTHUR_LOG_FILE, 'name')
+    current_group = stages.value('current_group', group.get_current_file, MOTHUR_LOG_FILE, 'group')
+    stages.value('native_count_seqs', native_count_seqs, current_name, current_group)
     print(datetime.now()) 
     print(f"done with count.seqs")
     # m.pre.cluster(fasta='current', count='current', diffs=0)
@@ -152,22 +178,147 @@ def main(config):
 
 
 
-    m.summary.seqs(fasta='current', count='current')
+    stages.run('summary.seqs', m.summary.seqs, fasta='current', count='current')
 
-    m.cluster(count='current', method='unique', cutoff='unique')
-    m.remove.rare(list='current', count='current',
+    stages.run('cluster', m.cluster, count='current', method='unique', cutoff='unique')
+    stages.run('remove.rare', m.remove.rare, list='current', count='current',
                       nseqs=config.getint('rare_seqs_param', 'nseqs', fallback=9),
                       label='unique')
 
-    current_count = group.get_current_file(MOTHUR_LOG_FILE, 'count').replace(os.path.expanduser('~'), '~', 1)
-    m.list.seqs(count=current_count)
-    m.get.seqs(fasta='current', accnos='current', name='current', group='current')
-    m.summary.seqs(fasta='current', count='current')
+    current_count = stages.value('current_count', group.get_current_file, MOTHUR_LOG_FILE, 'count').replace(os.path.expanduser('~'), '~', 1)
+    stages.run('list.seqs', m.list.seqs, count=current_count)
+    stages.run('get.seqs', m.get.seqs, fasta='current', accnos='current', name='current', group='current')
+    stages.run('summary.seqs', m.summary.seqs, fasta='current', count='current')
 
-    m.rename.file(fasta='current', count='current', prefix=config.get('rename_param', 'prefix') +'.final')
+    stages.run('rename.file', m.rename.file, fasta='current', count='current', prefix=config.get('rename_param', 'prefix') +'.final')
 
     # convert to full format count_table
-    m.count.seqs(count='current', compress='f')
+    stages.run('count.seqs', m.count.seqs, count='current', compress='f')
+
+    return m.current_files.get('count')
+
+
+def sample_name(batch_line):
+    """
+    This utility function names the sample of a batch file line after its R1 fastq file,
+    i.e. Sample-1_S1_L001_R1_001.fastq.gz -> Sample-1
+    """
+    r1_file = os.path.basename(batch_line.split()[0])
+    return re.split(r'(_S\d+)?(_L\d{3})?_R1', r1_file)[0]
+
+
+def split_batch_file(config):
+    """
+    This function splits the batch file by sample (one line per sample), and creates for each sample
+    an output folder (output_dir/sample) with its own single line batch file.
+
+    Returns
+    -------
+    a dictionary of sample name: sample output folder
+    """
+    dir = os.path.expanduser(config['file_inputs']['output_dir'])
+    samples = {}
+    with open(os.path.expanduser(config['file_inputs']['batch_file'])) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            sample = sample_name(line)
+            if sample in samples:
+                raise RuntimeError(f"************************************************************\n"
+                                   f"return_code=None   Alert! ERROR\n"
+                                   f"sample {sample} is found more than once in the batch file\n"
+                                   f"************************************************************")
+            samples[sample] = os.path.join(dir, sample)
+            os.makedirs(samples[sample], exist_ok=True)
+            with open(os.path.join(samples[sample], f'{sample}.batch'), 'w') as batch:
+                batch.write(line)
+    return samples
+
+
+def sample_config(config, sample, sample_dir):
+    """
+    This function builds the config of a single sample session: a copy of the config
+    with the sample's batch file, output folder and file prefix
+    """
+    new_config = ConfigParser()
+    new_config.read_dict({section: dict(config.items(section, raw=True)) for section in config.sections()})
+    new_config.set('file_inputs', 'batch_file', os.path.join(sample_dir, f'{sample}.batch'))
+    new_config.set('file_inputs', 'output_dir', sample_dir)
+    # the sample folder has files <sample>.final.count_table etc., as hmas2_confusion_matrix.py expects
+    new_config.set('rename_param', 'prefix', sample)
+    return new_config
+
+
+def run_sample(sample, config, resume):
+    """
+    This function runs the whole mothur command chain of one sample in its own mothur-py session
+    (and process), then cleans up its MOTHUR log file and vsearch temp files
+
+    Returns
+    -------
+    (sample, the final count_table file or None, the error message or None)
+    """
+    global MOTHUR_LOG_FILE
+    MOTHUR_LOG_FILE = '' # the pool process may have run another sample before
+    try:
+        return sample, main(config, resume), None
+    except Exception as e:
+        return sample, None, str(e)
+    finally:
+        if (os.access(MOTHUR_LOG_FILE, os.R_OK)):
+            log_parser.parse(MOTHUR_LOG_FILE)
+        file_remover.remove_vsearch_files(config, primers_only=True)
+
+
+def main_per_sample(config, resume=False, cores=None):
+    """
+    This function runs the pipeline by sample: the batch file is split by sample (see split_batch_file),
+    and each sample runs in an independent mothur-py session, in a process pool.
+    Each session uses the processors budget of the config (contigs_params), so that
+    cores // processors sessions run at the same time.
+    The final count_tables of the samples are then merged into output_dir/<prefix>.final.count_table
+
+    Parameters
+    ----------
+    config: the config object
+    resume: resume each sample session from its own stage manifest
+    cores: the total number of cores to use (default: all of them)
+
+    Returns
+    -------
+    the merged count_table file name
+
+    """
+    dir = os.path.expanduser(config['file_inputs']['output_dir'])
+    cores = cores or os.cpu_count()
+    processors = config.getint('contigs_params', 'processors', fallback = 40)
+    sessions = max(1, cores // processors)
+    samples = split_batch_file(config)
+    print(f"{datetime.now()}   running {len(samples)} samples, {sessions} sessions of {processors} processors")
+
+    count_files, errors = [], []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=sessions) as executor:
+        futures = [executor.submit(run_sample, sample, sample_config(config, sample, sample_dir), resume)
+                   for sample, sample_dir in samples.items()]
+        for future in concurrent.futures.as_completed(futures):
+            sample, count_file, error = future.result()
+            if error:
+                print(f"{datetime.now()}   sample {sample} failed:\n{error}")
+                errors.append(sample)
+            else:
+                print(f"{datetime.now()}   done with sample {sample}")
+                count_files.append(os.path.expanduser(count_file))
+
+    merged_file = os.path.join(dir, f"{config.get('rename_param', 'prefix')}.final.count_table")
+    count_table.merge_count_tables(sorted(count_files), merged_file)
+    print(f"{datetime.now()}   merged count_table: {merged_file}")
+
+    if errors:
+        raise RuntimeError(f"************************************************************\n"
+                           f"return_code=None   Alert! ERROR\n"
+                           f"samples failed: {', '.join(sorted(errors))}\n"
+                           f"************************************************************")
+    return merged_file
 
 
 if __name__ == "__main__":
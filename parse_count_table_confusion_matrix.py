@@ -2,7 +2,7 @@
 
 import argparse, os, sys
 import pandas as pd
-from pathlib import Path
+import numpy as np
 import logging
 from configparser import ConfigParser
 # importing scripts under helper_scripts folder
@@ -15,6 +15,8 @@ from configparser import ConfigParser
 from helper_scripts import run_blast as blast
 from helper_scripts import utilities
 from helper_scripts import settings
+# full format count tables are read (through their columnar cache) as sparse count matrices
+from helper_scripts.count_matrix import CountMatrix, split_sample_primer
 
 
 logger = logging.getLogger(__name__)
@@ -161,54 +163,51 @@ def rev_map_isolate_to_sample(map_dict):
     return rev_map_dict
 
 
-# helper method to read a full format count table, and/or save it as a pickle file for faster retrieval
-def read_count_table(count_file):
-
-    if Path(f"{count_file}.pkl").is_file():
-        print(f"...loading {count_file}.pkl")
-        df = pd.read_pickle(f"{count_file}.pkl")
-    else:
-        # read count_table
-        print("loading csv count file")
-        df = pd.read_csv(count_file, sep='\t')
-        print("done loading csv count file")
-        pd.to_pickle(df, f"{count_file}.pkl") 
-        print("done dumping pkl file")
-
-    return df
-
-def create_blast_df(blast_file, query_fasta, reference, max_hit, metasheet_file):
+def create_blast_df(blast_file, query_fasta, reference, max_hit, metasheet_file, blast_db=None):
 
     # the 'primer' is like: OG0000890-OG0000890primerGroup9-2014K_0979
     bcolnames = ["seq", "primer", "query_len", "subj_len", "len_aln", "eval", "cov", "pident", "mismatch"]
 
     if not blast_file: #if we don't already have blast result as a text file
-        blast_file = blast.blast(query_fasta, reference, os.path.basename(query_fasta), max_hit)
-        
-    # blast_df = pd.read_csv(blast_file, sep='\t', names=bcolnames, index_col=False, header=None)
-    blast_df = pd.read_csv(blast_file, sep='\t', names=bcolnames)
+        # the hits are filtered (settings.py thresholds) as blast produces them, see merge_count_blast
+        blast_df = blast.blast_table(query_fasta, reference, os.path.basename(query_fasta), max_hit, bcolnames, blast_db,
+                                     settings.PIDENT, settings.PCOV, settings.P_ALIGN,
+                                     exact=settings.BLAST_EXACT_BYPASS, cache=settings.BLAST_CACHE)
+    else:
+        # blast_df = pd.read_csv(blast_file, sep='\t', names=bcolnames, index_col=False, header=None)
+        blast_df = pd.read_csv(blast_file, sep='\t', names=bcolnames)
     
     # de-couple the formatting 
-    # use the csv_to_dict() fuction to get the dict
-    # '>OG0000294-OG0000294primerGroup8-ParatyphiA rc' - the seq_id will be a key of a dictionary
+    # '>OG0000294-OG0000294primerGroup8-ParatyphiA rc' - the seq_id will be the index of the metasheet table
     # metasheet is a 3 column csv file, which contains explicit information of 
     # which primer pair and sample does an amplicon sequence correspond to. For example:
     # seq_id,primer,sample
     # OG0002941-OG0002941primerGroup0-2014K_0324,OG0002941primerGroup0,2014K_0324
-    map_dict = csv_to_dict(metasheet_file)
-    blast_df['primer_new'] = [ map_dict[seq_id]['primer'] for seq_id in blast_df['primer']]
-    blast_df['sample'] = [ map_dict[seq_id]['sample'] for seq_id in blast_df['primer']]
-    blast_df.drop(columns='primer', inplace=True)
-    blast_df.rename(columns={'primer_new':'primer'}, inplace=True)
-    blast_df['sample_primer'] = blast_df['sample'] + '.' + blast_df['primer']
+    # (metasheet_file can also be that table, already loaded)
+    metasheet = metasheet_file if isinstance(metasheet_file, pd.DataFrame) else pd.read_csv(metasheet_file, index_col=0)
+    metasheet = metasheet[['primer','sample']]
+    metasheet = metasheet.assign(sample_primer = metasheet['sample'] + '.' + metasheet['primer'])
+
+    # join the blast hits with the metasheet through the (few) distinct seq_ids, as categorical codes
+    seq_ids = blast_df.pop('primer').astype('category')
+    position = metasheet.index.get_indexer(seq_ids.cat.categories)
+    if (position < 0).any():
+        raise KeyError(seq_ids.cat.categories[position < 0][0])
+    row_position = position[seq_ids.cat.codes.to_numpy()]
+    for column in ['primer','sample','sample_primer']:
+        values = metasheet[column].astype('category')
+        blast_df[column] = pd.Categorical.from_codes(values.cat.codes.to_numpy()[row_position], values.cat.categories)
 
     return blast_df
 
 def blast_map_sample_to_isolate(blast_df, map_dict):
     '''
     this method helps to convert the 'isolate.primer' column in blast result into its corresponding
-    'sample.primer' instead. One isolate might correspond to multiple samples, and this is taken
-    care of by explode() method
+    'sample.primer' instead. One isolate might correspond to multiple samples, so a blast row becomes
+    one row per sample (like explode()).
+
+    The mapping is done on the (few) distinct isolate.primer values only, merged with the small
+    isolate-to-sample table, and then merged back into the blast rows on their categorical codes.
 
     Parameters
     ----------
@@ -217,19 +216,27 @@ def blast_map_sample_to_isolate(blast_df, map_dict):
 
     Returns the converted blast result dataframe
     '''
-    def map_sample_to_isolate(x):
-        sep = '.'
-        isolate = x.split(sep)[0]
-        primer_pair = x.split(sep)[1]
-        sample_list = map_dict[isolate]
-        return [f"{sample}{sep}{primer_pair}" for sample in sample_list]
+    sep = '.'
+    sample_primer = blast_df['sample_primer'].astype('category')
+    pairs = pd.Series(sample_primer.cat.categories, dtype=object).str.split(sep)
+    pair_df = pd.DataFrame({'code': np.arange(len(pairs)), 'isolate': pairs.str[0], 'primer_pair': pairs.str[1]})
+    missing = ~pair_df['isolate'].isin(map_dict)
+    if missing.any():
+        raise KeyError(pair_df.loc[missing, 'isolate'].iloc[0])
+
+    isolate_df = pd.DataFrame([(isolate, sample) for isolate, samples in map_dict.items() for sample in samples],
+                              columns=['isolate','sample'])
+    pair_df = pair_df.merge(isolate_df, on='isolate', how='left')
+    pair_df['sample_primer'] = pair_df['sample'] + sep + pair_df['primer_pair']
+
+    blast_df = blast_df.drop(columns='sample_primer').assign(code=sample_primer.cat.codes)
+    blast_df = blast_df.merge(pair_df[['code','sample_primer']], on='code', how='left').drop(columns='code')
+    blast_df['sample_primer'] = blast_df['sample_primer'].astype('category')
 
-    blast_df['sample_primer'] = blast_df['sample_primer'].apply(map_sample_to_isolate)
-
-    return blast_df.explode('sample_primer', ignore_index=True)
+    return blast_df
 
 
-def merge_count_blast(df, primer_list, blast_df):
+def merge_count_blast(count_matrix, blast_df):
     '''
     this method filters the original full-format count table (below), so that seqs 
     all have matches in blast result and their pident == 100 & cov >= 90 (or any value in the settings.py)
@@ -239,39 +246,26 @@ def merge_count_blast(df, primer_list, blast_df):
     Seq2    0   0   86  0
     Seq3    4   0   0   0
 
+    The count table is held as a sparse CountMatrix, so instead of melting the whole table and merging it
+    with the blast result, only the cells of the (seq, sample_primer) pairs of the blast hits are kept.
+
     Parameters
     ----------
-    df: the original count table dataframe
-    primer_list: the list of targeted sample.primer ['Sam1_PP1', 'Sam1_PP2'] etc.
+    count_matrix: the original count table as a CountMatrix (of the targeted sample.primer columns)
     blast_df: blast result dataframe
 
-    Returns the filtered dataframe
+    Returns the filtered CountMatrix
 
     '''
 
-    #1.1 melt the df 
-    df = df.melt(id_vars=['seq'],value_vars=primer_list,var_name='sample_primer_orig',value_name='count')
-    # change dtype for 'count' to save memory
-    df = df.astype({'count':int})
-    df['sample_primer'] = df['sample_primer_orig']
-
-    #1.2 filter and merge
+    #1.1 filter the blast result
     blast_df = blast_df[(blast_df['pident'] >= settings.PIDENT) & \
                         (blast_df['len_aln']/blast_df['subj_len'] >= settings.P_ALIGN) & \
                         (blast_df['cov'] >= settings.PCOV)]
-    df = pd.merge(df,blast_df,on=['seq','sample_primer'])
 
-    #1.3
-    # duplicates come from the exploded blast_df, and they're all identical in 
-    # the subset of ['seq','sample_primer_orig','count'], so we only need to keep one of them
-    df.drop_duplicates(subset=['seq','sample_primer_orig'], inplace=True)
-
-    #1.4 reverse the melt, and return to original format of df
-    # df = df.drop(columns = ["query_len", "subj_len", "eval", "cov", "pident", "mismatch", "primer", "sample", "sample_primer_x","sample_primer_y"], errors='ignore')
-    df = df[['seq','sample_primer_orig','count']]
-    df = df.pivot(index='seq',columns='sample_primer_orig',values='count')
-
-    return df
+    #1.2 keep only the count table cells with a blast hit
+    # (duplicates come from the exploded blast_df, they're dropped with the pairs)
+    return count_matrix.filter_pairs(blast_df['seq'], blast_df['sample_primer'])
 
 
 def split_samle_primer(sr, primers, sample_list, raw_idx):
@@ -300,27 +294,8 @@ def split_samle_primer(sr, primers, sample_list, raw_idx):
 
     '''
 
-    #1. construct lists of count values(as columns) for the final df
-    n_column_list = []
-    _idx = sr.index
-    for pp in primers:
-        # check if sample.pp is in the index, otherwise make it blank
-        # n_column_list.append([sr[f"{sample}.{pp}"] if f"{sample}.{pp}" in _idx else 0 for sample in sample_list])
-        count_list = []
-        for sample in sample_list:
-            if f"{sample}.{pp}" in _idx:
-                count_list.append(sr[f"{sample}.{pp}"])
-            elif f"{sample}.{pp}" in raw_idx:
-                count_list.append(0)
-            else:
-                count_list.append(None)
-        n_column_list.append(count_list)
-
-    #2. create the final_df from the list, transpose and reset the index name
-    final_df = pd.DataFrame(n_column_list, index=primers).T
-    final_df.index = sample_list
-
-    return final_df
+    # vectorized: the sample.primer index is split once and unstacked
+    return split_sample_primer(sr, primers, sample_list, raw_idx)
 
 def parse_argument():
     # note
@@ -385,74 +360,60 @@ def get_column_list(df):
     return column_list
 
 
-def build_confusion_matrix(sample_list, raw_df_t, blast_df_t, map_dict, meta_sheet):
+def build_confusion_matrix(sample_list, raw_df, blast_df, ref):
     '''
-    this method flattens a list of sets into one single list and generate the occurrence count for each item
-    as a dictionary
+    this method computes the TP/FP/FN/TN primers of all the samples at once: the observed, predicted and
+    true positive primers of each sample are rows of boolean (sample x primer) matrices (see
+    utilities.ReferenceContext.encode), and the confusion sets are a few element-wise operations on them
 
     Parameters
     ----------
     sample_list: a list of all samples in the data set
-    blast_df_t: the transformed (and blast filtered) dataframe (row: primers, column: samples)
-    map_dict: mapping dictionary between sample and isolate name 
+    raw_df: the reformatted count table dataframe (row: samples, column: primers), NaN for the unobserved primers
+    blast_df: the blast filtered dataframe (row: samples, column: primers), NaN for the unobserved primers
+    ref: the utilities.ReferenceContext (primer universe, sample-isolates mapping and metasheet), loaded once
 
     Returns
     ----------
-    df_dict: a dictionary of TP/FP/TN/FN metrics (key: sample_name, value: a list of number of TP/FP/TN/FN counts )
+    a dataframe of the TP/FP/FN/TN counts and the derived metrics (index: samples)
     '''
-    df_dict = {}
+    predicted = {}
     for key in sample_list:
-        primer_dict = get_oligo_primer_dict() # our full 2461 primer list
-        # dictionary of sample:list_primer(predicted)
-        sample_to_primer_dict = map_sample_to_primer(meta_sheet)
-        primer_list = [] # hold the predicted primers for the sample
-        
-        
-        
-        # if map_dict and (key in map_dict): # map_dict is for mapping sample to isolates
-        if key in map_dict:
-            # Gut_10_3_1  Typhimurium	ParatyphiA might have 2 isolates
-            for i in range(len(map_dict[key])):
-                if map_dict[key][i] in sample_to_primer_dict:
-                    primer_list.extend(sample_to_primer_dict[map_dict[key][i]])
-                else:
-                    logger.info(f"WARNING: {map_dict[key][i]} can't be found in the metasheet ")
-        else:
+        # Gut_10_3_1  Typhimurium	ParatyphiA might have 2 isolates
+        if key not in ref.sample_to_isolate:
             logger.info(f"WARNING: {key} can't be found in the sample-isolates mapping file")
-                    
-                    
-        pred_pos_primer_set = set(primer_dict.keys()) & set(primer_list)
-        pred_neg_primer_set = set(primer_dict.keys()) - pred_pos_primer_set
-        
-        obs_pos_primer_set = set(raw_df_t[key].dropna().index.tolist())
-        obs_neg_primer_set = set(primer_dict.keys()) - obs_pos_primer_set
-        
-        # this is our true positives
-        TP_primer_set = set(blast_df_t[key].dropna().index.tolist())
-        # this is standard definition of true negatives
-        TN_primer_set = obs_neg_primer_set & pred_neg_primer_set
-        # FP is refined to those we falsely indentified and they're predicted to be negatives
-        FP_primer_set = (obs_pos_primer_set - TP_primer_set) & pred_neg_primer_set
-        # FN is made of 2 parts: those we didn't identify and those didn't meet blast threshold
-        FN_primer_set = (obs_neg_primer_set - TN_primer_set) | (obs_pos_primer_set - TP_primer_set - FP_primer_set)
-        
-        df_dict[key] = list(map(len,(TP_primer_set,FP_primer_set,FN_primer_set,TN_primer_set)))
-        
-        logger.info(f"sample is: {key}")
-        logger.info(f"FP are: {FP_primer_set}")
-        logger.info(f"FN are: {FN_primer_set}")
-        logger.info(f"TN are: {TN_primer_set}")
-        logger.info(f"sanity check: {len(primer_dict)}, "
-                    f"{len(primer_dict) == sum(df_dict[key])}")
-        logger.info(f"sanity check 2, the following 3 sets SHOULD be emptry")
-        logger.info(TP_primer_set & FP_primer_set)
-        logger.info(TP_primer_set & FN_primer_set)
-        logger.info(FN_primer_set & FP_primer_set)
-        
-    return df_dict
+        predicted[key], missing_isolates = ref.predicted_primers(key)
+        for isolate in missing_isolates:
+            logger.info(f"WARNING: {isolate} can't be found in the metasheet ")
+
+    columns, (pred_pos, obs_pos, TP) = ref.encode(sample_list, predicted, raw_df, blast_df)
+    total = ref.universe(columns) # our full 2461 primer list
+
+    pred_neg = total & ~pred_pos
+    obs_neg = total & ~obs_pos
+    # this is standard definition of true negatives
+    TN = obs_neg & pred_neg
+    # FP is refined to those we falsely indentified and they're predicted to be negatives
+    FP = obs_pos & ~TP & pred_neg
+    # FN is made of 2 parts: those we didn't identify and those didn't meet blast threshold
+    FN = (obs_neg & ~TN) | (obs_pos & ~TP & ~FP)
+
+    df = utilities.confusion_metrics(sample_list, TP, FP, FN, TN)
+    logger.info(f"sanity check: {total.sum()}, {(df[['TP','FP','FN','TN']].sum(axis=1) == total.sum()).all()}")
+    logger.info(f"sanity check 2, SHOULD be 0: {((TP & FP) | (TP & FN) | (FN & FP)).sum()}")
+
+    if logger.isEnabledFor(logging.DEBUG):
+        columns = np.asarray(columns, dtype=object)
+        for i, key in enumerate(sample_list):
+            logger.debug(f"sample is: {key}")
+            logger.debug(f"FP are: {set(columns[FP[i]])}")
+            logger.debug(f"FN are: {set(columns[FN[i]])}")
+            logger.debug(f"TN are: {set(columns[TN[i]])}")
+
+    return df
 
 
-def create_report(raw_df, report_file):
+def create_report(raw_df, report_file, ref):
     '''
     this method calculates metrics like: Mean read depth, # of failed primer pairs and 
     generate a report (csv file) for state public health lab
@@ -461,6 +422,7 @@ def create_report(raw_df, report_file):
     ----------
     raw_df: a reformatted dataframe (row:samples, column:primer pairs) of original count_table
     report_file: the output file name
+    ref: the utilities.ReferenceContext, for the primer universe
 
     Returns
     ----------
@@ -468,7 +430,7 @@ def create_report(raw_df, report_file):
     '''   
     report_df = raw_df.copy()
     
-    total_primer_count = len(get_oligo_primer_dict())
+    total_primer_count = len(ref.primers)
     #this is failed primer pairs (common denominator) for all the samples
     all_failed_pp_count = total_primer_count - len(raw_df.columns)
     
@@ -489,47 +451,66 @@ def create_report(raw_df, report_file):
     
     report_df.to_csv(f'{report_file}.csv') 
     
-def main():
+def load_reference(metasheet, mapping_file):
+    '''
+    this method loads the primer universe (oligo file), the metasheet and the sample-isolates mapping file
+    into a utilities.ReferenceContext, which can then be shared by the analysis of many count tables
 
-    args = parse_argument()
-    
-    # default is INFO:20
-    if args['logging_flag']:
-        logger.setLevel(int(args['logging_flag']))
+    Returns a utilities.ReferenceContext
+    '''
+    return utilities.ReferenceContext(settings.OLIGO_FILE, map_sample_to_primer(metasheet),
+                                      map_sample_to_isolate(mapping_file), pd.read_csv(metasheet, index_col=0))
 
-    df = read_count_table(args['count_table'])
 
-    # read sample list file
-    sample_list = pd.read_csv(args['sample_list'], names = ['sample'])['sample'].tolist()
+def run_confusion_matrix(args, sample_list=None, ref=None, blast_db=None):
+    '''
+    this method runs the whole confusion matrix analysis of one count table
+
+    Parameters
+    ----------
+    args: the dictionary of the inputs (see parse_argument), the DEBUG files raw_df/blast_df are saved in
+          args['debug_dir'] if it's given (default is the current folder)
+    sample_list: the list of samples, default is to read it from args['sample_list']
+    ref: the utilities.ReferenceContext (see load_reference), default is to load it from args
+    blast_db: a Blast database of args['reference_fasta'] which is already built (see run_blast.build_blast_db),
+              default is to build it (unless args['blast_file'] is given)
+
+    Returns
+    ----------
+    the confusion matrix dataframe (index: samples)
+    '''
+    if sample_list is None:
+        # read sample list file
+        sample_list = pd.read_csv(args['sample_list'], names = ['sample'])['sample'].tolist()
     sample_list = [sample for sample in sample_list if sample not in control_list]
     sample_list.sort(key=str.lower)
     print (sample_list)
 
-	#filter columns to contain only sample names in the sample_list
-    df.columns = df.columns.str.strip() # remove potential spaces
-    seq_df = df.iloc[:,0] # keep the 1st column (sequence)
-    primer_list = [i for i in df.columns if i.split('.')[0] in sample_list]
-    df = df[primer_list]
-    df['seq'] = seq_df
-    raw_idx = df.sum().index
+    # the primer universe, metasheet and mapping lookups, loaded once for all the samples
+    if ref is None:
+        ref = load_reference(args['metasheet'], args['mapping_file'])
+    # mapping dictionary between sample and isolate
+    map_dict = ref.sample_to_isolate
+
+    # sparse count matrix of only the sample.primer columns of the samples in the sample_list
+    count_matrix = CountMatrix.from_count_table(args['count_table'], sample_list)
 
-    raw_df = df.sum() #total abundance all high quality seqs
-    raw_df.drop(['seq'], inplace=True)
+    raw_df = count_matrix.column_sums() #total abundance all high quality seqs
+    raw_idx = raw_df.index
     raw_df = split_samle_primer(raw_df, get_column_list(raw_df), sample_list, raw_idx)
 
     #generate report for SPHL
     if args['report_file']:
-        create_report(raw_df, args['report_file'])
+        create_report(raw_df, args['report_file'], ref)
 
     #print out raw amplicon sequence abundance info 
     if logger.isEnabledFor(logging.DEBUG):
-        raw_df['mean'] = raw_df.fillna(0).mean(axis=1)
-        raw_df.to_csv('raw_df', sep='\t') # save as a tsv file
+        raw_df.assign(mean=raw_df.fillna(0).mean(axis=1)).to_csv(os.path.join(args.get('debug_dir', ''), 'raw_df'),
+                                                                 sep='\t') # save as a tsv file
 
     #creat the blast df, to blast filtering all sequences
-    blast_df = create_blast_df(args['blast_file'], args['unique_fasta'], args['reference_fasta'], 100, args['metasheet'])
-    # mapping dictionary between sample and isolate
-    map_dict = map_sample_to_isolate(args['mapping_file'])
+    blast_df = create_blast_df(args['blast_file'], args['unique_fasta'], args['reference_fasta'], 100,
+                               args['metasheet'] if ref.amplicons is None else ref.amplicons, blast_db)
     
     # mapping (samples-isolates) is required on 02/15/2023
     # create a reverse mapping between isolate and samples, it runs faster this way
@@ -538,26 +519,28 @@ def main():
     blast_df = blast_map_sample_to_isolate(blast_df, rev_map_dict)
 
     # the filtered version of our count table df
-    df = merge_count_blast(df, primer_list, blast_df)
-    blast_df = df.sum()
+    blast_matrix = merge_count_blast(count_matrix, blast_df)
+    logger.info(f"peak memory after the blast filtering: {utilities.peak_memory_mb()} MB")
+    blast_df = blast_matrix.column_sums()
     blast_df = split_samle_primer(blast_df, get_column_list(blast_df), sample_list, raw_idx)
     
     #print out blast filtered amplicon sequence abundance info
     if logger.isEnabledFor(logging.DEBUG):
-        blast_df['mean'] = blast_df.fillna(0).mean(axis=1)
-        blast_df.to_csv('blast_df', sep='\t') # save as a tsv file
-
-    raw_df_t = raw_df.T
-    blast_df_t = blast_df.T
-    df_dict = build_confusion_matrix(sample_list, raw_df_t, blast_df_t, map_dict, args['metasheet'])
-    df = pd.DataFrame.from_dict(df_dict, orient='index')
-    df.columns = ['TP','FP','FN','TN']
-    df['sensitivity (TP/P)'] = df['TP']/(df['TP'] + df['FN'])
-    df['sensitivity (TP/P)'] = df['sensitivity (TP/P)'].apply(lambda x:round(x,3))
-    df['specificity (TN/N)'] = (df['TN']/(df['TN'] + df['FP'])).apply(lambda x:round(x,3))
-    df['precision (TP/TP+FP)'] = (df['TP']/(df['TP'] + df['FP'])).apply(lambda x:round(x,3))
-    df['ACC'] = (df['TP'] + df['TN'])/(df['TP'] + df['TN'] + df['FP'] + df['FN'])
-    df['ACC'] = df['ACC'].apply(lambda x:round(x,3))
+        blast_df.assign(mean=blast_df.fillna(0).mean(axis=1)).to_csv(os.path.join(args.get('debug_dir', ''), 'blast_df'),
+                                                                     sep='\t') # save as a tsv file
+
+    return build_confusion_matrix(sample_list, raw_df, blast_df, ref)
+
+
+def main():
+
+    args = parse_argument()
+    
+    # default is INFO:20
+    if args['logging_flag']:
+        logger.setLevel(int(args['logging_flag']))
+
+    df = run_confusion_matrix(args)
 
     # if we need to generate output file
     if args['output_file']:
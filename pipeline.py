@@ -78,6 +78,12 @@ def main():
 
     parser = argparse.ArgumentParser(description = 'Run Mothur QC pipeline on HMAS data.')
     parser.add_argument('-c', '--config', metavar = '', required = True, help = 'Specify configuration file')
+    parser.add_argument('-r', '--resume', action = 'store_true', help = 'Resume a failed run, skipping the stages already '
+                        'completed (as recorded in output_dir/stage_manifest.json)')
+    parser.add_argument('-s', '--per_sample', action = 'store_true', help = 'Split the batch file by sample and run each sample '
+                        'in its own mothur session (in output_dir/sample), in parallel')
+    parser.add_argument('-n', '--cores', metavar = '', type = int, default = os.cpu_count(), help = 'Total number of cores '
+                        'for the per sample mode, each session uses contigs_params processors of them (default: all cores)')
     args = parser.parse_args()
 
     cfg_file = args.config
@@ -110,7 +116,10 @@ def main():
     try:
         # import mpy_batch_v47 as mpy_batch
         import mpy_batch
-        mpy_batch.main(config)
+        if args.per_sample:
+            mpy_batch.main_per_sample(config, args.resume, args.cores)
+        else:
+            mpy_batch.main(config, args.resume)
         logger.info(f'mothur-py executed on files listed in {args.config}')
     except ModuleNotFoundError as e:
         print(f'{e}')
@@ -125,13 +134,15 @@ def main():
             print('Please check mothur logfile for details')
             logger.error('Please check mothur log file for details')
     finally:
-        # parce MOTHUR LOG file to remove the redundancy
-        if (os.access(mpy_batch.MOTHUR_LOG_FILE, os.R_OK)):
-            log_parser.parse(mpy_batch.MOTHUR_LOG_FILE)
-        else:
-            logger.error(f'mothur log file: {mpy_batch.MOTHUR_LOG_FILE} does not exist !')
-        #remove those temp files created by MOTHUR's chimera.vsearch()
-        file_remover.remove_vsearch_files(config)
+        # in per sample mode, each sample session already cleaned up its own log and temp files
+        if not args.per_sample:
+            # parce MOTHUR LOG file to remove the redundancy
+            if (os.access(mpy_batch.MOTHUR_LOG_FILE, os.R_OK)):
+                log_parser.parse(mpy_batch.MOTHUR_LOG_FILE)
+            else:
+                logger.error(f'mothur log file: {mpy_batch.MOTHUR_LOG_FILE} does not exist !')
+            #remove those temp files created by MOTHUR's chimera.vsearch()
+            file_remover.remove_vsearch_files(config)
 
 
 if __name__ == "__main__":
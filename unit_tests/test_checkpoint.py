@@ -0,0 +1,136 @@
+import unittest
+import os
+import json
+import tempfile
+import checkpoint
+
+class FakeGet:
+
+    def __init__(self):
+        self.calls = 0
+
+    def current(self):
+        self.calls += 1
+
+
+class FakeMothur:
+    """ the mothur-py attributes that StageManifest uses"""
+
+    def __init__(self):
+        self.current_files = {}
+        self.current_dirs = {}
+        self.logfile_name = 'mothur.logfile'
+        self.get = FakeGet()
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        """ set up an output folder (the commands, see command(), write their files and record their calls)"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.calls = []
+
+        return
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def command(self, name, file_type):
+        """ a mothur style command, which writes a file and makes it current"""
+        def run(**kwargs):
+            self.calls.append(name)
+            path = os.path.join(self.tmp_dir.name, f"test.{name}.{file_type}")
+            with open(path, 'w') as f:
+                f.write(f"{name} {kwargs}\n")
+            self.mothur.current_files[file_type] = path
+            self.mothur.current_dirs[name] = self.tmp_dir.name
+        return run
+
+    def run_chain(self, resume=False):
+        """ a command chain of 2 mothur commands and a python-side step, in a new mothur session"""
+        self.mothur = FakeMothur()
+        stages = checkpoint.StageManifest(self.tmp_dir.name, resume)
+        stages.bind(self.mothur)
+        stages.run('make.contigs', self.command('contigs', 'fasta'), file='test.batch')
+        stages.run('make.group', self.command('group', 'group'), fasta='current')
+        value = stages.value('count', lambda path: len(open(path).read()), os.path.join(self.tmp_dir.name, "test.contigs.fasta"))
+        return stages, value
+
+    def test_record(self):
+        """Test the manifest of a run: written atomically, with the files each stage made current as its outputs"""
+        stages, value = self.run_chain()
+        self.assertFalse(os.path.exists(f"{stages.path}.tmp"))
+        with open(stages.path) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest['logfile'], 'mothur.logfile')
+        self.assertEqual([stage['name'] for stage in manifest['stages']], ['make.contigs', 'make.group', 'count'])
+        self.assertEqual(list(manifest['stages'][1]['outputs']), [self.mothur.current_files['group']])
+        self.assertEqual(manifest['stages'][1]['params'], {'fasta': 'current'})
+        self.assertEqual(manifest['stages'][2]['value'], value)
+
+        return
+
+    def test_resume(self):
+        """Test that a resumed run skips the intact stages, and restores mothur's current files before the first changed one"""
+        self.run_chain()
+        with open(self.mothur.current_files['group'], 'a') as f:
+            f.write("changed\n")
+        self.calls = []
+
+        stages, value = self.run_chain(resume=True)
+        self.assertEqual(self.calls, ['group'])
+        self.assertEqual(stages.skipped, 1)
+        self.assertEqual(self.mothur.get.calls, 1)
+        # the fasta (and output dir) of the skipped make.contigs is current again (the fake mothur object is new)
+        self.assertEqual(set(self.mothur.current_dirs), {'contigs', 'group'})
+        self.assertEqual(self.mothur.current_files['fasta'], os.path.join(self.tmp_dir.name, "test.contigs.fasta"))
+        self.assertEqual(set(self.mothur.current_files), {'fasta', 'group'})
+        self.assertEqual(value, len("contigs {'file': 'test.batch'}\n"))
+
+        return
+
+    def test_resume_all(self):
+        """Test that a resumed run of intact stages runs nothing, and returns the recorded values"""
+        _, value = self.run_chain()
+        self.calls = []
+        stages, resumed_value = self.run_chain(resume=True)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(stages.skipped, 3)
+        self.assertEqual(resumed_value, value)
+        self.assertEqual(self.mothur.get.calls, 0)
+
+        return
+
+    def test_resume_changed_input(self):
+        """Test that a stage runs again if one of its inputs changed: the oligo file, or a raw reads file of the batch file"""
+        batch_file = os.path.join(self.tmp_dir.name, "test.batch")
+        oligo_file = os.path.join(self.tmp_dir.name, "test.oligos")
+        reads = [os.path.join(self.tmp_dir.name, f"S1_R{read}_001.fastq") for read in (1, 2)]
+        for file, content in ((batch_file, "S1_R1_001.fastq S1_R2_001.fastq\n"), (oligo_file, "primer\tACGT\tTTGG\tP1\n"),
+                              (reads[0], "@r1\nACGT\n+\nIIII\n"), (reads[1], "@r1\nTTGG\n+\nIIII\n")):
+            with open(file, 'w') as f:
+                f.write(content)
+
+        def run_contigs(resume=False):
+            self.mothur = FakeMothur()
+            stages = checkpoint.StageManifest(self.tmp_dir.name, resume)
+            stages.bind(self.mothur)
+            stages.run('make.contigs', self.command('contigs', 'fasta'), file=batch_file, oligos=oligo_file)
+            return stages
+
+        stages = run_contigs()
+        self.assertEqual(list(stages.stages[0]['inputs']), [batch_file, reads[0], reads[1], oligo_file])
+        self.assertEqual(run_contigs(resume=True).skipped, 1)
+
+        for changed in (reads[1], oligo_file):
+            with open(changed, 'a') as f:
+                f.write("changed\n")
+            self.calls = []
+            self.assertEqual(run_contigs(resume=True).skipped, 0)
+            self.assertEqual(self.calls, ['contigs'])
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+import os
+import tempfile
+import count_cache as cc
+
+class TestCount_cache(unittest.TestCase):
+
+    def setUp(self):
+        """ set up a small full format count_table"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.count_file = os.path.join(self.tmp_dir.name, "test.count_table")
+
+        with open(self.count_file, 'w') as f:
+            f.write("Representative_Sequence\ttotal\tS1.P1\tS1.P2\tS2.P1\n"
+                    "r1\t3\t1\t0\t2\nr22\t1\t0\t1\t0\nr5\t5\t0\t0\t5\n")
+
+        return
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_read_columns(self):
+        """Test loading only the sample.primer columns of some samples"""
+        columns = cc.sample_columns(self.count_file, ['S1'])
+        self.assertEqual(columns, ['S1.P1', 'S1.P2'])
+
+        df = cc.read_count_table(self.count_file, columns)
+        self.assertEqual(df.columns.tolist(), ['Representative_Sequence', 'S1.P1', 'S1.P2'])
+        self.assertEqual(df['Representative_Sequence'].tolist(), ['r1', 'r22', 'r5'])
+        self.assertEqual(df['S1.P2'].tolist(), [0, 1, 0])
+        self.assertTrue(os.path.isfile(os.path.join(cc.cache_dir(self.count_file), cc.INDEX_FILE)))
+
+        return
+
+    def test_stale_cache(self):
+        """Test that the cache is rebuilt when the count_table changes"""
+        self.assertEqual(cc.read_count_table(self.count_file)['total'].tolist(), [3, 1, 5])
+
+        with open(self.count_file, 'a') as f:
+            f.write("r7\t2\t2\t0\t0\n")
+        df = cc.read_count_table(self.count_file)
+        self.assertEqual(df['total'].tolist(), [3, 1, 5, 2])
+        self.assertEqual(df['Representative_Sequence'].tolist(), ['r1', 'r22', 'r5', 'r7'])
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+import os
+import tempfile
+import pandas as pd
+from count_matrix import CountMatrix, split_sample_primer
+
+class TestCount_matrix(unittest.TestCase):
+
+    def setUp(self):
+        """ set up a small full format count_table"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.count_file = os.path.join(self.tmp_dir.name, "test.count_table")
+
+        with open(self.count_file, 'w') as f:
+            f.write("Representative_Sequence\ttotal\tS1.P1\tS1.P2\tS2.P1\tS3.P1\n"
+                    "r1\t3\t1\t0\t2\t0\nr2\t1\t0\t1\t0\t0\nr3\t5\t0\t0\t5\t0\n")
+        self.matrix = CountMatrix.from_count_table(self.count_file, ['S1', 'S2', 'S3'])
+
+        return
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_sums(self):
+        """Test the group-sums by column, sample and primer"""
+        self.assertEqual(len(self.matrix.counts), 4)  # only the non-zero cells
+        self.assertEqual(self.matrix.column_sums().to_dict(), {'S1.P1': 1, 'S1.P2': 1, 'S2.P1': 7, 'S3.P1': 0})
+        self.assertEqual(self.matrix.sum_by_sample().to_dict(), {'S1': 2, 'S2': 7, 'S3': 0})
+        self.assertEqual(self.matrix.sum_by_primer().to_dict(), {'P1': 8, 'P2': 1})
+
+        return
+
+    def test_filters(self):
+        """Test filtering by sequences and by (sequence, sample.primer) pairs"""
+        long_df = self.matrix.filter_seqs(['r1']).to_long_df()
+        self.assertEqual(list(zip(long_df['sample_primer'], long_df['count'])), [('S1.P1', 1), ('S2.P1', 2)])
+
+        # r2 has no reads in S1.P1, the column is still kept (with 0), rX is not in the count table
+        pairs = self.matrix.filter_pairs(['r1', 'r2', 'r2', 'rX'], ['S2.P1', 'S1.P1', 'S1.P1', 'S3.P1'])
+        self.assertEqual(pairs.column_sums().to_dict(), {'S1.P1': 0, 'S2.P1': 2})
+
+        return
+
+    def test_dataframe(self):
+        """Test the conversion to the wide dataframe view and back"""
+        df = self.matrix.to_dataframe()
+        self.assertEqual(df.columns.tolist(), ['seq', 'S1.P1', 'S1.P2', 'S2.P1', 'S3.P1'])
+        self.assertEqual(df['S2.P1'].tolist(), [2, 0, 5])
+
+        matrix = CountMatrix.from_dataframe(df, ['S2'])
+        self.assertEqual(matrix.column_sums().to_dict(), {'S2.P1': 7})
+
+        return
+
+    def test_split_sample_primer(self):
+        """Test the (sample x primer) reshaping, 0 vs None for the sample.primer missing from the count table"""
+        sr = pd.Series([2, 1, 1], index=['S1.P1', 'S2.P1', 'S1.P2'])
+        raw_idx = pd.Index(['S1.P1', 'S2.P1', 'S1.P2', 'S3.P2'])
+
+        df = split_sample_primer(sr, ['P1', 'P2'], ['S1', 'S2', 'S3'], raw_idx)
+        self.assertEqual(df.loc['S1'].tolist(), [2, 1])
+        self.assertEqual(df.loc['S3', 'P2'], 0)  # in the count table, but no reads
+        self.assertTrue(df[['P2']].loc[['S2']].isna().all().all())
+        self.assertTrue(pd.isna(df.loc['S3', 'P1']))
+
+        df = split_sample_primer(sr, ['P1', 'P2'], ['S1', 'S2', 'S3'])
+        self.assertEqual(df.values.tolist(), [[2, 1], [1, 0], [0, 0]])
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import os
+import sys
+import gzip
+import tempfile
+import count_rawseqs
+import primer_index
+
+class TestCount_rawseqs(unittest.TestCase):
+
+    def setUp(self):
+        """ set up a gzipped fastq (without a trailing newline) and an oligo file"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.fastq = os.path.join(self.tmp_dir.name, "S1_R1_001.fastq.gz")
+        self.oligo_file = os.path.join(self.tmp_dir.name, "test.oligos")
+
+        with gzip.open(self.fastq, 'wt') as f:
+            f.write("@r1\nACGATTAAA\n+\nIIIIIIIII\n@r2\nCCTAATTT\n+\nIIIIIIII\n@r3\nGGGG\n+\nIIII")
+        with open(self.oligo_file, 'w') as f:
+            f.write("primer\tACGATT\tTTAGG\tP1\nprimer\tTTGACCA\tCAGGTA\tP2\n")
+
+        return
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_count_lines(self):
+        """Test the line count of a gz file, read in blocks smaller than a line"""
+        chunk_size, count_rawseqs.CHUNK_SIZE = count_rawseqs.CHUNK_SIZE, 3
+        try:
+            self.assertEqual(count_rawseqs.count_lines(self.fastq), 12)
+        finally:
+            count_rawseqs.CHUNK_SIZE = chunk_size
+
+        return
+
+    def test_count_primer_reads(self):
+        """Test the observed reads per primer (forward primer, or reverse primer on the other strand)"""
+        index = primer_index.PrimerIndex.from_oligo_file(self.oligo_file)
+        reads, primer_counts = count_rawseqs.count_primer_reads(self.fastq, index)
+        self.assertEqual(reads, 3)
+        self.assertEqual(dict(primer_counts), {'P1': 2})
+
+        return
+
+    def test_main(self):
+        """Test the expected reads per primer (the number of primers from the oligo file), and the primer table"""
+        output_file = os.path.join(self.tmp_dir.name, "counts.tsv")
+        primer_table = os.path.join(self.tmp_dir.name, "primers.tsv")
+        argv = sys.argv
+        sys.argv = ['count_rawseqs.py', self.tmp_dir.name, output_file, '-n', '1', '-l', self.oligo_file, '-p', primer_table]
+        try:
+            count_rawseqs.main()
+        finally:
+            sys.argv = argv
+
+        with open(output_file) as f:
+            self.assertEqual(f.read(), "S1_R1_001.fastq.gz\t1.5\n")
+        with open(primer_table) as f:
+            self.assertEqual(f.read().splitlines()[1:], ["S1_R1_001.fastq.gz\tP1\t1.5\t2", "S1_R1_001.fastq.gz\tP2\t1.5\t0"])
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
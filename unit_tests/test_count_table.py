@@ -0,0 +1,98 @@
+import unittest
+import os
+import tempfile
+import count_table as ct
+
+class TestCount_table(unittest.TestCase):
+
+    def setUp(self):
+        """ set up a small names file and group file (sample.primer groups)"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.name_file = os.path.join(self.tmp_dir.name, "test.names")
+        self.group_file = os.path.join(self.tmp_dir.name, "test.groups")
+
+        with open(self.name_file, 'w') as f:
+            f.write("r1\tr1,r2,r3\nr4\tr4\nr5\tr5,r6\n")
+        with open(self.group_file, 'w') as f:
+            f.write("r1\tS2.P1\nr2\tS1.P1\nr3\tS2.P1\nr4\tS1.P2\nr5\tS1.P1\nr6\tS2.P2\nr7\tS1.P1\n")
+
+        return
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_compressed_format(self):
+        """Test the compressed count_table (groupIndex,abundance) and its MOTHUR style name"""
+        count_file = ct.build_count_table(self.name_file, self.group_file)
+        self.assertEqual(count_file, os.path.join(self.tmp_dir.name, "test.count_table"))
+
+        with open(count_file) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[1], "#1,S1.P1\t2,S1.P2\t3,S2.P1\t4,S2.P2")
+        self.assertEqual(lines[2], "Representative_Sequence\ttotal")
+        self.assertEqual(lines[3:], ["r1\t3\t1,1\t3,2", "r4\t1\t2,1", "r5\t2\t1,1\t4,1"])
+
+        return
+
+    def test_full_format(self):
+        """Test the full format count_table, with small batches so that rows span several batches"""
+        batch_reads = ct.BATCH_READS
+        ct.BATCH_READS = 2
+        count_file = ct.build_count_table(self.name_file, self.group_file, compress=False)
+        ct.BATCH_READS = batch_reads
+
+        with open(count_file) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines, ["Representative_Sequence\ttotal\tS1.P1\tS1.P2\tS2.P1\tS2.P2",
+                                 "r1\t3\t1\t0\t2\t0",
+                                 "r4\t1\t0\t1\t0\t0",
+                                 "r5\t2\t1\t0\t0\t1"])
+
+        return
+
+    def test_hash_collisions(self):
+        """Test that the reads whose hashes collide (in different groups) are still counted in their own group"""
+        read_hash = ct.read_hash
+        ct.read_hash = lambda name: 7 if name in ('r2', 'r3', 'r6') else hash(name)
+        try:
+            count_file = ct.build_count_table(self.name_file, self.group_file)
+        finally:
+            ct.read_hash = read_hash
+
+        with open(count_file) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[3:], ["r1\t3\t1,1\t3,2", "r4\t1\t2,1", "r5\t2\t1,1\t4,1"])
+
+        return
+
+    def test_missing_read(self):
+        """Test that a read missing from the group file is an error"""
+        with open(self.name_file, 'a') as f:
+            f.write("r8\tr8\n")
+        with self.assertRaises(RuntimeError):
+            ct.build_count_table(self.name_file, self.group_file)
+
+        return
+
+    def test_merge(self):
+        """Test merging a compressed and a full format count_table of 2 samples"""
+        count_file = ct.build_count_table(self.name_file, self.group_file)
+        other_file = os.path.join(self.tmp_dir.name, "other.count_table")
+        with open(other_file, 'w') as f:
+            f.write("Representative_Sequence\ttotal\tS1.P1\tS3.P1\nq1\t5\t1\t4\n")
+        merged_file = ct.merge_count_tables([count_file, other_file],
+                                            os.path.join(self.tmp_dir.name, "merged.count_table"))
+
+        with open(merged_file) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines, ["Representative_Sequence\ttotal\tS1.P1\tS1.P2\tS2.P1\tS2.P2\tS3.P1",
+                                 "r1\t3\t1\t0\t2\t0\t0",
+                                 "r4\t1\t0\t1\t0\t0\t0",
+                                 "r5\t2\t1\t0\t0\t1\t0",
+                                 "q1\t5\t1\t0\t0\t0\t4"])
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
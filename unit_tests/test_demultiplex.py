@@ -0,0 +1,100 @@
+import unittest
+import os
+import gzip
+import tempfile
+import importlib.util
+
+# helper_scripts/bin/run_cutadapt.py has the same module name as helper_scripts/run_cutadapt.py
+spec = importlib.util.spec_from_file_location(
+    'bin_run_cutadapt', os.path.join(os.path.dirname(__file__), '..', 'helper_scripts', 'bin', 'run_cutadapt.py'))
+bin_run_cutadapt = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(bin_run_cutadapt)
+
+class TestDemultiplex(unittest.TestCase):
+
+    def setUp(self):
+        """ set up an oligo file of 2 primer pairs, and R1/R2 reads of 3 pairs (the last one has no primer)"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.oligo_file = os.path.join(self.tmp_dir.name, "test.oligos")
+        self.r1 = os.path.join(self.tmp_dir.name, "S1_R1_001.fastq.gz")
+        self.r2 = os.path.join(self.tmp_dir.name, "S1_R2_001.fastq.gz")
+
+        with open(self.oligo_file, 'w') as f:
+            f.write("primer\tACGATT\tTTAGG\tP1\nprimer\tTTGRCCA\tCAGGTA\tP2\n")
+        # P1: R1 = forward primer, insert, rc reverse primer (full), R2 = reverse primer, insert, rc forward primer (partial)
+        reads = [("r1 1:N", "ACGATTGGGGCCCCCCTAATT", "TTAGGGGGGCCCCAATC"),
+                 ("r2 1:N", "TTGACCATTTTTTTACCTG", "CAGGTATTTTTTT"),
+                 ("r3 1:N", "GGGGGGGGGG", "CCCCCCCCCC")]
+        for fastq, read in ((self.r1, 1), (self.r2, 2)):
+            with gzip.open(fastq, 'wt') as f:
+                f.writelines(f"@{r[0]}\n{r[read]}\n+\n{'I' * len(r[read])}\n" for r in reads)
+
+        return
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_primer_index(self):
+        """Test the anchored primer matches, for indexed and (too ambiguous) unindexed primers"""
+        index = bin_run_cutadapt.PrimerIndex({'P1': 'ACGATT', 'P2': 'ACGRTTAC', 'P3': 'TTGACC'})
+        self.assertEqual(index.match("ACGATTACGG"), {'P1': 6, 'P2': 8})
+        self.assertEqual(index.match("ACGGTTACGG"), {'P2': 8})
+        self.assertEqual(index.match("GACGATT"), {})
+
+        max_expansion, bin_run_cutadapt.MAX_PREFIX_EXPANSION = bin_run_cutadapt.MAX_PREFIX_EXPANSION, 1
+        try:
+            index = bin_run_cutadapt.PrimerIndex({'P1': 'ACGATT', 'P2': 'ACGRTTAC'})
+        finally:
+            bin_run_cutadapt.MAX_PREFIX_EXPANSION = max_expansion
+        self.assertEqual(index.unindexed, ['P2'])
+        self.assertEqual(index.match("ACGGTTACGG"), {'P2': 8})
+
+        return
+
+    def test_trim_3prime(self):
+        """Test the 3' adapter position: leftmost full match, else the longest partial match at the end"""
+        adapter = bin_run_cutadapt.prefix_patterns('CCTRA')
+        self.assertEqual(bin_run_cutadapt.trim_3prime("GGCCTAAGGCCTGA", adapter), 2)
+        self.assertEqual(bin_run_cutadapt.trim_3prime("GGGGGCCTG", adapter), 5)
+        self.assertEqual(bin_run_cutadapt.trim_3prime("GGGGGGGCC", adapter), 9)
+        self.assertEqual(bin_run_cutadapt.trim_3prime("GGGGGGGCC", adapter, min_overlap=2), 7)
+
+        return
+
+    def test_buffered_writer(self):
+        """Test that all the buffers are written out once their total size is reached"""
+        files = [os.path.join(self.tmp_dir.name, name) for name in ("a.fastq", "b.fastq")]
+        writer = bin_run_cutadapt.BufferedWriter(max_size=10)
+        writer.write(files[0], "12345")
+        writer.write(files[1], "1234")
+        self.assertFalse(os.path.exists(files[0]))
+        writer.write(files[1], "5")
+        self.assertEqual((writer.size, writer.buffers), (0, {}))
+        writer.write(files[0], "6")
+        writer.close()
+
+        for file, content in zip(files, ("123456", "12345")):
+            with open(file) as f:
+                self.assertEqual(f.read(), content)
+
+        return
+
+    def test_demultiplex(self):
+        """Test the trimmed read pairs of each primer, with cutadapt style headers"""
+        bin_run_cutadapt.demultiplex('S1', self.r1, self.r2, self.tmp_dir.name, self.oligo_file)
+
+        outputs = {}
+        for key in ('P1', 'P2'):
+            for read in ('1', '2'):
+                with open(os.path.join(self.tmp_dir.name, f"S1.{key}.{read}.fastq")) as f:
+                    outputs[f"{key}.{read}"] = f.read()
+        self.assertEqual(outputs['P1.1'], "@r1  adapter=P1=S1 1:N\nGGGGCCCC\n+\nIIIIIIII\n")
+        self.assertEqual(outputs['P1.2'], "@r1  adapter=P1=S1 1:N\nGGGGCCCC\n+\nIIIIIIII\n")
+        self.assertEqual(outputs['P2.1'], "@r2  adapter=P2=S1 1:N\nTTTTTT\n+\nIIIIII\n")
+        self.assertEqual(outputs['P2.2'], "@r2  adapter=P2=S1 1:N\nTTTTTTT\n+\nIIIIIII\n")
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+import os
+import tempfile
+import file_remover
+
+class TestFile_remover(unittest.TestCase):
+
+    def setUp(self):
+        """ set up the per sample output folder of S10 (S1 is another sample), with the sample's own files and
+        the vsearch temp files of 2 primers"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.oligo_file = os.path.join(self.tmp_dir.name, "test.oligos")
+        with open(self.oligo_file, 'w') as f:
+            f.write("primer\tACGATT\tTTAGG\tOG0001primerGroup1\nprimer\tTTGACCA\tCAGGTA\tOG0002primerGroup2\n"
+                    "barcode\tNONE\tNONE\tS1\nbarcode\tNONE\tNONE\tS10\n")
+        self.config = {'file_inputs': {'oligos': self.oligo_file, 'output_dir': self.tmp_dir.name}}
+
+        self.sample_files = ["S10.batch", "S10.final.count_table", "S10.final.fasta", "S10.trim.contigs.good.unique.fasta"]
+        self.temp_files = ["S10.trim.contigs.good.unique.OG0001primerGroup1.temp",
+                           "S10.trim.contigs.good.unique.OG0002primerGroup2.fasta"]
+        for file in self.sample_files + self.temp_files:
+            open(os.path.join(self.tmp_dir.name, file), 'w').close()
+
+        return
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_remove_vsearch_files(self):
+        """Test that the temp files of the primers are removed, but not the sample's own files
+        (even though the barcode ID S1 is a substring of the sample name)"""
+        file_remover.remove_vsearch_files(self.config, primers_only=True)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir.name)), sorted(self.sample_files + ["test.oligos"]))
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+import os
+import tempfile
+import group
+
+class TestGroup(unittest.TestCase):
+
+    def setUp(self):
+        """ set up a small MOTHUR log file"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.log_file = os.path.join(self.tmp_dir.name, "test.logfile")
+
+        with open(self.log_file, 'w') as f:
+            f.write("mothur > unique.seqs(fasta=current)\n"
+                    "fasta=/a/x.trim.contigs.fasta\n"
+                    "/a/x.scrap.contigs.fasta\n"
+                    "group=/a/x.groups\n")
+
+        return
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_current_file(self):
+        """Test that only the most current file is returned, as the log grows"""
+        self.assertEqual(group.get_current_file(self.log_file, 'fasta'), "/a/x.trim.contigs.fasta")
+        self.assertEqual(group.get_current_file(self.log_file), "/a/x.groups")
+
+        with open(self.log_file, 'a') as f:
+            f.write("fasta=/a/x.unique.fasta\ngroup=/a/x.gro")  # mothur is still writing the last line
+        self.assertEqual(group.get_current_file(self.log_file, 'fasta'), "/a/x.unique.fasta")
+        self.assertEqual(group.get_current_file(self.log_file), "/a/x.groups")
+
+        with open(self.log_file, 'a') as f:
+            f.write("ups_new\ncount=/a/x.count_table\n")
+        self.assertEqual(group.get_current_file(self.log_file), "/a/x.groups_new")
+        # count wasn't asked for before, it is found in the part of the log already read
+        self.assertEqual(group.get_current_file(self.log_file, 'count'), "/a/x.count_table")
+
+        return
+
+    def test_search(self):
+        """Test the first match of the trim/scrap contigs fasta (check_filesize)"""
+        good, scrap = group.get_log_index(self.log_file).search(r'.+trim\.contigs\.fasta',
+                                                                r'.+scrap\.contigs\.fasta')
+        self.assertEqual(good, "fasta=/a/x.trim.contigs.fasta")
+        self.assertEqual(scrap, "/a/x.scrap.contigs.fasta")
+
+        return
+
+    def test_missing_file(self):
+        """Test that a file type missing from the log is an error"""
+        with self.assertRaises(RuntimeError):
+            group.get_current_file(self.log_file, 'name')
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+import os
+import sys
+import argparse
+import tempfile
+import hmas2_confusion_matrix as hmas2
+
+# a stand-in for parse_count_table_confusion_matrix.py, which reports what each folder's analysis was given
+FAKE_SCRIPT = '''
+import os, logging
+import pandas as pd
+
+logger = logging.getLogger('fake_confusion_matrix')
+
+class blast:
+    BLAST_SHARDS = 0
+
+    @staticmethod
+    def build_blast_db(reference):
+        return f'{reference}.db'
+
+def load_reference(metasheet, mapping_file):
+    return {'metasheet': metasheet, 'mapping_file': mapping_file}
+
+def run_confusion_matrix(args, sample_list=None, ref=None, blast_db=None):
+    return pd.DataFrame({'blast_db': [blast_db], 'shards': [blast.BLAST_SHARDS], 'metasheet': [ref['metasheet']],
+                         'count_table': [os.path.basename(args['count_table'])], 'debug_dir': [args['debug_dir']],
+                         'pid': [os.getpid()]}, index=sample_list)
+'''
+
+class TestHmas2_confusion_matrix(unittest.TestCase):
+
+    def setUp(self):
+        """ set up 3 sample folders (S3 has no unique sequences, S2 has its count_table in temp) and the fake script"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.input = os.path.join(self.tmp_dir.name, "input")
+        for folder, sequences in (("S1", ">s\nACGT\n"), ("S2", ">s\nACGT\n"), ("S3", "")):
+            os.makedirs(os.path.join(self.input, folder, "temp"))
+            with open(os.path.join(self.input, folder, f"{folder}.final.unique.fasta"), 'w') as f:
+                f.write(sequences)
+        open(os.path.join(self.input, "S1", "S1.final.count_table"), 'w').close()
+
+        script = os.path.join(self.tmp_dir.name, "fake_confusion_matrix.py")
+        with open(script, 'w') as f:
+            f.write(FAKE_SCRIPT)
+        self.args = argparse.Namespace(input=self.input, reference="ref.fasta", metasheet="meta.csv",
+                                       mapping="map.csv", script=script)
+
+        return
+
+    def tearDown(self):
+        # load_script puts the script's folder on sys.path
+        if self.tmp_dir.name in sys.path:
+            sys.path.remove(self.tmp_dir.name)
+        hmas2.worker.clear()
+        self.tmp_dir.cleanup()
+
+    def test_run_folders(self):
+        """Test that every folder with sequences is analysed in a worker, with the shared reference and Blast database"""
+        df = hmas2.run_folders(self.args, cores=2).sort_index()
+        self.assertEqual(list(df.index), ["S1", "S2"])
+        self.assertEqual(list(df['blast_db']), ["ref.fasta.db"] * 2)
+        self.assertEqual(list(df['metasheet']), ["meta.csv"] * 2)
+        self.assertEqual(list(df['count_table']), ["S1.final.count_table", "S2.final.count_table"])
+        self.assertTrue((df['shards'] >= 1).all())
+        self.assertNotIn(os.getpid(), list(df['pid']))
+        # each folder has its own output file and DEBUG files folder
+        for folder in ("S1", "S2"):
+            self.assertEqual(df.loc[folder, 'debug_dir'], f"{self.input}/{folder}")
+            self.assertTrue(os.path.isfile(os.path.join(self.input, folder, f"confusion_matrix_{folder}")))
+
+        return
+
+    def test_init_worker(self):
+        """Test that the worker state is loaded once, and shared by the folders of the worker"""
+        hmas2.init_worker(self.args.script, {'metasheet': 'meta.csv'}, 'ref.db', 3)
+        self.assertEqual(hmas2.worker['script'].blast.BLAST_SHARDS, 3)
+
+        df = hmas2.process_folder(("S2", hmas2.get_fixed_options(self.args), self.args))
+        self.assertEqual(df.loc["S2", 'blast_db'], 'ref.db')
+        self.assertEqual(df.loc["S2", 'count_table'], "S2.final.count_table")
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+import os
+import tempfile
+import log_parser
+
+class TestLog_parser(unittest.TestCase):
+
+    def setUp(self):
+        """ set up a small MOTHUR log file of 3 commands"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.log_file = os.path.join(self.tmp_dir.name, "test.logfile")
+
+        command = ("Linux version\nmothur v.1.48.0\n\nmothur > set.logfile(name=test.logfile, append=T)\n{error}\n\n\n"
+                   "mothur > {name}(fasta=current)\n{output}\n"
+                   "mothur > get.current()\nfasta=/o/b.fasta\n\nmothur > quit()\n")
+        with open(self.log_file, 'w') as f:
+            f.write(command.format(error='', name='unique.seqs', output='done\n'))
+            f.write(command.format(error='[ERROR]: bad', name='chimera.vsearch', output='x\n' * 3000))
+            f.write(command.format(error='', name='summary.seqs', output='done\n'))
+
+        return
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_parse(self):
+        """Test the compacted MOTHUR log file"""
+        log_parser.parse(self.log_file)
+        with open(self.log_file) as f:
+            log = f.read()
+
+        self.assertEqual(log.count('version'), 1)  # only the first banner is kept
+        self.assertNotIn('get.current', log)
+        self.assertEqual(log.count('set.logfile'), 1)  # the one with the ERROR
+        self.assertIn('[ERROR]: bad', log)
+        self.assertIn('### we deleted some output ###', log)
+        self.assertLess(len(log), 5000)
+        self.assertFalse(os.path.exists(f'{self.log_file}.tmp'))
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+import os
+import pickle
+import tempfile
+import numpy as np
+import primer_index
+
+class TestPrimer_index(unittest.TestCase):
+
+    def setUp(self):
+        """ set up an oligo file with a degenerate primer"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.oligo_file = os.path.join(self.tmp_dir.name, "test.oligos")
+
+        with open(self.oligo_file, 'w') as f:
+            f.write("primer\tACGRTTAC\tGGCATTNA\tP1\nprimer\tACGATT\tTTAGG\tP2\n")
+        self.index = primer_index.PrimerIndex.from_oligo_file(self.oligo_file)
+
+        return
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_assign(self):
+        """Test the primer pair and strand of each read, with the IUPAC codes and the gap between the primers"""
+        reads = ["ACGGTTACCCCCTAAATGCC", # P1, forward primer with G for R, reverse primer with T for N
+                 "GGCATTCAAAGTAACCGT",   # P1 on the '-' strand
+                 "TTACGATTACCTAA",       # P2 with a 2 bases gap
+                 "ACGATTAC",             # only the forward primers
+                 ""]
+        self.assertEqual(self.index.assign(reads), [[('P1', '+')], [('P1', '-')], [('P2', '+')], [], []])
+        self.assertEqual(self.index.assign(reads, min_gap=3)[2], [])
+        self.assertEqual(self.index.assign(reads, both=False)[3], [('P1', '+'), ('P2', '+')])
+
+        return
+
+    def test_batch_array(self):
+        """Test a 0 padded uint8 batch, and the index after a pickle round trip"""
+        index = pickle.loads(pickle.dumps(self.index))
+        batch = np.zeros((2, 20), dtype=np.uint8)
+        for row, read in enumerate([b"ACGATTACCTAA", b"NNACGATTACCTAA"]):
+            batch[row, :len(read)] = np.frombuffer(read, dtype=np.uint8)
+        self.assertEqual(index.assign(batch), [[('P2', '+')], [('P2', '+')]])
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
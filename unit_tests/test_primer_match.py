@@ -0,0 +1,30 @@
+import unittest
+import primer_match
+
+class TestPrimer_match(unittest.TestCase):
+
+    def test_degenerate_match(self):
+        """Test that each concrete sequence of a degenerate primer matches exactly"""
+        matcher = primer_match.PrimerMatcher("ACRYN", 0)
+        for seq in ["ACATG", "acgcA", "TTACGTT"]:
+            found = matcher.search(seq)
+            self.assertIsNotNone(found)
+            self.assertEqual(found.errors, 0)
+        self.assertEqual(matcher.search("TTACGTT").span(), (2, 7))
+        self.assertIsNone(matcher.search("ACTTG"))
+
+        return
+
+    def test_errors(self):
+        """Test the mismatch, insertion and deletion budget"""
+        matcher = primer_match.PrimerMatcher("GATTACAGATTACA", 2)
+        found = matcher.search("CCCGATTCCAGATTTACACCC") # 1 mismatch and 1 insertion
+        self.assertEqual((found.group(), found.errors), ("GATTCCAGATTTACA", 2))
+        self.assertIsNone(matcher.search("CCCGATTCCAGTTTTACACCC")) # 3 errors
+        self.assertIs(primer_match.get_matcher("GATTACA", 3), primer_match.get_matcher("GATTACA", 3))
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
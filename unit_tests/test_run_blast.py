@@ -0,0 +1,162 @@
+import unittest
+import os
+import sys
+import tempfile
+import run_blast
+
+@unittest.skipIf(os.name == 'nt', "the fake makeblastdb is a shell script")
+class TestRun_blast(unittest.TestCase):
+
+    def setUp(self):
+        """ set up a reference fasta and a fake makeblastdb which records its calls"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.reference = os.path.join(self.tmp_dir.name, "ref.fasta")
+        self.cache_dir = os.path.join(self.tmp_dir.name, "cache")
+        self.calls = os.path.join(self.tmp_dir.name, "calls")
+        self.makeblastdb = os.path.join(self.tmp_dir.name, "makeblastdb")
+
+        with open(self.reference, 'w') as f:
+            f.write(">amp1\nACGT\n")
+        with open(self.makeblastdb, 'w') as f:
+            f.write(f'#!/bin/sh\necho "$@" >> {self.calls}\n'
+                    'while [ $# -gt 0 ]; do [ "$1" = "-out" ] && touch "$2.nsq"; shift; done\n')
+        os.chmod(self.makeblastdb, 0o755)
+
+        return
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_cached_blast_db(self):
+        """Test that the database is built once per reference content, and rebuilt when the content changes"""
+        db = run_blast.cached_blast_db(self.reference, 'nucl', self.makeblastdb, self.cache_dir)
+        self.assertTrue(os.path.isfile(f"{db}.nsq"))
+        self.assertEqual(os.path.basename(db), "db")
+        self.assertEqual(run_blast.cached_blast_db(self.reference, 'nucl', self.makeblastdb, self.cache_dir), db)
+
+        with open(self.reference, 'a') as f:
+            f.write(">amp2\nGGCC\n")
+        new_db = run_blast.cached_blast_db(self.reference, 'nucl', self.makeblastdb, self.cache_dir)
+        self.assertNotEqual(new_db, db)
+        with open(self.calls) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+        return
+
+    def test_cached_blast_db_renamed(self):
+        """Test that a copy of the reference under another name gets the same (existing) database"""
+        db = run_blast.cached_blast_db(self.reference, 'nucl', self.makeblastdb, self.cache_dir)
+        other = os.path.join(self.tmp_dir.name, "other_name.fasta")
+        with open(self.reference) as f_in, open(other, 'w') as f_out:
+            f_out.write(f_in.read())
+        other_db = run_blast.cached_blast_db(other, 'nucl', self.makeblastdb, self.cache_dir)
+        self.assertEqual(other_db, db)
+        self.assertTrue(os.path.isfile(f"{other_db}.nsq"))
+
+        return
+
+    def test_shard_fasta(self):
+        """Test that the shards keep every (multi-line) record and have about the same total sequence length"""
+        fasta = os.path.join(self.tmp_dir.name, "query.fasta")
+        with open(fasta, 'w') as f:
+            f.write(">s1\nAAAAAAAA\nAA\n>s2\nCCCC\n>s3\nGGGG\n>s4\nTT\n")
+        shard_files = run_blast.shard_fasta(fasta, 2, self.tmp_dir.name)
+
+        shards = []
+        for shard_file in shard_files:
+            with open(shard_file) as f:
+                shards.append(f.read())
+        self.assertEqual(shards, [">s1\nAAAAAAAA\nAA\n", ">s2\nCCCC\n>s3\nGGGG\n>s4\nTT\n"])
+
+        return
+
+    def test_read_hits(self):
+        """Test that the blast rows are typed and filtered as they are read, and all copied to the raw output"""
+        names = ["seq", "primer", "query_len", "subj_len", "len_aln", "eval", "cov", "pident", "mismatch"]
+        rows = ["q1\tamp1\t100\t100\t100\t1e-50\t100\t100.000\t0\n",
+                "q2\tamp1\t100\t100\t100\t1e-50\t100\t95.000\t5\n",  # pident
+                "q3\tamp2\t100\t200\t100\t1e-50\t100\t100.000\t0\n",  # alignment / subject length
+                "q4\tamp2\t100\t100\t95\t1e-50\t95\t99.000\t1\n"]
+        raw_out = os.path.join(self.tmp_dir.name, "raw_blast.out")
+        with open(raw_out, 'w') as f:
+            df = run_blast.read_hits(iter(rows), f, names, run_blast.hit_filter(96, 90, 0.9))
+
+        self.assertEqual(df['seq'].tolist(), ['q1', 'q4'])
+        self.assertEqual(df['pident'].tolist(), [100.0, 99.0])
+        self.assertEqual(str(df['cov'].dtype), 'int64')
+        with open(raw_out) as f:
+            self.assertEqual(f.readlines(), rows)
+
+        return
+
+    def test_amplicon_index(self):
+        """Test that a query identical to an amplicon (either strand) gets all of its hits, imperfect ones too,
+        that only the other records are sharded, and that the amplicons are blasted only once per database"""
+        amplicons = os.path.join(self.tmp_dir.name, "amplicons.fasta")
+        with open(amplicons, 'w') as f:
+            f.write(">ampA desc\nACGTTT\nGG\n>ampB\nCCCAAAT\n")
+        fasta = os.path.join(self.tmp_dir.name, "query.fasta")
+        with open(fasta, 'w') as f:
+            f.write(">q1\nccaaacgt\n>q2\nCCCAAAT\n>q3\nCCCAAA\n")
+        # a fake blastn: every query hits ampA (100% if identical, 97% otherwise) and ampB (96%)
+        blastn = os.path.join(self.tmp_dir.name, "blastn")
+        with open(blastn, 'w') as f:
+            f.write(f"#!{sys.executable}\nimport sys\n"
+                    f"open({self.calls!r}, 'a').write('blastn\\n')\n"
+                    "args = sys.argv\nlines = open(args[args.index('-query') + 1]).read().split()\n"
+                    "with open(args[args.index('-out') + 1], 'w') as out:\n"
+                    "    for qseqid, seq in zip(lines[::2], lines[1::2]):\n"
+                    "        pident = '100.000' if seq in ('ACGTTTGG', 'CCAAACGT') else '97.000'\n"
+                    "        out.write(f'{qseqid[1:]}\\tampA\\t{len(seq)}\\t8\\t8\\t0.0\\t100\\t{pident}\\t0\\n')\n"
+                    "        out.write(f'{qseqid[1:]}\\tampB\\t{len(seq)}\\t7\\t7\\t1e-3\\t100\\t96.000\\t1\\n')\n")
+        os.chmod(blastn, 0o755)
+        db = os.path.join(self.cache_dir, "db")
+        os.makedirs(self.cache_dir)
+
+        index = run_blast.AmpliconIndex(amplicons, db, blastn)
+        exact_out = os.path.join(self.tmp_dir.name, "exact_blast.out")
+        with open(exact_out, 'w') as f:
+            shard_files = run_blast.shard_fasta(fasta, 2, self.tmp_dir.name, index.hits, f)
+
+        with open(exact_out) as f:
+            self.assertEqual(f.readlines(), ["q1\tampA\t8\t8\t8\t0.0\t100\t100.000\t0\n",
+                                             "q1\tampB\t8\t7\t7\t1e-3\t100\t96.000\t1\n",
+                                             "q2\tampA\t7\t8\t8\t0.0\t100\t97.000\t0\n",
+                                             "q2\tampB\t7\t7\t7\t1e-3\t100\t96.000\t1\n"])
+        self.assertEqual(len(shard_files), 1)
+        with open(shard_files[0]) as f:
+            self.assertEqual(f.read(), ">q3\nCCCAAA\n")
+
+        # the hits of the amplicons are saved with the database
+        self.assertTrue(os.path.isfile(f"{db}.self_hits_10.tsv"))
+        self.assertEqual(run_blast.AmpliconIndex(amplicons, db, blastn).index, index.index)
+        with open(self.calls) as f:
+            self.assertEqual(f.readlines(), ["blastn\n"])
+
+        return
+
+    def test_blast_cache(self):
+        """Test that the hits (or no hits) of a sequence are cached, whatever its id in the next run"""
+        cache_file = os.path.join(self.cache_dir, "hits.sqlite")
+        cache = run_blast.BlastCache(self.reference, "-max_target_seqs 10", cache_file)
+        self.assertIsNone(cache.lookup([">q1\n", "ACGT\n"]))
+        self.assertIsNone(cache.lookup([">q2\n", "GGGG\n"]))
+        raw_out = os.path.join(self.tmp_dir.name, "raw_blast.out")
+        with open(raw_out, 'w') as f:
+            f.write("q1\tamp1\t4\t4\t4\t1e-5\t100\t100.000\t0\nq1\tamp2\t4\t4\t4\t1e-5\t100\t75.000\t1\n")
+        cache.store([raw_out])
+        cache.close()
+
+        cache = run_blast.BlastCache(self.reference, "-max_target_seqs 10", cache_file)
+        self.assertEqual(cache.lookup([">s7 run2\n", "acgt\n"]), ["s7\tamp1\t4\t4\t4\t1e-5\t100\t100.000\t0\n",
+                                                                  "s7\tamp2\t4\t4\t4\t1e-5\t100\t75.000\t1\n"])
+        self.assertEqual(cache.lookup([">s8\n", "GG\n", "GG\n"]), [])
+        # other blast parameters
+        self.assertIsNone(run_blast.BlastCache(self.reference, "-max_target_seqs 1", cache_file).lookup([">q1\n", "ACGT\n"]))
+        cache.close()
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
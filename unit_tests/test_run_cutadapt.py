@@ -0,0 +1,60 @@
+import unittest
+import os
+import shutil
+import logging
+import tempfile
+import run_cutadapt
+
+class TestRun_cutadapt(unittest.TestCase):
+
+    def setUp(self):
+        """ set up the split fasta files of 4 primers, of 4, 3, 2 and 1 records"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.commands = []
+        for records, key in enumerate(['P1', 'P2', 'P3', 'P4'][::-1], 1):
+            fasta = os.path.join(self.tmp_dir.name, f"test.{key}.fasta")
+            with open(fasta, 'w') as f:
+                f.write(">r\nACGTACGT\n" * records)
+            self.commands.append((key, ['cutadapt', '-g', 'ACG...CGT', '-o', f"{fasta}_cutadapt", fasta]))
+        self.commands.reverse()
+
+        return
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_make_tasks(self):
+        """Test that the commands are balanced (by input size) among the tasks, largest input first"""
+        tasks = run_cutadapt.make_tasks(self.commands, 2)
+        self.assertEqual([[key for key, _ in task] for task in tasks], [['P1', 'P4'], ['P2', 'P3']])
+        self.assertEqual(len(run_cutadapt.make_tasks(self.commands, 10)), 4)
+        self.assertEqual(run_cutadapt.make_tasks([], 2), [[]])
+
+        return
+
+    def test_run_cutadapt_task(self):
+        """Test the in-process cutadapt runs: their report, and that their logging handlers don't pile up"""
+        calls = []
+        def fake_cutadapt_main(args):
+            calls.append(args)
+            logging.getLogger().addHandler(logging.NullHandler())
+            shutil.copy(args[-1], args[-2])
+            with open(args[-2], 'a') as f:
+                f.write(">r\nAC\n")
+
+        cutadapt_main, run_cutadapt.cutadapt_main = run_cutadapt.cutadapt_main, fake_cutadapt_main
+        handlers = logging.getLogger().handlers[:]
+        try:
+            report = run_cutadapt.run_cutadapt_task(self.commands[:2])
+        finally:
+            run_cutadapt.cutadapt_main = cutadapt_main
+        self.assertEqual(logging.getLogger().handlers, handlers)
+        self.assertEqual(calls[0][0], '--quiet')
+        self.assertEqual([row[:1] + row[2:4] for row in report], [('P1', 4, 5), ('P2', 3, 4)])
+        self.assertEqual(report[0][4], self.commands[0][1][-2])
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+import os
+import gzip
+import pickle
+import tempfile
+import seq_reader
+
+class TestSeq_reader(unittest.TestCase):
+
+    def setUp(self):
+        """ set up a single line fasta, a wrapped (CRLF) fasta and a gzipped fastq"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.fasta = os.path.join(self.tmp_dir.name, "test.fasta")
+        self.wrapped = os.path.join(self.tmp_dir.name, "wrapped.fasta")
+        self.fastq = os.path.join(self.tmp_dir.name, "test.fastq.gz")
+
+        with open(self.fasta, 'w') as f:
+            f.write(">s1 primer=P1\nACGT\n>s2\nGG\n>s1\nTTTT\n")
+        with open(self.wrapped, 'wb') as f:
+            f.write(b">s1 primer=P1\r\nAC\r\nGT\r\n\r\n>s2\r\nGG\r\n")
+        with gzip.open(self.fastq, 'wt') as f:
+            f.write("@r1 1:N\nACGT\n+\n@III\n@r2\nGG\n+\nII\n")
+
+        return
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_read_records(self):
+        """Test the records of a single line fasta, a wrapped fasta and a fastq"""
+        expected = [("s1 primer=P1", "ACGT", None), ("s2", "GG", None)]
+        self.assertEqual(list(seq_reader.read_records(self.fasta))[:2], expected)
+        self.assertEqual(list(seq_reader.read_records(self.wrapped)), expected)
+
+        records = list(seq_reader.read_records(self.fastq))
+        self.assertEqual(records, [("r1 1:N", "ACGT", "@III"), ("r2", "GG", "II")])
+        self.assertEqual(records[0].id, "r1")
+
+        return
+
+    def test_read_batches(self):
+        """Test the batches of memoryview records, with gzip blocks smaller than a record"""
+        chunk_size, seq_reader.CHUNK_SIZE = seq_reader.CHUNK_SIZE, 5
+        try:
+            batches = list(seq_reader.read_batches(self.fastq, batch_size=1))
+        finally:
+            seq_reader.CHUNK_SIZE = chunk_size
+        self.assertEqual(len(batches), 2)
+        self.assertIsInstance(batches[0][0].seq, memoryview)
+        self.assertEqual([bytes(batch[0].qual) for batch in batches], [b"@III", b"II"])
+
+        return
+
+    def test_seq_index(self):
+        """Test the dictionary index, which keeps the first record of a duplicated seq ID"""
+        index = seq_reader.SeqIndex(self.fasta)
+        self.assertEqual(dict(index), {"s1": "ACGT", "s2": "GG"})
+        self.assertEqual(index.duplicates, ["s1"])
+        self.assertEqual(seq_reader.SeqIndex(self.wrapped)["s1"], "ACGT")
+
+        return
+
+    def test_offset_index(self):
+        """Test the lazy records of the offset index, which is rebuilt only when the file changes"""
+        with seq_reader.OffsetIndex(self.wrapped) as index:
+            self.assertEqual(list(index), ["s1", "s2"])
+            self.assertEqual(index["s2"], ("s2", "GG", None))
+            self.assertEqual(pickle.loads(pickle.dumps(index))["s1"].seq, "ACGT")
+        self.assertTrue(os.path.isfile(seq_reader.index_file(self.wrapped)))
+        # no temp file is left behind by the index
+        self.assertEqual(sorted(f for f in os.listdir(self.tmp_dir.name) if f.startswith("wrapped.")),
+                         ["wrapped.fasta", os.path.basename(seq_reader.index_file(self.wrapped))])
+
+        with open(self.wrapped, 'ab') as f:
+            f.write(b">s3\r\nCCA\r\n")
+        index = seq_reader.OffsetIndex(self.wrapped)
+        self.assertEqual(index["s3"].seq, "CCA")
+        self.assertEqual(index.source['size'], os.path.getsize(self.wrapped))
+        index.close()
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import utilities
+
+class TestUtilities(unittest.TestCase):
+
+    def setUp(self):
+        """ set up a small oligo file"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.oligo_file = os.path.join(self.tmp_dir.name, "test.oligos")
+
+        with open(self.oligo_file, 'w') as f:
+            f.write("primer\tACGT\tAACC\tP1\nprimer\tGGTT\tTTGC\tP2\nprimer\tCCAA\tGTCA\tP3\n")
+
+        return
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_reference_context(self):
+        """Test the primer universe and the predicted primers of a sample with 2 isolates"""
+        ref = utilities.ReferenceContext(self.oligo_file,
+                                         {'iso1': ['P1', 'P4'], 'iso2': ['P2']},
+                                         {'S1': ['iso1', 'iso2', 'iso3'], 'S2': ['iso2']})
+        self.assertEqual(ref.primers, frozenset(['P1', 'P2', 'P3']))
+        # P4 is not in the oligo file and iso3 is not in the metasheet
+        self.assertEqual(ref.predicted_primers('S1'), (frozenset(['P1', 'P2']), ['iso3']))
+        self.assertEqual(ref.predicted_primers('S2'), (frozenset(['P2']), []))
+        self.assertEqual(ref.predicted_primers('S3'), (frozenset(), []))
+
+        return
+
+    def test_encode(self):
+        """Test the boolean primer matrices, with a primer (X) outside of the primer universe"""
+        ref = utilities.ReferenceContext(self.oligo_file)
+        observed = pd.DataFrame([[1, None], [None, 2]], index=['S2', 'S1'], columns=['P3', 'X'])
+        columns, (predicted, observed) = ref.encode(['S1', 'S2'], {'S1': ['P2'], 'S2': ['P1', 'P2']}, observed)
+        self.assertEqual(columns, ['P1', 'P2', 'P3', 'X'])
+        self.assertEqual(ref.universe(columns).tolist(), [True, True, True, False])
+        self.assertEqual(predicted.tolist(), [[False, True, False, False], [True, True, False, False]])
+        self.assertEqual(observed.tolist(), [[False, False, False, True], [False, False, True, False]])
+
+        return
+
+    def test_confusion_metrics(self):
+        """Test the TP/FP/FN/TN counts and the derived metrics"""
+        TP, FP, FN, TN = (np.array(matrix, dtype=bool) for matrix in
+                          ([[1, 1, 0]], [[0, 0, 1]], [[0, 0, 0]], [[0, 0, 0]]))
+        df = utilities.confusion_metrics(['S1'], TP, FP, FN, TN)
+        self.assertEqual(df.loc['S1', ['TP', 'FP', 'FN', 'TN']].tolist(), [2, 1, 0, 0])
+        self.assertEqual(df.loc['S1', 'sensitivity (TP/P)'], 1.0)
+        self.assertEqual(df.loc['S1', 'precision (TP/TP+FP)'], 0.667)
+        self.assertEqual(df.loc['S1', 'ACC'], 0.667)
+
+        return
+
+    def test_peak_memory_mb(self):
+        """Test that the peak memory is a positive number of MB (None without the resource module)"""
+        peak = utilities.peak_memory_mb()
+        if utilities.resource is None:
+            self.assertIsNone(peak)
+        else:
+            self.assertGreater(peak, 0)
+
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()